@@ -88,6 +88,15 @@ DATABASES['default']['ATOMIC_REQUESTS'] = True
 
 # custom crate engine where we use a customized postgres backend engine
 DATABASES['crate']['ENGINE'] = 'cratedb.connector'
+# reuse the crate connections across requests from a pool, set CRATE_POOL_MAXCONN=0 to disable;
+# each thread holds a connection until the end of its request or task so CRATE_POOL_MAXCONN should be
+# at least the number of threads per process (web server threads, Celery concurrency, script workers),
+# when they are all in use a thread waits CRATE_POOL_TIMEOUT seconds before failing with an OperationalError
+DATABASES['crate'].setdefault('OPTIONS', {}).update({
+    'pool_minconn': env.int('CRATE_POOL_MINCONN', default=1),
+    'pool_maxconn': env.int('CRATE_POOL_MAXCONN', default=10),
+    'pool_timeout': env.int('CRATE_POOL_TIMEOUT', default=30),
+})
 
 DATABASE_ROUTERS = ['config.db_routers.CrateRouter']
 
@@ -135,6 +144,7 @@ LOCAL_APPS = [
     'opentaps_seas.api.apps.ApiAppConfig',
     'opentaps_seas.eemeter.apps.EEMeterAppConfig',
     'opentaps_seas.party.apps.PartyAppConfig',
+    'opentaps_seas.haystack.apps.HaystackAppConfig',
     # Your stuff: custom apps go here
 ]
 # https://docs.djangoproject.com/en/dev/ref/settings/#installed-apps
@@ -291,6 +301,27 @@ VOLTTRON_VC_PASSWORD = get_secret('VOLTTRON_VC_PASSWORD', required=False)
 
 GOOGLE_API_KEY = get_secret('GOOGLE_API_KEY', required=False)
 CRATE_TAG_AUTOSYNC = get_secret('CRATE_TAG_AUTOSYNC', required=False)
+# how long in seconds the latest data point values are cached, 0 to always query Crate;
+# the periodic refresh task can only update them when the cache is shared, eg: Redis
+CRATE_LAST_VALUE_TTL = env.int('CRATE_LAST_VALUE_TTL', default=300)
+# the rollups re-aggregate that many seconds before their watermark on each refresh for the data arriving late,
+# older data imported later should be flagged with utils.mark_rollups_dirty
+CRATE_ROLLUP_LATE_WINDOW = env.int('CRATE_ROLLUP_LATE_WINDOW', default=7200)
+# how many seconds of data a rollup refresh aggregates at most, bounds the first runs over existing data
+CRATE_ROLLUP_MAX_SPAN = env.int('CRATE_ROLLUP_MAX_SPAN', default=604800)
+# how long in seconds the rollup watermarks kept in Crate are cached
+CRATE_ROLLUP_WATERMARK_TTL = env.int('CRATE_ROLLUP_WATERMARK_TTL', default=60)
+# how long in seconds the list of kv tag columns of the Crate topic table is cached
+CRATE_TOPIC_TAGS_TTL = env.int('CRATE_TOPIC_TAGS_TTL', default=3600)
+# how long in seconds the counts and page boundaries of the filtered topic lists are cached,
+# they are also dropped when the topic tags change
+TOPIC_LIST_CACHE_TTL = env.int('TOPIC_LIST_CACHE_TTL', default=300)
+# log the SQL and query plan of the filtered topic queries
+EXPLAIN_TOPIC_FILTERS = env.bool('EXPLAIN_TOPIC_FILTERS', default=False)
+# how long in seconds the Haystack nav tree is cached, it is also rebuilt when an Entity changes
+HAYSTACK_NAV_CACHE_TTL = env.int('HAYSTACK_NAV_CACHE_TTL', default=3600)
+# default lease in seconds of the Haystack watches, they expire when not polled for that long
+HAYSTACK_WATCH_LEASE = env.int('HAYSTACK_WATCH_LEASE', default=300)
 OPENEI_API_KEY = get_secret('OPENEI_API_KEY', required=False)
 UTILITY_API_KEY = get_secret('UTILITY_API_KEY', required=False)
 
@@ -309,6 +340,16 @@ CELERY_ACCEPT_CONTENT = ['pickle', 'json']
 CELERY_TASK_SERIALIZER = 'pickle'
 CELERY_RESULT_SERIALIZER = 'pickle'
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {
+    'refresh-last-values': {
+        'task': 'opentaps_seas.core.tasks.refresh_last_values_task',
+        'schedule': 60.0,
+    },
+    'refresh-rollups': {
+        'task': 'opentaps_seas.core.tasks.refresh_rollups_task',
+        'schedule': 300.0,
+    },
+}
 
 # FIXTURES
 # ------------------------------------------------------------------------------
@@ -73,3 +73,7 @@ EMAIL_PORT = 1025
 # ------------------------------------------------------------------------------
 DATABASES['crate']['TEST'] = {'NAME': 'test'}
 DATABASES['crate']['BYPASS_CREATION'] = True
+# tests insert data points and expect to read them back right away
+CRATE_LAST_VALUE_TTL = 0
+# entities are rolled back between tests without any signal
+HAYSTACK_NAV_CACHE_TTL = 0
@@ -37,6 +37,7 @@ try:
     import psycopg2 as Database
     import psycopg2.extensions
     import psycopg2.extras
+    import psycopg2.pool
 except ImportError as e:
     raise ImproperlyConfigured("Error loading psycopg2 module: %s" % e)
 
@@ -74,6 +75,52 @@ INETARRAY = psycopg2.extensions.new_array_type(
 )
 psycopg2.extensions.register_type(INETARRAY)
 
+# Connection pools shared by all the DatabaseWrapper of a process, keyed by
+# the connection parameters, see DatabaseWrapper.get_pool
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class BlockingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    A ThreadedConnectionPool where getconn waits up to timeout seconds for a
+    connection to be given back when all maxconn of them are in use, instead
+    of failing right away with a PoolError.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        if not self._semaphore.acquire(timeout=self.timeout):
+            raise Database.OperationalError(
+                "No connection available in the pool after %s seconds, all %s "
+                "are in use; pool_maxconn should be at least the number of "
+                "threads using this database" % (self.timeout, self.maxconn))
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._semaphore.release()
+
+
+def connection_is_usable(connection):
+    try:
+        # Use a psycopg cursor directly, bypassing Django's utilities.
+        connection.cursor().execute("SELECT 1")
+    except Database.Error:
+        return False
+    else:
+        return True
+
 
 class DatabaseWrapper(BaseDatabaseWrapper):
     vendor = 'postgresql_crate'
@@ -158,6 +205,8 @@ class DatabaseWrapper(BaseDatabaseWrapper):
     ops_class = DatabaseOperations
     # PostgreSQL backend-specific attributes.
     _named_cursor_idx = 0
+    # set when the connection comes from a pool, see get_pool
+    pool = None
 
     def get_connection_params(self):
         settings_dict = self.settings_dict
@@ -171,6 +220,10 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         }
         conn_params.update(settings_dict['OPTIONS'])
         conn_params.pop('isolation_level', None)
+        # pool options are only for the pool and not for psycopg2.connect
+        conn_params.pop('pool_minconn', None)
+        conn_params.pop('pool_maxconn', None)
+        conn_params.pop('pool_timeout', None)
         if settings_dict['USER']:
             conn_params['user'] = settings_dict['USER']
         if settings_dict['PASSWORD']:
@@ -181,8 +234,48 @@ class DatabaseWrapper(BaseDatabaseWrapper):
             conn_params['port'] = settings_dict['PORT']
         return conn_params
 
+    def get_pool(self, conn_params):
+        # Pooling is enabled by setting pool_maxconn in the database OPTIONS,
+        # in which case connections are taken from and returned to a
+        # BlockingConnectionPool instead of being opened and closed every time.
+        # Each thread keeps its connection until the connection is closed, at
+        # the end of a request or task, so pool_maxconn should be at least the
+        # number of threads of the process using this database (web server
+        # threads, Celery worker threads, script workers); beyond that they
+        # wait up to pool_timeout seconds then get an OperationalError.
+        options = self.settings_dict['OPTIONS']
+        maxconn = options.get('pool_maxconn')
+        if not maxconn:
+            return None
+        minconn = options.get('pool_minconn', 1)
+        timeout = options.get('pool_timeout', 30)
+        key = (self.alias, tuple(sorted(conn_params.items())))
+        with _pools_lock:
+            pool = _pools.get(key)
+            if not pool:
+                pool = BlockingConnectionPool(minconn, maxconn, timeout, **conn_params)
+                _pools[key] = pool
+        return pool
+
+    def get_pooled_connection(self, pool):
+        # check the connection is still alive before handing it out, a dead one
+        # is discarded from the pool and the next one is tried: after a restart of
+        # the database all the idle connections are dead, so up to maxconn of them
+        # are drained before a new connection is made
+        for _ in range(pool.maxconn + 1):
+            connection = pool.getconn()
+            if not connection.closed and connection_is_usable(connection):
+                return connection
+            pool.putconn(connection, close=True)
+        raise Database.OperationalError(
+            "No usable connection in the pool after discarding %s dead ones" % (pool.maxconn + 1))
+
     def get_new_connection(self, conn_params):
-        connection = Database.connect(**conn_params)
+        self.pool = self.get_pool(conn_params)
+        if self.pool:
+            connection = self.get_pooled_connection(self.pool)
+        else:
+            connection = Database.connect(**conn_params)
 
         # self.isolation_level must be set:
         # - after connecting to the database in order to obtain the database's
@@ -252,14 +345,17 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         self.cursor().execute('SET CONSTRAINTS ALL IMMEDIATE')
         self.cursor().execute('SET CONSTRAINTS ALL DEFERRED')
 
-    def is_usable(self):
-        try:
-            # Use a psycopg cursor directly, bypassing Django's utilities.
-            self.connection.cursor().execute("SELECT 1")
-        except Database.Error:
-            return False
+    def _close(self):
+        if self.connection is not None and self.pool:
+            # give the connection back to the pool, which rolls back any
+            # pending transaction, or drops it if it was broken
+            with self.wrap_database_errors:
+                self.pool.putconn(self.connection, close=bool(self.connection.closed))
         else:
-            return True
+            super()._close()
+
+    def is_usable(self):
+        return connection_is_usable(self.connection)
 
     @property
     def _nodb_connection(self):
@@ -101,3 +101,40 @@ WITH (
    "warmer.enabled" = true,
    "write.wait_for_active_shards" = 'ALL'
 );
+
+-- Rollups of the Number data points, maintained by the refresh_rollups_task
+
+CREATE TABLE IF NOT EXISTS "volttron"."data_hourly" (
+   "topic" STRING,
+   "ts" TIMESTAMP,
+   "avg_value" DOUBLE,
+   "min_value" DOUBLE,
+   "max_value" DOUBLE,
+   "count_value" LONG,
+   PRIMARY KEY ("topic", "ts")
+)
+CLUSTERED BY ("topic");
+
+CREATE TABLE IF NOT EXISTS "volttron"."data_daily" (
+   "topic" STRING,
+   "ts" TIMESTAMP,
+   "avg_value" DOUBLE,
+   "min_value" DOUBLE,
+   "max_value" DOUBLE,
+   "count_value" LONG,
+   PRIMARY KEY ("topic", "ts")
+)
+CLUSTERED BY ("topic");
+
+CREATE TABLE IF NOT EXISTS "volttron"."rollup_state" (
+   "rollup" STRING PRIMARY KEY,
+   "watermark" TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS "volttron"."rollup_dirty" (
+   "rollup" STRING,
+   "topic" STRING,
+   "ts" TIMESTAMP,
+   "marked" TIMESTAMP,
+   PRIMARY KEY ("rollup", "topic")
+);
@@ -15,44 +15,176 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import re
 import requests
-import csv
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = 10
+# idempotent requests failing with those statuses or a connection error are retried,
+# waiting backoff_factor * 2 ^ retry seconds between each
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# a Zinc cell: quoted strings may contain commas, eg: @id "Dis, with comma"
+ZINC_CELL_RE = re.compile(r'((?:"(?:[^"\\]|\\.)*"|[^,"])*)(?:,|$)')
+ZINC_ESCAPE_RE = re.compile(r'\\(u[0-9a-fA-F]{4}|.)')
+ZINC_ESCAPES = {
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+}
+
+
+class HSClientError(Exception):
+    pass
+
+
+def _unescape(m):
+    esc = m.group(1)
+    if esc[0] == 'u' and len(esc) == 5:
+        return chr(int(esc[1:], 16))
+    return ZINC_ESCAPES.get(esc, esc)
+
+
+def split_zinc_row(line):
+    # the cells of a Zinc row, strings are unquoted and unescaped other values are kept as is
+    cells = []
+    pos = 0
+    end = len(line)
+    while pos <= end:
+        m = ZINC_CELL_RE.match(line, pos)
+        cell = m.group(1).strip()
+        if len(cell) > 1 and cell[0] == '"' and cell[-1] == '"':
+            cell = ZINC_ESCAPE_RE.sub(_unescape, cell[1:-1])
+        cells.append(cell)
+        if m.end() == pos or m.end() > end or line[m.end() - 1] != ',':
+            break
+        pos = m.end()
+    return cells
+
+
+def parse_grid_lines(lines):
+    # parse a Zinc grid from an iterable of lines, returns the column names and
+    # a generator of the rows so the grid never has to be held in memory
+    lines = iter(lines)
+    header = []
+    # the first line is the version and grid metadata
+    for line in lines:
+        if line.strip():
+            break
+    for line in lines:
+        # column names, possibly followed by their metadata
+        header = [c.split(' ', 1)[0] for c in split_zinc_row(line)]
+        break
+
+    def rows():
+        for line in lines:
+            if not line.strip():
+                # end of the grid
+                break
+            yield split_zinc_row(line)
+
+    return header, rows()
+
+
+class GridRows(object):
+    """ The rows of a grid parsed as its response is read, the response is closed once all the rows
+    are read or when closed, which can be done with a with block:
+        header, rows = client.his_read_grid(id)
+        with rows:
+            for row in rows:
+                ..."""
+
+    def __init__(self, res, rows):
+        self.res = res
+        self.rows = rows
+
+    def __iter__(self):
+        try:
+            for row in self.rows:
+                yield row
+        except requests.RequestException as e:
+            raise HSClientError("Can't read the response of %s: %s" % (self.res.url, e))
+        finally:
+            self.close()
+
+    def close(self):
+        self.res.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 class HSClient(object):
 
-    def __init__(self, url, username=None, password=None):
+    def __init__(self, url, username=None, password=None, session=None, timeout=DEFAULT_TIMEOUT, retries=3,
+                 backoff_factor=0.5, pool_maxsize=10):
         self.url = url
+        self.timeout = timeout
         self.headers = {}
         self.contentTypeHeaders = {
             'Content-Type': 'text/zinc;charset=utf-8',
             'Accept': 'text/zinc;charset=utf-8',
         }
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        # one session for all the requests of this client, keeping the connections alive
+        if not session:
+            session = requests.Session()
+            retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES)
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_maxsize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
 
     def get(self, url):
         """ Perform a GET request"""
         return self.do_url_request(url)
 
-    def do_url_request(self, url, body=None, method='GET'):
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    def do_url_request(self, url, body=None, method='GET', params=None, stream=False):
+        """ Perform the request and return the response text, or the response itself when streaming,
+        raises HSClientError if the request failed"""
         currentHeaders = self.contentTypeHeaders
 
         try:
             if method == 'GET':
-                res = requests.get(url, headers=currentHeaders, verify=False, timeout=2)
+                res = self.session.get(url, params=params, headers=currentHeaders, verify=False,
+                                       timeout=self.timeout, stream=stream)
             elif method == 'POST':
-                res = requests.post(url, data=body, headers=currentHeaders, verify=False)
+                res = self.session.post(url, data=body, headers=currentHeaders, verify=False, timeout=self.timeout,
+                                        stream=stream)
             else:
                 raise ValueError("Method %s is not supported right now." % method)
 
             self.response = res.status_code
-            content = res.text
+            res.raise_for_status()
+        except requests.RequestException as e:
+            raise HSClientError("Can't perform request to %s: %s" % (url, e))
+
+        if stream:
+            return res
+        return res.text
+
+    def get_grid(self, op, params=None):
+        """ Perform a GET request and return the grid column names and its GridRows, which are parsed
+        as the response is read, the response stays open until they are all read or closed"""
+        res = self.do_url_request(self.url + "/" + op, params=params, stream=True)
+        # the Zinc grids are UTF-8 even when the content type does not say so
+        res.encoding = 'utf-8'
+        try:
+            header, rows = parse_grid_lines(res.iter_lines(decode_unicode=True))
+        except requests.RequestException as e:
+            res.close()
+            raise HSClientError("Can't read the response of %s: %s" % (res.url, e))
         except Exception:
-            print("Can't perform request to %s" % (url))
-            return ""
-
-        return content
+            res.close()
+            raise
+        return header, GridRows(res, rows)
 
     def about(self):
         return self.get(self.url + "/about")
@@ -67,44 +199,50 @@ class HSClient(object):
         if not filter:
             raise ValueError("filter parameter is required")
 
-        op_url = self.url + "/read?filter=%s" % filter
+        return self.do_url_request(self.url + "/read", params=self.read_params(filter, limit))
+
+    def read_grid(self, filter=None, limit=None):
+        if not filter:
+            raise ValueError("filter parameter is required")
+
+        return self.get_grid("read", params=self.read_params(filter, limit))
+
+    def read_params(self, filter, limit):
+        params = {'filter': filter}
         if limit:
-            op_url = op_url + "&limit=%s" % limit
-        return self.get(op_url)
+            params['limit'] = limit
+        return params
 
     def nav(self, nav_id=None):
-        op_url = self.url + "/nav"
-        if nav_id:
-            op_url = op_url + "?navId=%s" % nav_id
+        return self.do_url_request(self.url + "/nav", params=self.nav_params(nav_id))
+
+    def nav_grid(self, nav_id=None):
+        return self.get_grid("nav", params=self.nav_params(nav_id))
 
-        return self.get(op_url)
+    def nav_params(self, nav_id):
+        params = {}
+        if nav_id:
+            params['navId'] = nav_id
+        return params
 
     def his_read(self, id=None, range=None):
         if not id:
             raise ValueError("id is required")
 
-        op_url = self.url + "/hisRead?id=%s" % (id)
-        if range:
-            op_url = op_url + "&range=%s" % (range)
+        return self.do_url_request(self.url + "/hisRead", params=self.his_read_params(id, range))
 
-        return self.get(op_url)
+    def his_read_grid(self, id=None, range=None):
+        if not id:
+            raise ValueError("id is required")
 
-    def parse_grid(self, source):
-        header = []
-        data = []
-        reader = csv.reader(source.splitlines(), delimiter=',', lineterminator="\n", quoting=csv.QUOTE_MINIMAL)
-        line_number = 0
-        for row in reader:
-            if line_number == 0:
-                line_number = line_number + 1
-                continue
-            elif line_number == 1:
-                # add header
-                header = row
-            else:
-                # add data
-                data.append(row)
+        return self.get_grid("hisRead", params=self.his_read_params(id, range))
 
-            line_number = line_number + 1
+    def his_read_params(self, id, range):
+        params = {'id': id}
+        if range:
+            params['range'] = range
+        return params
 
-        return header, data
+    def parse_grid(self, source):
+        header, rows = parse_grid_lines(source.splitlines())
+        return header, list(rows)
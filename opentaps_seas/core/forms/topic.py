@@ -19,8 +19,10 @@ import logging
 import json
 import csv
 from io import TextIOWrapper
+from .. import topic_rules_utils
 from .. import utils
 from ..models import Entity
+from ..models import defer_crate_tag_sync
 from ..models import SiteView
 from ..models import Tag
 from ..models import TopicTagRule
@@ -57,6 +59,7 @@ class TopicTagRuleSetRunForm(forms.Form):
     topic_filter = ModelField(label='Topic Filter', max_length=255, required=False)
     preview_type = forms.CharField(required=False)
     diff_format = forms.BooleanField(label="Preview in a diff format", required=False, initial=False)
+    use_async = forms.BooleanField(required=False, initial=False)
 
     def is_valid(self):
         if not super().is_valid():
@@ -81,62 +84,16 @@ class TopicTagRuleSetRunForm(forms.Form):
         logger.info('TopicTagRuleSetRunForm: for set %s and additional filter: %s, pretend: %s',
                     ruleset_id, topic_filter, pretend)
         rule_set = TopicTagRuleSet.objects.get(id=ruleset_id)
-        # collect count of topics we ran for
-        updated_set = set()
-        updated_entities = {}
-        updated_tags = {}
-        removed_tags = {}
-        new_equipments = []
-        for rule in rule_set.topictagrule_set.all():
-            rule_filters = rule.filters
-            # Add the topic_filter to the rule filters if given
-            if topic_filter:
-                tf = {'type': 'c', 'value': topic_filter}
-                if rule_filters:
-                    rule_filters.append(tf)
-                else:
-                    rule_filters = [tf]
-            if rule.tags:
-                updated, updated_curr_entities, updated_curr_tags, removed_curr_tags = utils.tag_topics(
-                    rule_filters, rule.tags, select_all=True, pretend=pretend)
-                for x in updated:
-                    updated_set.add(x.get('topic'))
-
-                for key in updated_curr_entities.keys():
-                    updated_curr_entity = updated_curr_entities.get(key, {})
-                    topic = updated_curr_entity.topic
-                    kv_tags = updated_curr_entity.kv_tags
-                    m_tags = updated_curr_entity.m_tags
-                    updated_entity = updated_entities.get(key, {})
-                    updated_entity['topic'] = topic
-                    updated_kv_tags = updated_entity.get('kv_tags', {})
-                    updated_m_tags = updated_entity.get('m_tags', [])
-                    for tag, value in kv_tags.items():
-                        updated_kv_tags[tag] = value
-                    for tag in m_tags:
-                        if tag not in updated_m_tags:
-                            updated_m_tags.append(tag)
-
-                    updated_entity['kv_tags'] = updated_kv_tags
-                    updated_entity['m_tags'] = updated_m_tags
-
-                    updated_entities[key] = updated_entity
-
-                for key, updated_curr_tag in updated_curr_tags.items():
-                    updated_tag = updated_tags.get(key, {})
-                    for tag, value in updated_curr_tag.items():
-                        updated_tag[tag] = value
-                    updated_tags[key] = updated_tag
-
-                for key, removed_curr_tag in removed_curr_tags.items():
-                    removed_tag = removed_tags.get(key, {})
-                    for tag, value in removed_curr_tag.items():
-                        removed_tag[tag] = value
-                    removed_tags[key] = removed_tag
-
-            if rule.action and rule.action_fields and not pretend:
-                if rule.action == 'create equipment':
-                    new_equipments = utils.create_equipment_action(rule_filters, rule.action_fields)
+        # the tags of the data points for the preview reports, collected by the preview
+        self.report_tags = None
+        if pretend:
+            state = topic_rules_utils.TopicTagsState()
+            updated_set, updated_entities, updated_tags, removed_tags, new_equipments = \
+                topic_rules_utils.preview_topic_tag_ruleset(rule_set, topic_filter=topic_filter, state=state)
+            self.report_tags = state.tags
+        else:
+            updated_set, updated_entities, updated_tags, removed_tags, new_equipments = utils.run_topic_tag_ruleset(
+                rule_set, topic_filter=topic_filter)
 
         return updated_set, updated_entities, preview_type, updated_tags, removed_tags, diff_format, new_equipments
 
@@ -196,61 +153,16 @@ class TopicTagRuleRunForm(forms.Form):
         logger.info('TopicTagRuleRunForm: for set %s and additional filter: %s, pretend: %s',
                     rule_id, topic_filter, pretend)
         rule = TopicTagRule.objects.get(id=rule_id)
-        # collect count of topics we ran for
-        updated_set = set()
-        updated_entities = {}
-        updated_tags = {}
-        removed_tags = {}
-        new_equipments = []
-        rule_filters = rule.filters
-        # Add the topic_filter to the rule filters if given
-        if topic_filter:
-            tf = {'type': 'c', 'value': topic_filter}
-            if rule_filters:
-                rule_filters.append(tf)
-            else:
-                rule_filters = [tf]
-        if rule.tags:
-            updated, updated_curr_entities, updated_curr_tags, removed_curr_tags = utils.tag_topics(
-                rule_filters, rule.tags, select_all=True, pretend=pretend)
-            for x in updated:
-                updated_set.add(x.get('topic'))
-
-            for key in updated_curr_entities.keys():
-                updated_curr_entity = updated_curr_entities.get(key, {})
-                topic = updated_curr_entity.topic
-                kv_tags = updated_curr_entity.kv_tags
-                m_tags = updated_curr_entity.m_tags
-                updated_entity = updated_entities.get(key, {})
-                updated_entity['topic'] = topic
-                updated_kv_tags = updated_entity.get('kv_tags', {})
-                updated_m_tags = updated_entity.get('m_tags', [])
-                for tag, value in kv_tags.items():
-                    updated_kv_tags[tag] = value
-                for tag in m_tags:
-                    if tag not in updated_m_tags:
-                        updated_m_tags.append(tag)
-
-                updated_entity['kv_tags'] = updated_kv_tags
-                updated_entity['m_tags'] = updated_m_tags
-
-                updated_entities[key] = updated_entity
-
-            for key, updated_curr_tag in updated_curr_tags.items():
-                updated_tag = updated_tags.get(key, {})
-                for tag, value in updated_curr_tag.items():
-                    updated_tag[tag] = value
-                updated_tags[key] = updated_tag
-
-            for key, removed_curr_tag in removed_curr_tags.items():
-                removed_tag = removed_tags.get(key, {})
-                for tag, value in removed_curr_tag.items():
-                    removed_tag[tag] = value
-                removed_tags[key] = removed_tag
-
-        if rule.action and rule.action_fields and not pretend:
-            if rule.action == 'create equipment':
-                new_equipments = utils.create_equipment_action(rule_filters, rule.action_fields)
+        # the tags of the data points for the preview reports, collected by the preview
+        self.report_tags = None
+        if pretend:
+            state = topic_rules_utils.TopicTagsState()
+            updated_set, updated_entities, updated_tags, removed_tags, new_equipments = \
+                topic_rules_utils.preview_topic_tag_rules([rule], topic_filter=topic_filter, state=state)
+            self.report_tags = state.tags
+        else:
+            updated_set, updated_entities, updated_tags, removed_tags, new_equipments = utils.run_topic_tag_rules(
+                [rule], topic_filter=topic_filter)
 
         return updated_set, updated_entities, preview_type, updated_tags, removed_tags, diff_format, new_equipments
 
@@ -401,64 +313,67 @@ class TopicImportForm(forms.Form):
                 import_errors = 'Could not get site {}'.format(site_id)
 
         if site:
-            for row in records:
-                if 'Volttron Point Name' in row:
-                    topic = '/'.join([prefix, row['Volttron Point Name']])
-                    entity_id = utils.make_random_id(topic)
-                    name = row['Volttron Point Name']
-                    # create the topic if it does not exist in the Crate Database
-                    Topic.ensure_topic_exists(topic)
-                    # update or create the Data Point
-                    try:
-                        e = Entity.objects.get(topic=topic)
-                    except Entity.DoesNotExist:
-                        e = Entity(entity_id=entity_id, topic=topic)
-                        e.add_tag('id', entity_id, commit=False)
-                    e.add_tag('point', commit=False)
-                    e.add_tag('dis', name, commit=False)
-                    if site.kv_tags.get('id'):
-                        e.add_tag('siteRef', site.kv_tags.get('id'), commit=False)
-                    if row.get('Units'):
-                        e.add_tag('unit', row['Units'], commit=False)
-
-                    e.add_tag(Tag.bacnet_tag_prefix + 'prefix', prefix, commit=False)
-                    # add all bacnet tags
-                    for k, v in row.items():
-                        field = k.lower()
-                        field = field.replace(' ', '_')
-                        if field == 'point_name':
-                            field = 'reference_point_name'
-                        if v:
-                            e.add_tag(Tag.bacnet_tag_prefix + field, v, commit=False)
-                    # add config file fields
-                    try:
-                        config_data_json = json.loads(config_data)
-                    except Exception:
-                        logging.error("Cannot parse bacnet_config json")
-                    else:
-                        for key in config_data_json.keys():
-                            value = config_data_json.get(key)
-                            field = key.lower()
+            # sync all the imported tags to Crate at once
+            with defer_crate_tag_sync():
+                for row in records:
+                    if 'Volttron Point Name' in row:
+                        topic = '/'.join([prefix, row['Volttron Point Name']])
+                        entity_id = utils.make_random_id(topic)
+                        name = row['Volttron Point Name']
+                        # create the topic if it does not exist in the Crate Database
+                        Topic.ensure_topic_exists(topic)
+                        # update or create the Data Point
+                        try:
+                            e = Entity.objects.get(topic=topic)
+                        except Entity.DoesNotExist:
+                            e = Entity(entity_id=entity_id, topic=topic)
+                            e.add_tag('id', entity_id, commit=False)
+                        e.add_tag('point', commit=False)
+                        e.add_tag('dis', name, commit=False)
+                        if site.kv_tags.get('id'):
+                            e.add_tag('siteRef', site.kv_tags.get('id'), commit=False)
+                        if row.get('Units'):
+                            e.add_tag('unit', row['Units'], commit=False)
+
+                        e.add_tag(Tag.bacnet_tag_prefix + 'prefix', prefix, commit=False)
+                        # add all bacnet tags
+                        for k, v in row.items():
+                            field = k.lower()
                             field = field.replace(' ', '_')
-                            if value:
-                                if key == 'driver_config':
-                                    for key1 in value.keys():
-                                        value1 = value.get(key1)
-                                        field = key1.lower()
-                                        field = field.replace(' ', '_')
-                                        e.add_tag(Tag.bacnet_tag_prefix + field, value1, commit=False)
-                                else:
-                                    if key == 'interval':
-                                        e.add_tag(field, value, commit=False)
+                            if field == 'point_name':
+                                field = 'reference_point_name'
+                            if v:
+                                e.add_tag(Tag.bacnet_tag_prefix + field, v, commit=False)
+                        # add config file fields
+                        try:
+                            config_data_json = json.loads(config_data)
+                        except Exception:
+                            logging.error("Cannot parse bacnet_config json")
+                        else:
+                            for key in config_data_json.keys():
+                                value = config_data_json.get(key)
+                                field = key.lower()
+                                field = field.replace(' ', '_')
+                                if value:
+                                    if key == 'driver_config':
+                                        for key1 in value.keys():
+                                            value1 = value.get(key1)
+                                            field = key1.lower()
+                                            field = field.replace(' ', '_')
+                                            e.add_tag(Tag.bacnet_tag_prefix + field, value1, commit=False)
                                     else:
-                                        e.add_tag(Tag.bacnet_tag_prefix + field, value, commit=False)
-
-                    logger.info('TopicImportForm: imported Data Point %s as %s with topic %s', entity_id, name, topic)
-                    e.save()
-                    import_count += 1
-                else:
-                    error_count += 1
-                    logger.error('TopicImportView cannot import row, no point name found, %s', row)
+                                        if key == 'interval':
+                                            e.add_tag(field, value, commit=False)
+                                        else:
+                                            e.add_tag(Tag.bacnet_tag_prefix + field, value, commit=False)
+
+                        logger.info('TopicImportForm: imported Data Point %s as %s with topic %s',
+                                    entity_id, name, topic)
+                        e.save()
+                        import_count += 1
+                    else:
+                        error_count += 1
+                        logger.error('TopicImportView cannot import row, no point name found, %s', row)
 
             import_success = 'Imported {} topics and Data Points with prefix {}'.format(import_count, prefix)
             if error_count:
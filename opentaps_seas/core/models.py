@@ -18,6 +18,9 @@
 import csv
 import logging
 import re
+import threading
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
 from datetime import time
 from datetime import timedelta
@@ -27,10 +30,12 @@ from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.fields import HStoreField
 from django.contrib.postgres.fields import JSONField
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import connections
 from django.db import models
 from django.db import OperationalError
+from django.db import transaction
 from django.db.models import AutoField
 from django.db.models import BooleanField
 from django.db.models import CharField
@@ -46,6 +51,7 @@ from django.db.models.signals import pre_delete
 from django.db.models.signals import pre_save
 from django.db.models import Q
 from django.db.utils import DatabaseError
+from django.dispatch import Signal
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils.timezone import now
@@ -485,6 +491,11 @@ def entity_deleted(sender, instance, using, **kwargs):
         delete_tags_from_crate_entity(instance)
 
 
+# sent by bulk_save_entities since bulk_create and bulk_update do not send post_save
+entities_bulk_saved = Signal(providing_args=['entities'])
+ENTITY_BULK_BATCH_SIZE = 500
+
+
 @receiver(post_save, sender=Entity, dispatch_uid='entity_post_save_signal')
 def entity_saved(sender, instance, using, **kwargs):
     # remove all associated resourcese: notes, files, links ...
@@ -539,6 +550,7 @@ class Topic(models.Model):
             VALUES (%s)""".format("topic")
             try:
                 c.execute(sql, [topic])
+                invalidate_crate_topics()
             except Exception:
                 # just make sure the topic exists
                 pass
@@ -565,6 +577,13 @@ class Topic(models.Model):
         cratedb = True
 
 
+@receiver(post_save, sender=Topic, dispatch_uid='topic_post_save_signal')
+def topic_saved(sender, instance, using, **kwargs):
+    # saving a new kv tag adds a column to the crate topic table
+    invalidate_crate_topic_tags(instance.kv_tags)
+    invalidate_crate_topics()
+
+
 class TimeZone(models.Model):
     time_zone = CharField(_("Time Zone"), max_length=255)
     tzoffset = IntegerField(default=0)
@@ -661,6 +680,52 @@ def ensure_crate_entity_table():
         c.execute(sql)
 
 
+CRATE_TOPIC_TAGS_CACHE_KEY = 'crate_topic_tags'
+
+
+def get_crate_topic_tags():
+    # the kv tags that exist as columns of the crate topic table, since filtering
+    # on an unknown tag would cause a DB error
+    tags = cache.get(CRATE_TOPIC_TAGS_CACHE_KEY)
+    if tags is None:
+        tags = set()
+        with connections['crate'].cursor() as c:
+            sql = """SELECT column_name from information_schema.columns
+                     WHERE table_name = 'topic' and column_name like 'kv_tags[%';"""
+            c.execute(sql)
+            for (cn, ) in c:
+                # extract the tag name from "kv_tags['tag_name']"
+                tags.add(cn[9:-2])
+        cache.set(CRATE_TOPIC_TAGS_CACHE_KEY, tags, settings.CRATE_TOPIC_TAGS_TTL)
+    return tags
+
+
+# version of the crate topics and their tags, the cached topic counts and pages
+# are keyed by it so they are dropped as soon as the tags are synced
+CRATE_TOPICS_VERSION_KEY = 'crate_topics_version'
+
+
+def get_crate_topics_version():
+    version = cache.get(CRATE_TOPICS_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(CRATE_TOPICS_VERSION_KEY, version, None)
+    return version
+
+
+def invalidate_crate_topics():
+    cache.set(CRATE_TOPICS_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def invalidate_crate_topic_tags(kv_tags=None):
+    # when given the kv_tags just written, only invalidate if one of them is new
+    if kv_tags:
+        tags = cache.get(CRATE_TOPIC_TAGS_CACHE_KEY)
+        if tags is not None and all(k in tags for k in kv_tags.keys()):
+            return
+    cache.delete(CRATE_TOPIC_TAGS_CACHE_KEY)
+
+
 def kv_tags_update_crate_entity_string(kv_tags, params_list):
     res = '{'
     first = True
@@ -688,11 +753,19 @@ def delete_tags_from_crate_entity(row):
             except Exception:
                 # ignore if the entity did not exist
                 pass
+            else:
+                invalidate_crate_topics()
     except OperationalError:
         logging.warning('Crate database unavailable')
 
 
-def sync_tags_to_crate_entity(row, retried=False):
+CRATE_TAG_SYNC_BATCH_SIZE = 500
+
+# state of defer_crate_tag_sync for the current thread
+_deferred_tag_sync = threading.local()
+
+
+def get_crate_entity_tags(row):
     # we sync points, sites and equipment
     topic = row.topic
     if not topic:
@@ -701,43 +774,116 @@ def sync_tags_to_crate_entity(row, retried=False):
                 topic = row.kv_tags['id']
     if not topic:
         logger.info('sync_tags_to_crate_entity topic or id is empty: %s', row)
-        return
-
+        return None
+    # copy the tags since the row may still be modified when the sync is deferred
+    m_tags = list(row.m_tags) if row.m_tags else None
+    kv_tags = dict(row.kv_tags) if row.kv_tags else None
+    return (topic, m_tags, kv_tags)
+
+
+def sync_tags_to_crate_entities(rows):
+    entities = {}
+    for row in rows:
+        t = get_crate_entity_tags(row)
+        if t:
+            entities[t[0]] = t
+    if getattr(_deferred_tag_sync, 'depth', 0):
+        _deferred_tag_sync.entities.update(entities)
+        return len(entities)
+    return upsert_crate_entity_tags(list(entities.values()))
+
+
+def upsert_crate_entity_tags(entities, retried=False):
+    # upsert the (topic, m_tags, kv_tags) in batches of one statement each,
+    # existing tags are kept when a row has no m_tags or no kv_tags
+    count = 0
     try:
         with connections['crate'].cursor() as c:
-            # make sure the topic is in CrateDB
-            sql = """INSERT INTO {0} (topic)
-            VALUES (%s)""".format("topic")
-            try:
-                c.execute(sql, [topic])
-            except DatabaseError as e:
-                # could be the table is missing
-                if 'RelationUnknown' in str(e):
-                    if not retried:
+            for i in range(0, len(entities), CRATE_TAG_SYNC_BATCH_SIZE):
+                batch = entities[i:i + CRATE_TAG_SYNC_BATCH_SIZE]
+                params_list = []
+                values = []
+                new_kv_tags = {}
+                for (topic, m_tags, kv_tags) in batch:
+                    params_list.append(topic)
+                    params_list.append(m_tags)
+                    if kv_tags:
+                        values.append('(%s, %s, {})'.format(kv_tags_update_crate_entity_string(kv_tags, params_list)))
+                        new_kv_tags.update(kv_tags)
+                    else:
+                        values.append('(%s, %s, NULL)')
+                sql = """INSERT INTO {0} (topic, m_tags, kv_tags)
+                VALUES {1}
+                ON CONFLICT (topic) DO UPDATE SET
+                    m_tags = COALESCE(excluded.m_tags, m_tags),
+                    kv_tags = COALESCE(excluded.kv_tags, kv_tags)""".format("topic", ', '.join(values))
+                logger.info('upsert_crate_entity_tags: %s topics', len(batch))
+                try:
+                    c.execute(sql, params_list)
+                except DatabaseError as e:
+                    # could be the table is missing
+                    if 'RelationUnknown' in str(e) and not retried:
                         ensure_crate_entity_table()
                         # try again
-                        return sync_tags_to_crate_entity(row, retried=True)
-            except Exception:
-                # just make sure the topic exists
-                pass
-
-            if row.m_tags or row.kv_tags:
-                params_list = []
-                sql = """ UPDATE "topic" SET """
-                if row.kv_tags:
-                    sql += " kv_tags = {} ".format(kv_tags_update_crate_entity_string(row.kv_tags, params_list))
-                if row.m_tags:
-                    if row.kv_tags:
-                        sql += ", "
-                    sql += " m_tags = %s "
-                    params_list.append(row.m_tags)
-                sql += """ WHERE topic = %s;"""
-                params_list.append(topic)
-                logger.info('sync_tags_to_crate_entity SQL: %s', sql)
-                logger.info('sync_tags_to_crate_entity Params: %s', params_list)
-                c.execute(sql, params_list)
+                        return count + upsert_crate_entity_tags(entities[i:], retried=True)
+                    raise
+                count += len(batch)
+                if new_kv_tags:
+                    invalidate_crate_topic_tags(new_kv_tags)
+        if count:
+            invalidate_crate_topics()
     except OperationalError:
         logging.warning('Crate database unavailable')
+    return count
+
+
+def sync_tags_to_crate_entity(row):
+    t = get_crate_entity_tags(row)
+    if not t:
+        return
+    if getattr(_deferred_tag_sync, 'depth', 0):
+        _deferred_tag_sync.entities[t[0]] = t
+    else:
+        upsert_crate_entity_tags([t])
+
+
+@contextmanager
+def defer_crate_tag_sync():
+    # collect the tag syncs triggered by saving entities in the block and run them
+    # as one bulk sync on exit, for example:
+    #   with defer_crate_tag_sync():
+    #       for e in entities:
+    #           e.save()
+    # the entities saved before an error in the block are still synced, as they would have been
+    # by post_save without the deferral
+    depth = getattr(_deferred_tag_sync, 'depth', 0)
+    if not depth:
+        _deferred_tag_sync.entities = {}
+    _deferred_tag_sync.depth = depth + 1
+    try:
+        yield
+    finally:
+        _deferred_tag_sync.depth = depth
+        if not depth:
+            entities = list(_deferred_tag_sync.entities.values())
+            _deferred_tag_sync.entities = {}
+            upsert_crate_entity_tags(entities)
+
+
+def bulk_save_entities(created=[], updated=[]):
+    # insert and update the entities tags in batches, since this does not send post_save
+    # the Crate tags are synced at once and entities_bulk_saved is sent instead
+    with transaction.atomic():
+        if created:
+            Entity.objects.bulk_create(created, batch_size=ENTITY_BULK_BATCH_SIZE)
+        if updated:
+            Entity.objects.bulk_update(updated, ['kv_tags', 'm_tags'], batch_size=ENTITY_BULK_BATCH_SIZE)
+    entities = list(created) + list(updated)
+    if entities:
+        logger.info('bulk_save_entities: created %s updated %s', len(created), len(updated))
+        if settings.CRATE_TAG_AUTOSYNC:
+            sync_tags_to_crate_entities(entities)
+        entities_bulk_saved.send(sender=Entity, entities=entities)
 
 
 class Status(models.Model):
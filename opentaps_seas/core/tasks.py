@@ -15,6 +15,7 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import csv
 import logging
 import requests
 import tempfile
@@ -22,12 +23,16 @@ import time
 import solaredge
 from celery import shared_task
 from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.urls import reverse
 from easy_thumbnails.files import get_thumbnailer
 from filer.models import Image as FilerFile
 from ..core.models import Meter
 from ..core.models import SolarEdgeSetting
+from ..core.models import TopicTagRuleSet
 from ..core.celery import ProgressRecorder
+from io import StringIO
 from . import utils
 
 logger = logging.getLogger(__name__)
@@ -52,6 +57,20 @@ def test_task(self, kwargs):
         }
 
 
+@shared_task
+def refresh_last_values_task():
+    return {
+        'result': utils.refresh_last_values()
+        }
+
+
+@shared_task
+def refresh_rollups_task():
+    return {
+        'result': utils.refresh_rollups()
+        }
+
+
 @shared_task(bind=True)
 def fetch_solaredge_for_equipment_task(self, kwargs):
     entity_id = kwargs.get('entity_id')
@@ -140,3 +159,60 @@ def fetch_solaredge_for_equipment(kwargs):
                 logger.exception(e)
                 raise e
     return ses
+
+
+@shared_task(bind=True)
+def run_topic_tag_ruleset_task(self, kwargs):
+    ruleset_id = kwargs.get('ruleset_id')
+    obs = ProgressRecorder(
+        self,
+        name="Running the Topic Tag Rule Set",
+        success_label='View Rule Set',
+        back_url=reverse("core:topictagruleset_list"))
+    kwargs['progress_observer'] = obs
+    result = run_topic_tag_ruleset(kwargs)
+
+    obs.extra.update({
+        'success_url': reverse("core:topictagruleset_detail", kwargs={'id': ruleset_id}),
+        'report_url': result.get('report_url'),
+        'summary': 'Updated {} Topics and created {} Equipments.'.format(
+            result['updated'], result['new_equipments'])
+        })
+    return {
+        'result': result,
+        'extra': obs.extra
+        }
+
+
+def run_topic_tag_ruleset(kwargs):
+    # this runs outside of a request transaction, so the tags are committed
+    # as each chunk of topics gets updated
+    progress_observer = kwargs.pop('progress_observer', None)
+    ruleset_id = kwargs.get('ruleset_id')
+    topic_filter = kwargs.get('topic_filter')
+
+    rule_set = TopicTagRuleSet.objects.get(id=ruleset_id)
+    updated_set, updated_entities, updated_tags, removed_tags, new_equipments = utils.run_topic_tag_ruleset(
+        rule_set, topic_filter=topic_filter, progress_observer=progress_observer)
+
+    result = {
+        'updated': len(updated_set),
+        'new_equipments': len(new_equipments),
+        'report_url': None
+        }
+    # store the report of the changes where it can be downloaded from the progress page
+    report_rows, report_header = utils.tag_rulesets_run_report_diff(updated_entities, updated_tags, removed_tags)
+    if report_rows:
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerow(report_header)
+        for row in report_rows:
+            writer.writerow(row)
+        try:
+            name = default_storage.save('reports/TagRulesetRun_{}.csv'.format(ruleset_id),
+                                        ContentFile(output.getvalue().encode('utf-8')))
+            result['report_url'] = default_storage.url(name)
+        except Exception as e:
+            # the rule set was still applied
+            logger.error('Could not save the rule set run report: %s', e)
+    return result
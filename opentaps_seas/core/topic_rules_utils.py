@@ -0,0 +1,257 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import re
+from .models import Entity
+from .models import EquipmentView
+from .models import Topic
+from .models import get_crate_topic_tags
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+# Evaluates the topic tag rules in memory for the rule previews: the topics and their
+# tags are loaded once, the rule filters are compiled into predicates and every rule
+# is applied in turn to the in memory tags, so a rule sees the changes of the previous
+# ones as it would when the rules are actually run.
+# The filters work like apply_filters_to_queryset but on the data point tags which
+# are the tags synced to the Crate topics.
+
+
+def _match_all(topic, kv_tags, m_tags):
+    return True
+
+
+def compile_filter(filter_field, filter_type, filter_value, valid_tags=None):
+    # returns a predicate of (topic, kv_tags, m_tags)
+    # valid_tags are the tags that are Crate topic columns, like in filter_to_Q a filter
+    # on any other tag only restricts the topics for the present, contains and equal types
+    if not filter_field or filter_field == 'undefined' or filter_field == 'Topic':
+        name = 'topic'
+    else:
+        name = filter_field
+    unknown_tag = valid_tags is not None and name != 'topic' and name not in valid_tags
+
+    def value_of(topic, kv_tags):
+        if name == 'topic':
+            return topic
+        return kv_tags.get(name)
+
+    def present(topic, kv_tags, m_tags):
+        return value_of(topic, kv_tags) is not None or name in m_tags
+
+    if filter_type == 'present':
+        return present
+    if filter_type == 'absent':
+        return lambda topic, kv_tags, m_tags: not present(topic, kv_tags, m_tags)
+    if not filter_type or not filter_value:
+        return _match_all
+
+    # text comparisons are case insensitive
+    upper_value = filter_value.upper()
+
+    def contains(topic, kv_tags, m_tags):
+        value = value_of(topic, kv_tags)
+        return value is not None and upper_value in value.upper()
+
+    def exact(topic, kv_tags, m_tags):
+        value = value_of(topic, kv_tags)
+        return value is not None and upper_value == value.upper()
+
+    if filter_type == 'c':
+        return contains
+    if filter_type == 'nc':
+        return lambda topic, kv_tags, m_tags: not contains(topic, kv_tags, m_tags)
+    if filter_type == 'eq':
+        return exact
+    if filter_type == 'neq':
+        return lambda topic, kv_tags, m_tags: not exact(topic, kv_tags, m_tags)
+    if unknown_tag and filter_type in ('matches', 'gt', 'gte', 'lt', 'lte'):
+        return _match_all
+    if filter_type == 'matches':
+        # Crate regular expressions must match the whole value
+        regex = re.compile(filter_value, re.IGNORECASE)
+
+        def matches(topic, kv_tags, m_tags):
+            value = value_of(topic, kv_tags)
+            return value is not None and regex.fullmatch(value) is not None
+        return matches
+
+    compare = {
+        'gt': lambda a, b: a > b,
+        'gte': lambda a, b: a >= b,
+        'lt': lambda a, b: a < b,
+        'lte': lambda a, b: a <= b,
+    }.get(filter_type)
+    if compare:
+        def cmp(topic, kv_tags, m_tags):
+            value = value_of(topic, kv_tags)
+            return value is not None and compare(value, filter_value)
+        return cmp
+
+    return _match_all
+
+
+def compile_filters(filters, valid_tags=None):
+    # returns a predicate of (topic, kv_tags, m_tags) for the rule filters, the
+    # ORs are grouped then each group is ANDed as in apply_filters_to_queryset:
+    # A or B and C or D -> (A or B) and (C or D)
+    groups = []
+    for qfilter in filters or []:
+        filter_op = qfilter.get('o') or qfilter.get('op')
+        filter_type = qfilter.get('t') or qfilter.get('type')
+        filter_field = qfilter.get('n') or qfilter.get('field')
+        if not filter_type:
+            continue
+        filter_value = qfilter.get('f') or qfilter.get('value')
+        predicate = compile_filter(filter_field, filter_type, filter_value, valid_tags=valid_tags)
+        if groups and filter_op and filter_op.lower() == 'or':
+            groups[-1].append(predicate)
+        else:
+            groups.append([predicate])
+
+    def match(topic, kv_tags, m_tags):
+        for group in groups:
+            if not any(p(topic, kv_tags, m_tags) for p in group):
+                return False
+        return True
+    return match
+
+
+class TopicTagsState(object):
+    # the topics with the current tags of their data point
+
+    def __init__(self):
+        self.topics = [topic for chunk in utils.iter_topic_chunks(Topic.objects.all()) for topic in chunk]
+        self.entities = {}
+        self.original = {}
+        # all the tags of the data points, as in get_topics_tags_report_header
+        self.tags = set()
+        # the tags that are Crate topic columns, a tag set by a rule becomes one
+        self.valid_tags = set(get_crate_topic_tags())
+        qs = Entity.objects.filter(topic__isnull=False).order_by('entity_id')
+        for (entity_id, topic, kv_tags, m_tags) in qs.values_list('entity_id', 'topic', 'kv_tags', 'm_tags').iterator():
+            self.tags.update(kv_tags or {})
+            self.tags.update(m_tags or [])
+            # like tag_topics, only the first data point of a topic is tagged
+            if topic not in self.entities:
+                self.original[topic] = (dict(kv_tags or {}), list(m_tags or []))
+                self.entities[topic] = {'topic': topic, 'kv_tags': dict(kv_tags or {}), 'm_tags': list(m_tags or [])}
+        self.equips_sites = None
+
+    def get_entity(self, topic):
+        # the topics without a data point get a new one
+        entity = self.entities.get(topic)
+        if not entity:
+            entity_id = utils.make_random_id(topic)
+            entity = {'topic': topic, 'kv_tags': {'id': entity_id}, 'm_tags': []}
+            self.original[topic] = ({}, [])
+            self.entities[topic] = entity
+        return entity
+
+    def get_equipment_site(self, equip_ref):
+        if self.equips_sites is None:
+            self.equips_sites = dict(EquipmentView.objects.values_list('object_id', 'site_id'))
+        # let it fail if the equipment does not exist
+        if equip_ref not in self.equips_sites:
+            raise EquipmentView.DoesNotExist('Equipment {} does not exist'.format(equip_ref))
+        return self.equips_sites[equip_ref]
+
+    def original_value(self, topic, tag):
+        kv_tags, m_tags = self.original.get(topic, ({}, []))
+        if tag in m_tags:
+            return 'type:MARKER'
+        return kv_tags.get(tag) or None
+
+    def match(self, predicate):
+        empty = {}
+        for topic in self.topics:
+            entity = self.entities.get(topic)
+            if entity:
+                if predicate(topic, entity['kv_tags'], entity['m_tags']):
+                    yield topic
+            elif predicate(topic, empty, []):
+                yield topic
+
+
+def preview_topic_tag_rules(rules, topic_filter=None, state=None):
+    # evaluate the rules without saving anything, returns
+    # (updated topics, updated entities, updated tags, removed tags, new equipments)
+    # where the updated and removed tags are the changes from the current tags
+    if state is None:
+        state = TopicTagsState()
+    updated_set = set()
+    updated_entities = {}
+    updated_tags = {}
+    removed_tags = {}
+    for rule in rules:
+        if not rule.tags:
+            continue
+        rule_filters = list(rule.filters or [])
+        if topic_filter:
+            rule_filters.append({'type': 'c', 'value': topic_filter})
+        predicate = compile_filters(rule_filters, valid_tags=state.valid_tags)
+        topics = list(state.match(predicate))
+        logger.info('preview_topic_tag_rules: rule %s matched %s topics', rule, len(topics))
+        for topic in topics:
+            entity = state.get_entity(topic)
+            kv_tags = entity['kv_tags']
+            m_tags = entity['m_tags']
+            if not kv_tags.get('dis'):
+                kv_tags['dis'] = topic
+            for tag in rule.tags:
+                tag_tag = tag.get('tag')
+                if tag.get('remove') is True or tag.get('remove') == 'True':
+                    if tag_tag in m_tags or kv_tags.get(tag_tag):
+                        updated_tags.get(topic, {}).pop(tag_tag, None)
+                        previous = state.original_value(topic, tag_tag)
+                        if previous:
+                            removed_tags.setdefault(topic, {})[tag_tag] = previous
+                    kv_tags.pop(tag_tag, None)
+                    if tag_tag in m_tags:
+                        m_tags.remove(tag_tag)
+                else:
+                    value = tag.get('value')
+                    updated_tags.setdefault(topic, {})[tag_tag] = {
+                        'new': value or 'type:MARKER',
+                        'previous': state.original_value(topic, tag_tag)
+                    }
+                    removed_tags.get(topic, {}).pop(tag_tag, None)
+                    if value:
+                        kv_tags[tag_tag] = value
+                        state.valid_tags.add(tag_tag)
+                    elif tag_tag not in m_tags:
+                        m_tags.append(tag_tag)
+            # if tagged with an equipRef make sure the siteRef also matches
+            equip_ref = kv_tags.get('equipRef')
+            if equip_ref:
+                site_id = state.get_equipment_site(equip_ref)
+                if site_id:
+                    kv_tags['siteRef'] = site_id
+            updated_set.add(topic)
+            updated_entities[topic] = entity
+
+    for topics_tags in (updated_tags, removed_tags):
+        for topic in [t for t, tags in topics_tags.items() if not tags]:
+            del topics_tags[topic]
+    return updated_set, updated_entities, updated_tags, removed_tags, []
+
+
+def preview_topic_tag_ruleset(rule_set, topic_filter=None, state=None):
+    return preview_topic_tag_rules(rule_set.topictagrule_set.order_by('id'), topic_filter=topic_filter, state=state)
@@ -374,6 +374,7 @@ urlpatterns = [
         name="site_equipment_point_detail",
     ),
     path("point/csv/<path:point>", view=point.point_data_csv, name="point_data_csv"),
+    path("points/json", view=point.points_data_json, name="points_data_json"),
     path("point/json/<path:point>", view=point.point_data_json, name="point_data_json"),
     path("point/<path:entity_id>", view=point.point_detail_view, name="point_detail"),
     path(
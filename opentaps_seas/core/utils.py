@@ -21,12 +21,18 @@ import geocoder
 import hashlib
 import json
 import numpy
+import pandas
 import pytz
 import requests
 import re
+from math import ceil
 from math import isnan
 from .models import Entity
 from .models import EquipmentView
+from .models import bulk_save_entities
+from .models import defer_crate_tag_sync
+from .models import get_crate_topic_tags
+from .models import get_crate_topics_version
 from .models import PointView
 from .models import Tag
 from .models import TimeZone
@@ -48,15 +54,27 @@ from pytz import timezone as pytz_timezone
 from dateutil.parser import parse as parse_datetime
 from django.db import connections
 from django.db import OperationalError
+from django.db.utils import DatabaseError
 from django.db.models import Q
 from django.urls import reverse
+from django.utils.http import urlencode
 from django.utils.html import format_html
 from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import EmptyPage
+from django.core.paginator import PageNotAnInteger
+from django.core.paginator import Paginator
 from django.utils.crypto import get_random_string
 from django.utils.text import slugify
 
 logger = logging.getLogger(__name__)
 
+# number of topics tagged at once by tag_topics
+TAG_TOPICS_CHUNK_SIZE = 1000
+# cache key prefixes of the filtered topic list counts and page boundaries
+TOPIC_COUNT_KEY_PREFIX = 'topic_count:'
+TOPIC_PAGES_KEY_PREFIX = 'topic_pages:'
+
 
 def check_boto_config():
     if not settings.AWS_ACCESS_KEY_ID or not settings.AWS_SECRET_ACCESS_KEY or not settings.AWS_STORAGE_BUCKET_NAME:
@@ -97,18 +115,17 @@ def format_epoch(ts):
     return {'epoch': ts, 'fmttime': fmttime, 'time': time}
 
 
-def get_current_value_dict(point):
-    result = None
-    with connections['crate'].cursor() as c:
-        sql = """SELECT ts, string_value FROM "data" WHERE topic = %s ORDER BY ts DESC LIMIT 1;"""
-        c.execute(sql, [point.topic])
-        for record in c:
-            result = record
+# maximum number of topics queried at once by get_current_values
+CURRENT_VALUES_BATCH_SIZE = 500
+# the last value cache stores topic -> (ts, string_value) see get_last_value_rows
+LAST_VALUE_CACHE_PREFIX = 'crate_last_value:'
+LAST_VALUE_WATERMARK_KEY = 'crate_last_value_watermark'
+LAST_VALUE_WATERMARK_OVERLAP = 60
+# cached for the topics without any data, so they are not queried again until it expires
+LAST_VALUE_MISSING = 'missing'
 
-    if not result:
-        return None
-    ts = result[0]
-    string_value = result[1]
+
+def format_current_value_dict(point, ts, string_value):
     epoch = int(ts.timestamp() * 1000)
     t = format_epoch(epoch)
     time = t['time']
@@ -126,21 +143,116 @@ def get_current_value_dict(point):
         if point.unit:
             return {'value': string_value, 'epoch': epoch, 'fmttime': fmttime, 'time': time, 'unit': point.unit}
         else:
-            if point.kind == 'Number' and (point.unit == '°F' or point.unit == '°C'):
-                try:
-                    v = float(string_value)
-                    # use 1 after the dot for temperatures
-                    string_value = format(v, '.1f')
-                except Exception:
-                    pass
-            if point.unit:
-                return {'value': string_value, 'epoch': epoch, 'fmttime': fmttime, 'time': time, 'unit': point.unit}
-            else:
-                return {'value': string_value, 'epoch': epoch, 'fmttime': fmttime, 'time': time}
+            return {'value': string_value, 'epoch': epoch, 'fmttime': fmttime, 'time': time}
 
 
-def get_current_value(point, raw=False):
-    d = get_current_value_dict(point)
+def get_current_values(points):
+    # returns a dict of topic -> current value dict (as in get_current_value_dict)
+    # the latest values for all the given points are read from the last value cache
+    # or fetched in one query per batch of topics, topics without any data are not in the result
+    points_by_topic = {}
+    for point in points:
+        if point.topic:
+            points_by_topic.setdefault(point.topic, []).append(point)
+    results = {}
+    if not points_by_topic:
+        return results
+
+    for topic, (ts, string_value) in get_last_value_rows(list(points_by_topic.keys())).items():
+        # the point is only used for formatting, so any point on that topic will do
+        point = points_by_topic[topic][0]
+        results[topic] = format_current_value_dict(point, ts, string_value)
+    return results
+
+
+def _last_value_cache_key(topic):
+    # topics can have spaces and be long, which the cache backends do not like
+    return LAST_VALUE_CACHE_PREFIX + hashlib.md5(topic.encode('utf-8')).hexdigest()
+
+
+def query_last_value_rows(topics=None, since=None):
+    # returns a dict of topic -> (ts, string_value) of the latest data row of each topic
+    # either for the given topics, or for all the topics with data more recent than since
+    conditions = []
+    if since:
+        conditions.append('ts > %s')
+    if topics is not None:
+        conditions.append('topic = ANY(%s)')
+    sql = """SELECT d.topic, d.ts, d.string_value FROM "data" d
+             INNER JOIN (SELECT topic, MAX(ts) AS max_ts FROM "data" WHERE {0} GROUP BY topic) m
+             ON d.topic = m.topic AND d.ts = m.max_ts
+             WHERE {1};""".format(' AND '.join(conditions) or 'TRUE',
+                                  ' AND '.join(['d.' + cond for cond in conditions]) or 'TRUE')
+
+    if topics is None:
+        batches = [None]
+    else:
+        batches = [topics[i:i + CURRENT_VALUES_BATCH_SIZE] for i in range(0, len(topics), CURRENT_VALUES_BATCH_SIZE)]
+    rows = {}
+    with connections['crate'].cursor() as c:
+        for batch in batches:
+            params = []
+            if since:
+                params.append(since)
+            if batch is not None:
+                params.append(batch)
+            # the same conditions apply to the inner and outer queries
+            c.execute(sql, params + params)
+            for (topic, ts, string_value) in c.fetchall():
+                rows[topic] = (ts, string_value)
+    return rows
+
+
+def get_last_value_rows(topics):
+    # returns a dict of topic -> (ts, string_value), reading from the last value cache
+    # and only querying Crate for the topics missing or expired from it
+    ttl = settings.CRATE_LAST_VALUE_TTL
+    rows = {}
+    cached = set()
+    if ttl:
+        keys = {_last_value_cache_key(topic): topic for topic in topics}
+        for key, row in cache.get_many(keys.keys()).items():
+            cached.add(keys[key])
+            if row != LAST_VALUE_MISSING:
+                rows[keys[key]] = row
+    missing = [topic for topic in topics if topic not in cached]
+    if missing:
+        logger.info('get_last_value_rows: querying %s of %s topics', len(missing), len(topics))
+        fetched = query_last_value_rows(topics=missing)
+        if ttl:
+            values = {_last_value_cache_key(topic): LAST_VALUE_MISSING for topic in missing}
+            values.update({_last_value_cache_key(topic): row for topic, row in fetched.items()})
+            cache.set_many(values, ttl)
+        rows.update(fetched)
+    return rows
+
+
+def refresh_last_values():
+    # update the last value cache for all the topics which received data since the previous refresh,
+    # this is meant to run periodically (see tasks.refresh_last_values_task) and since that runs
+    # in the Celery worker it only helps when the cache is shared with the web processes (eg: Redis),
+    # with a per process cache like LocMem the values are only refreshed as they expire
+    ttl = settings.CRATE_LAST_VALUE_TTL
+    if not ttl:
+        return 0
+    since = cache.get(LAST_VALUE_WATERMARK_KEY)
+    if not since:
+        since = datetime.utcnow() - timedelta(seconds=ttl)
+    rows = query_last_value_rows(since=since)
+    if rows:
+        cache.set_many({_last_value_cache_key(topic): row for topic, row in rows.items()}, ttl)
+        watermark = max([ts for (ts, string_value) in rows.values()])
+        # since the historian may insert late, keep an overlap with the previous refresh
+        cache.set(LAST_VALUE_WATERMARK_KEY, watermark - timedelta(seconds=LAST_VALUE_WATERMARK_OVERLAP), None)
+    logger.info('refresh_last_values: since %s refreshed %s topics', since, len(rows))
+    return len(rows)
+
+
+def get_current_value_dict(point):
+    return get_current_values([point]).get(point.topic)
+
+
+def format_current_value(point, d, raw=False):
     if not d:
         return None
 
@@ -162,14 +274,19 @@ def get_current_value(point, raw=False):
                                (value, d['time'], d['fmttime']), )
 
 
+def get_current_value(point, raw=False):
+    return format_current_value(point, get_current_value_dict(point), raw=raw)
+
+
 def add_current_values(data, raw=False):
     d2 = list(data)
+    values = {}
+    try:
+        values = get_current_values(d2)
+    except OperationalError:
+        logging.warning('Crate database unavailable')
     for d in d2:
-        cv = None
-        try:
-            cv = get_current_value(d, raw=raw)
-        except OperationalError:
-            logging.warning('Crate database unavailable')
+        cv = format_current_value(d, values.get(d.topic), raw=raw)
         if not cv:
             if raw:
                 cv = {}
@@ -222,12 +339,48 @@ def get_ahu_current_values(equipment_id):
                 p = pl
             p = p[0]
             logger.warning('get_ahu_current_values using point: %s', p)
-            results[n] = add_current_values([p], raw=True)[0]
+            results[n] = p
+    # fetch all the current values at once
+    add_current_values(results.values(), raw=True)
     return results
 
 
 DEFAULT_RANGE = '24h'
 DEFAULT_RES = 'minute'
+# number of rows fetched at once from Crate when reading point values
+POINT_VALUES_FETCH_SIZE = 1000
+# charts do not need more points than this, longer series get downsampled
+DEFAULT_MAX_POINTS = 2000
+DOWNSAMPLE_LTTB = 'lttb'
+DOWNSAMPLE_MINMAX = 'minmax'
+DEFAULT_DOWNSAMPLE = DOWNSAMPLE_LTTB
+# for LTTB, Crate aggregates into that many times more buckets than the points returned
+LTTB_OVERSAMPLING = 4
+# rollup tables of pre aggregated Number values per resolution, see refresh_rollup
+ROLLUPS = {
+    'hour': 'data_hourly',
+    'day': 'data_daily'
+}
+ROLLUP_WATERMARK_KEY = 'crate_rollup_watermark:'
+# Crate tables of the rollup watermarks and of the topics to re-aggregate, see mark_rollups_dirty
+ROLLUP_STATE_TABLE = 'rollup_state'
+ROLLUP_DIRTY_TABLE = 'rollup_dirty'
+# aggregation function -> rollup table column
+ROLLUP_VALUE_FUNCS = {
+    'avg': 'avg_value',
+    'min': 'min_value',
+    'max': 'max_value',
+    'count': 'count_value'
+}
+DATE_TRUNC_SECONDS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+    'week': 604800,
+    'month': 2592000,
+    'year': 31536000
+}
 
 
 def get_start_date_from_range(trange, from_datetime=None):
@@ -267,7 +420,9 @@ def get_start_date_from_range(trange, from_datetime=None):
     return start, end
 
 
-def get_point_values(d, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT_RANGE, ts_as_datetime=False):
+def plan_point_values(d, date_trunc=DEFAULT_RES, trange=DEFAULT_RANGE, max_points=None):
+    # returns how to query the values of a point: (start, end, date_trunc, limit, downsampled)
+    # when downsampled is True the values must be read with get_downsampled_point_values
     # validate the date_trunc
     if date_trunc not in ['day', 'hour', 'minute', 'second']:
         date_trunc = DEFAULT_RES
@@ -279,26 +434,95 @@ def get_point_values(d, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT
 
     logger.info("Getting data points for range %s -- %s", start, end)
 
-    if is_number:
-        sql = """SELECT DATE_TRUNC('{}', ts) as timest, {}(double_value) FROM "data"
-                 WHERE topic = %s AND ts > %s AND ts <= %s
-                 GROUP BY timest ORDER BY timest DESC;""".format(date_trunc, value_func)
-    elif is_bool:
-        # use MIN as function since we query string_value
-        sql = """SELECT DATE_TRUNC('{}', ts) as timest, MIN(string_value), {}(double_value) FROM "data"
-                 WHERE topic = %s AND ts > %s AND ts <= %s
-                 GROUP BY timest ORDER BY timest DESC;""".format(date_trunc, value_func)
+    limit = None
+    if max_points:
+        range_seconds = (end - start).total_seconds()
+        if range_seconds / DATE_TRUNC_SECONDS[date_trunc] > max_points:
+            if is_number:
+                return start, end, date_trunc, limit, True
+            elif is_bool:
+                date_trunc = fit_date_trunc(start, end, max_points)
+            else:
+                # values cannot be aggregated, only keep the most recent ones
+                limit = max_points
+    return start, end, date_trunc, limit, False
+
+
+def get_point_values(d, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT_RANGE, ts_as_datetime=False,
+                     max_points=None, downsample=DEFAULT_DOWNSAMPLE):
+    start, end, date_trunc, limit, downsampled = plan_point_values(d, date_trunc=date_trunc, trange=trange,
+                                                                   max_points=max_points)
+    if downsampled:
+        return get_downsampled_point_values(d, start, end, max_points, downsample=downsample,
+                                            value_func=value_func, ts_as_datetime=ts_as_datetime)
+
+    return list(iter_point_values(d, start, end, date_trunc=date_trunc, value_func=value_func,
+                                  ts_as_datetime=ts_as_datetime, limit=limit))
+
+
+def get_point_series(d, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT_RANGE,
+                     max_points=None, downsample=DEFAULT_DOWNSAMPLE):
+    # same as get_point_values but returns a pandas Series indexed by UTC timestamps,
+    # the rows are fetched in batches and converted with numpy instead of one by one
+    start, end, date_trunc, limit, downsampled = plan_point_values(d, date_trunc=date_trunc, trange=trange,
+                                                                   max_points=max_points)
+    if downsampled:
+        values = get_downsampled_point_values(d, start, end, max_points, downsample=downsample,
+                                              value_func=value_func)
+        ts = numpy.array([v[0] for v in values], dtype='int64')
+        return pandas.Series([v[1] for v in values], index=pandas.to_datetime(ts, unit='ms', utc=True),
+                             name=d.entity_id, dtype='float64')
+
+    is_number = 'Number' == d.kind
+    is_bool = 'Bool' == d.kind
+    queries, rollup = get_point_values_queries(d, start, end, date_trunc=date_trunc, value_func=value_func,
+                                               limit=limit)
+    ts_chunks = []
+    value_chunks = []
+    for results in fetch_point_values_batches(queries):
+        columns = list(zip(*results))
+        if is_bool:
+            string_values = numpy.array(columns[1], dtype=object)
+            double_values = numpy.array(columns[2], dtype='float64')
+            # same as get_point_values: any non empty string other than '0' is True
+            is_true = (string_values != None) & (string_values != '') & (string_values != '0')  # NOQA
+            value_chunks.append(numpy.where(is_true, 1.0, numpy.round(double_values)))
+        elif is_number:
+            value_chunks.append(numpy.array(columns[1], dtype='float64'))
+        else:
+            value_chunks.append(numpy.array(columns[1], dtype=object))
+        ts_chunks.append(numpy.array(columns[0], dtype='int64' if is_number or is_bool else object))
+
+    if ts_chunks:
+        ts = numpy.concatenate(ts_chunks)
+        values = numpy.concatenate(value_chunks)
     else:
-        sql = """SELECT ts, string_value FROM "data"
-                 WHERE topic = %s AND ts > %s AND ts <= %s ORDER BY ts DESC;"""
+        ts = numpy.array([], dtype='int64')
+        values = numpy.array([], dtype='float64' if is_number or is_bool else object)
+    logger.info("Got %s data points for %s%s", len(ts), d.entity_id, ' using rollup' if rollup else '')
 
-    data = []
-    with connections['crate'].cursor() as cursor:
-        cursor.execute(sql, [d.topic, start, end])
-        while True:
-            result = cursor.fetchone()
-            if result is None:
-                break
+    return pandas.Series(values, index=ts_to_datetime_index(ts), name=d.entity_id)
+
+
+def ts_to_datetime_index(ts):
+    # the UTC DatetimeIndex of a numpy array of timestamps read from Crate, those are epoch
+    # milliseconds when aggregated or cast and can be either ints or datetimes for the raw rows
+    if ts.dtype == object and len(ts) and all(isinstance(t, (int, numpy.integer)) for t in ts):
+        ts = ts.astype('int64')
+    if ts.dtype == object:
+        return pandas.to_datetime(ts, utc=True)
+    return pandas.to_datetime(ts, unit='ms', utc=True)
+
+
+def iter_point_values(d, start, end, date_trunc=DEFAULT_RES, value_func='avg', ts_as_datetime=False, limit=None):
+    # yields the [ts, value] of the point between start and end in ascending order
+    # rows are fetched in batches so only one batch is held in memory at a time
+    is_bool = 'Bool' == d.kind
+    queries, rollup = get_point_values_queries(d, start, end, date_trunc=date_trunc, value_func=value_func,
+                                               limit=limit)
+    n = 0
+    for results in fetch_point_values_batches(queries):
+        for result in results:
             ts = result[0]
             value = result[1]
             if is_bool:
@@ -309,10 +533,449 @@ def get_point_values(d, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT
             if ts_as_datetime:
                 # convert from epoch to datetime directly
                 ts = datetime.utcfromtimestamp(ts // 1000).replace(microsecond=0).replace(tzinfo=timezone.utc)
-            data.append([ts, value])
-        logger.info("Got %s data points for %s", len(data), d.entity_id)
-        cursor.close()
-    return list(reversed(data))
+            yield [ts, value]
+        n += len(results)
+    logger.info("Got %s data points for %s%s", n, d.entity_id, ' using rollup' if rollup else '')
+
+
+def fetch_point_values_batches(queries):
+    # runs the queries given by get_point_values_queries in sequence and yields their rows in batches,
+    # since the Crate cursor buffers the whole result set on execute each batch is a separate query:
+    # - ('once', sql, params): a bounded query run once
+    # - ('keyset', build, after): rows read POINT_VALUES_FETCH_SIZE at a time, build(after, limit)
+    #   returns the query of the rows after the first column of the last row read
+    # - ('window', build, seek, start, end, date_trunc): aggregates read by time windows of
+    #   POINT_VALUES_FETCH_SIZE buckets, build(lo, hi) returns the query of the buckets from DATE_TRUNC(lo)
+    #   to before DATE_TRUNC(hi), None meaning no bound, so each query only aggregates the rows of its own
+    #   window, and after an empty window seek(lo) returns the query of the first ts from there as epoch ms
+    #   so gaps in the data are skipped in one query
+    with connections['crate'].cursor() as cursor:
+        for query in queries:
+            kind = query[0]
+            if kind == 'once':
+                cursor.execute(query[1], query[2])
+                results = cursor.fetchall()
+                if results:
+                    yield results
+            elif kind == 'keyset':
+                build, after = query[1], query[2]
+                while True:
+                    cursor.execute(*build(after, POINT_VALUES_FETCH_SIZE))
+                    results = cursor.fetchall()
+                    if results:
+                        yield results
+                    if len(results) < POINT_VALUES_FETCH_SIZE:
+                        break
+                    after = results[-1][0]
+            elif kind == 'window':
+                build, seek, start, end, date_trunc = query[1:]
+                window = timedelta(seconds=DATE_TRUNC_SECONDS[date_trunc] * POINT_VALUES_FETCH_SIZE)
+                lo = None
+                hi = start + window
+                while True:
+                    if hi >= end:
+                        hi = None
+                    cursor.execute(*build(lo, hi))
+                    results = cursor.fetchall()
+                    if results:
+                        yield results
+                    if hi is None:
+                        break
+                    lo = hi
+                    if not results:
+                        cursor.execute(*seek(lo))
+                        row = cursor.fetchone()
+                        if not row or row[0] is None:
+                            break
+                        lo = datetime.utcfromtimestamp(row[0] / 1000.0)
+                        if end.tzinfo:
+                            lo = pytz.utc.localize(lo)
+                    hi = lo + window
+
+
+def bucket_window_sql(date_trunc, lo, hi):
+    # the conditions (sql, params) on ts selecting the rows of whole buckets for a window of
+    # fetch_point_values_batches, consecutive windows share their bounds so each bucket is in one of them
+    sql = ''
+    params = []
+    if lo is not None:
+        sql += " AND ts >= DATE_TRUNC('{}', %s)".format(date_trunc)
+        params.append(lo)
+    if hi is not None:
+        sql += " AND ts < DATE_TRUNC('{}', %s)".format(date_trunc)
+        params.append(hi)
+    return sql, params
+
+
+def get_point_values_queries(d, start, end, date_trunc=DEFAULT_RES, value_func='avg', limit=None):
+    # returns the list of queries to run in sequence to get the point values, see
+    # fetch_point_values_batches, and if a rollup is used
+    # each row is (ts, value) or (ts, string_value, double_value) for Bool points
+    if date_trunc not in DATE_TRUNC_SECONDS:
+        date_trunc = DEFAULT_RES
+    # use different queries for Number type sensors
+    is_number = 'Number' == d.kind
+    is_bool = 'Bool' == d.kind
+    topic = d.topic
+
+    def aggregate(columns, where, params):
+        # aggregated rows by time windows
+        def build(lo, hi):
+            window_sql, window_params = bucket_window_sql(date_trunc, lo, hi)
+            sql = """SELECT DATE_TRUNC('{}', ts) as timest, {} FROM "data"
+                     WHERE topic = %s AND {}{}
+                     GROUP BY timest ORDER BY timest;""".format(date_trunc, columns, where, window_sql)
+            return sql, [topic] + params + window_params
+
+        def seek(lo):
+            sql = """SELECT CAST(MIN(ts) AS LONG) FROM "data"
+                     WHERE topic = %s AND {} AND ts >= DATE_TRUNC('{}', %s);""".format(where, date_trunc)
+            return sql, [topic] + params + [lo]
+        return ('window', build, seek, start, end, date_trunc)
+
+    queries = []
+    rollup = None
+    if is_number and value_func in ROLLUP_VALUE_FUNCS:
+        rollup = get_rollup(date_trunc)
+    if rollup:
+        # the rows are between start and end as for the raw data, so only the buckets entirely in that range are
+        # read from the rollup table, the partial first and last buckets and the ones after the watermark are
+        # aggregated from the raw data
+        (table, watermark) = rollup
+        queries.append(('once', """SELECT DATE_TRUNC('{0}', ts) as timest, {1}(double_value) FROM "data"
+                           WHERE topic = %s AND ts > %s AND ts < %s AND ts < %s AND ts < DATE_TRUNC('{0}', %s)
+                           AND DATE_TRUNC('{0}', ts) = DATE_TRUNC('{0}', %s)
+                           GROUP BY timest;""".format(date_trunc, value_func),
+                        [topic, start, start + timedelta(seconds=DATE_TRUNC_SECONDS[date_trunc]), watermark,
+                         end, start]))
+
+        def rollup_rows(after, limit):
+            sql = """SELECT CAST(ts AS LONG), {} FROM "{}"
+                     WHERE topic = %s AND ts > %s AND ts < %s AND ts < DATE_TRUNC('{}', %s)
+                     ORDER BY ts LIMIT %s;""".format(ROLLUP_VALUE_FUNCS[value_func], table, date_trunc)
+            return sql, [topic, after, watermark, end, limit]
+        queries.append(('keyset', rollup_rows, start))
+        queries.append(aggregate('{}(double_value)'.format(value_func),
+                                 "ts > %s AND (ts >= %s OR ts >= DATE_TRUNC('{}', %s)) AND ts <= %s".format(date_trunc),
+                                 [start, watermark, end, end]))
+    elif is_number:
+        queries.append(aggregate('{}(double_value)'.format(value_func), 'ts > %s AND ts <= %s', [start, end]))
+    elif is_bool:
+        # use MIN as function since we query string_value
+        queries.append(aggregate('MIN(string_value), {}(double_value)'.format(value_func), 'ts > %s AND ts <= %s',
+                                 [start, end]))
+    elif limit:
+        # the most recent values, but still in ascending order, this is already bounded
+        queries.append(('once', """SELECT ts, string_value FROM (
+                             SELECT ts, string_value FROM "data"
+                             WHERE topic = %s AND ts > %s AND ts <= %s ORDER BY ts DESC LIMIT %s
+                           ) t ORDER BY ts;""",
+                        [topic, start, end, int(limit)]))
+    else:
+        def raw_rows(after, limit):
+            sql = """SELECT ts, string_value FROM "data"
+                     WHERE topic = %s AND ts > %s AND ts <= %s
+                     ORDER BY ts LIMIT %s;"""
+            return sql, [topic, after, end, limit]
+        queries.append(('keyset', raw_rows, start))
+    return queries, rollup is not None
+
+
+def get_rollup(date_trunc):
+    # returns the (table, watermark) of the rollup for the given resolution, or None if there is none
+    # the watermark (epoch ms) is the end of the last bucket aggregated, so only the buckets before it are complete
+    table = ROLLUPS.get(date_trunc)
+    if not table:
+        return None
+    key = ROLLUP_WATERMARK_KEY + date_trunc
+    watermark = cache.get(key)
+    if watermark is None:
+        # the watermark is kept in Crate so that all the processes see it, and cached for a short while
+        try:
+            with connections['crate'].cursor() as c:
+                c.execute("""SELECT CAST(watermark AS LONG) FROM "{}" WHERE rollup = %s;""".format(ROLLUP_STATE_TABLE),
+                          [table])
+                row = c.fetchone()
+        except DatabaseError as e:
+            # could be the table is missing, the rollups were never refreshed then
+            logger.warning('get_rollup: cannot read the watermark of %s: %s', table, e)
+            row = None
+        watermark = row[0] if row and row[0] else 0
+        cache.set(key, watermark, settings.CRATE_ROLLUP_WATERMARK_TTL)
+    if not watermark:
+        return None
+    return (table, watermark)
+
+
+def ensure_crate_rollup_tables():
+    with connections['crate'].cursor() as c:
+        for table in ROLLUPS.values():
+            sql = """
+            CREATE TABLE IF NOT EXISTS "{}" (
+               "topic" STRING,
+               "ts" TIMESTAMP,
+               "avg_value" DOUBLE,
+               "min_value" DOUBLE,
+               "max_value" DOUBLE,
+               "count_value" LONG,
+               PRIMARY KEY ("topic", "ts")
+            ) CLUSTERED BY ("topic");""".format(table)
+            c.execute(sql)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS "{}" (
+               "rollup" STRING PRIMARY KEY,
+               "watermark" TIMESTAMP
+            );""".format(ROLLUP_STATE_TABLE))
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS "{}" (
+               "rollup" STRING,
+               "topic" STRING,
+               "ts" TIMESTAMP,
+               "marked" TIMESTAMP,
+               PRIMARY KEY ("rollup", "topic")
+            );""".format(ROLLUP_DIRTY_TABLE))
+
+
+def mark_rollups_dirty(topics_since, retried=False):
+    # to call when data older than the rollup watermark is imported, topics_since is a dict
+    # of topic -> the earliest ts imported, the next refresh_rollup re-aggregates those topics from there
+    if not topics_since:
+        return
+    rows = []
+    params = []
+    for table in ROLLUPS.values():
+        for topic, ts in topics_since.items():
+            rows.append('(%s, %s, %s, CURRENT_TIMESTAMP)')
+            params.extend([table, topic, ts])
+    try:
+        with connections['crate'].cursor() as c:
+            c.execute("""INSERT INTO "{}" (rollup, topic, ts, marked) VALUES {}
+                         ON CONFLICT (rollup, topic) DO UPDATE SET ts = LEAST(ts, excluded.ts),
+                         marked = excluded.marked;""".format(ROLLUP_DIRTY_TABLE, ', '.join(rows)), params)
+    except DatabaseError as e:
+        # could be the table is missing
+        if 'RelationUnknown' in str(e) and not retried:
+            ensure_crate_rollup_tables()
+            return mark_rollups_dirty(topics_since, retried=True)
+        raise
+
+
+def aggregate_rollup(c, table, date_trunc, where, params):
+    # aggregates the raw data matching the where clause into the rollup table, returns the number of rows updated
+    sql = """INSERT INTO "{0}" (topic, ts, avg_value, min_value, max_value, count_value)
+             SELECT topic, DATE_TRUNC('{1}', ts) AS bucket,
+             AVG(double_value), MIN(double_value), MAX(double_value), COUNT(double_value)
+             FROM "data" WHERE double_value IS NOT NULL AND {2}
+             GROUP BY topic, bucket
+             ON CONFLICT (topic, ts) DO UPDATE SET avg_value = excluded.avg_value,
+             min_value = excluded.min_value, max_value = excluded.max_value,
+             count_value = excluded.count_value;""".format(table, date_trunc, where)
+    c.execute(sql, params)
+    return c.rowcount
+
+
+def refresh_rollup(date_trunc, retried=False):
+    # incrementally aggregates the raw data into the rollup table of the given resolution, returns the number
+    # of rows updated; each run:
+    # - re-aggregates the last CRATE_ROLLUP_LATE_WINDOW seconds before the watermark for the rows arriving late
+    # - re-aggregates the topics marked by mark_rollups_dirty, for older data imported later
+    # - aggregates the complete buckets after the watermark, at most CRATE_ROLLUP_MAX_SPAN seconds of them
+    #   so the first run over an existing data table is spread over as many runs as needed
+    # the buckets of the rollups (hour, day) have a fixed length in UTC so they are computed from the epoch
+    table = ROLLUPS[date_trunc]
+    bucket_ms = DATE_TRUNC_SECONDS[date_trunc] * 1000
+    try:
+        with connections['crate'].cursor() as c:
+            c.execute("""SELECT CAST(watermark AS LONG) FROM "{}" WHERE rollup = %s;""".format(ROLLUP_STATE_TABLE),
+                      [table])
+            row = c.fetchone()
+            since = row[0] if row else None
+            if not since:
+                # start from the first data row
+                c.execute("""SELECT CAST(MIN(ts) AS LONG) FROM "data" WHERE double_value IS NOT NULL;""")
+                since = c.fetchone()[0]
+                if since is None:
+                    return 0
+                since -= since % bucket_ms
+
+            # only complete buckets are aggregated, the current one is still read from the raw data
+            now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+            watermark = min(now_ms - now_ms % bucket_ms,
+                            since + max(settings.CRATE_ROLLUP_MAX_SPAN * 1000 // bucket_ms, 1) * bucket_ms)
+            watermark = max(watermark, since)
+            late_ms = -(-settings.CRATE_ROLLUP_LATE_WINDOW * 1000 // bucket_ms) * bucket_ms
+            n = 0
+            if watermark > since - late_ms:
+                n += aggregate_rollup(c, table, date_trunc, 'ts >= %s AND ts < %s', [since - late_ms, watermark])
+
+            # the older buckets of the dirty topics
+            c.execute("""SELECT topic, CAST(ts AS LONG), CAST(marked AS LONG) FROM "{}" WHERE rollup = %s;""".format(
+                ROLLUP_DIRTY_TABLE), [table])
+            for (topic, ts, marked) in c.fetchall():
+                ts -= ts % bucket_ms
+                if ts < since - late_ms:
+                    n += aggregate_rollup(c, table, date_trunc, 'topic = %s AND ts >= %s AND ts < %s',
+                                          [topic, ts, since - late_ms])
+                # unless it was marked again in the meantime
+                c.execute("""DELETE FROM "{}" WHERE rollup = %s AND topic = %s AND marked = %s;""".format(
+                    ROLLUP_DIRTY_TABLE), [table, topic, marked])
+
+            # make the new rows visible before moving the watermark
+            c.execute("""REFRESH TABLE "{}";""".format(table))
+            c.execute("""INSERT INTO "{}" (rollup, watermark) VALUES (%s, %s)
+                         ON CONFLICT (rollup) DO UPDATE SET watermark = excluded.watermark;""".format(
+                ROLLUP_STATE_TABLE), [table, watermark])
+            cache.set(ROLLUP_WATERMARK_KEY + date_trunc, watermark, settings.CRATE_ROLLUP_WATERMARK_TTL)
+            logger.info('refresh_rollup: %s since %s updated %s rows, watermark %s', table, since, n, watermark)
+            return n
+    except DatabaseError as e:
+        # could be the table is missing
+        if 'RelationUnknown' in str(e) and not retried:
+            ensure_crate_rollup_tables()
+            return refresh_rollup(date_trunc, retried=True)
+        raise
+
+
+def refresh_rollups():
+    # this is meant to run periodically (see tasks.refresh_rollups_task)
+    return {date_trunc: refresh_rollup(date_trunc) for date_trunc in ROLLUPS.keys()}
+
+
+def fit_date_trunc(start, end, max_points):
+    # returns the finest DATE_TRUNC resolution giving at most max_points buckets between start and end
+    range_seconds = (end - start).total_seconds()
+    for date_trunc in ['second', 'minute', 'hour', 'day', 'week', 'month', 'year']:
+        if range_seconds / DATE_TRUNC_SECONDS[date_trunc] <= max_points:
+            return date_trunc
+    return 'year'
+
+
+def get_points_values(points, date_trunc=DEFAULT_RES, value_func='avg', trange=DEFAULT_RANGE, max_points=None):
+    # returns the values of multiple points aligned on the same timestamps, fetched with one Crate query:
+    # {'ts': [ts1, ts2, ...], 'values': {point.entity_id: [value at ts1 or None, value at ts2 or None, ...]}}
+    # note: since the values are aggregated per bucket, non Number and non Bool points get their MIN value
+    if date_trunc not in ['day', 'hour', 'minute', 'second']:
+        date_trunc = DEFAULT_RES
+    start, end = get_start_date_from_range(trange)
+    if max_points and (end - start).total_seconds() / DATE_TRUNC_SECONDS[date_trunc] > max_points:
+        date_trunc = fit_date_trunc(start, end, max_points)
+
+    points = [p for p in points if p.topic]
+    points_by_topic = {}
+    for point in points:
+        points_by_topic.setdefault(point.topic, []).append(point)
+    by_point = {point.entity_id: {} for point in points}
+    timestamps = set()
+    if points_by_topic:
+        sql = """SELECT topic, DATE_TRUNC('{}', ts) as timest, {}(double_value), MIN(string_value) FROM "data"
+                 WHERE topic = ANY(%s) AND ts > %s AND ts <= %s
+                 GROUP BY topic, timest;""".format(date_trunc, value_func)
+        with connections['crate'].cursor() as cursor:
+            cursor.execute(sql, [list(points_by_topic.keys()), start, end])
+            while True:
+                results = cursor.fetchmany(POINT_VALUES_FETCH_SIZE)
+                if not results:
+                    break
+                for (topic, ts, double_value, string_value) in results:
+                    timestamps.add(ts)
+                    for point in points_by_topic[topic]:
+                        if 'Number' == point.kind:
+                            value = double_value
+                        elif 'Bool' == point.kind:
+                            if string_value and (string_value == 't' or string_value != '0'):
+                                value = 1
+                            elif double_value is not None:
+                                value = round(double_value)
+                            else:
+                                value = 0
+                        else:
+                            value = string_value
+                        by_point[point.entity_id][ts] = value
+
+    ts_list = sorted(timestamps)
+    logger.info("Got %s timestamps for %s points", len(ts_list), len(by_point))
+    return {
+        'ts': ts_list,
+        'values': {entity_id: [values.get(ts) for ts in ts_list] for entity_id, values in by_point.items()}
+    }
+
+
+def get_downsampled_point_values(d, start, end, max_points, downsample=DEFAULT_DOWNSAMPLE, value_func='avg',
+                                 ts_as_datetime=False):
+    # returns at most max_points values of a Number point between start and end
+    # the bucket width is chosen so Crate only returns a bounded number of rows, then:
+    # - lttb: aggregate with value_func into finer buckets and keep the most significant ones
+    # - minmax: returns the min and max of each bucket
+    if downsample == DOWNSAMPLE_MINMAX:
+        buckets = max(1, max_points // 2)
+    else:
+        downsample = DOWNSAMPLE_LTTB
+        buckets = max_points * LTTB_OVERSAMPLING
+    range_ms = (end - start).total_seconds() * 1000
+    width = max(1000, int(ceil(range_ms / buckets)))
+
+    # timestamps cast as LONG are epoch milliseconds
+    sql = """SELECT (CAST(ts AS LONG) / {0}) * {0} as timest, {1}(double_value), MIN(double_value), MAX(double_value)
+             FROM "data"
+             WHERE topic = %s AND ts > %s AND ts <= %s
+             GROUP BY timest ORDER BY timest;""".format(width, value_func)
+
+    data = []
+    with connections['crate'].cursor() as cursor:
+        cursor.execute(sql, [d.topic, start, end])
+        for (ts, value, min_value, max_value) in cursor.fetchall():
+            if value is None:
+                continue
+            if downsample == DOWNSAMPLE_MINMAX:
+                data.append([ts, min_value])
+                if max_value != min_value:
+                    data.append([ts + width // 2, max_value])
+            else:
+                data.append([ts, value])
+    logger.info("Got %s data points for %s downsampled with %s buckets of %s ms", len(data), d.entity_id,
+                downsample, width)
+
+    if downsample == DOWNSAMPLE_LTTB:
+        data = lttb(data, max_points)
+
+    if ts_as_datetime:
+        for v in data:
+            v[0] = datetime.utcfromtimestamp(v[0] // 1000).replace(microsecond=0).replace(tzinfo=timezone.utc)
+    return data
+
+
+def lttb(data, threshold):
+    # Largest-Triangle-Three-Buckets: reduce a list of [x, y] to threshold points while preserving its shape
+    n = len(data)
+    if threshold >= n or threshold < 3:
+        return data
+
+    sampled = [data[0]]
+    # the first and last points are always kept, the rest is split in threshold - 2 buckets
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # average of the next bucket, which is the third point of the triangle
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_len = avg_end - avg_start
+        avg_x = sum([p[0] for p in data[avg_start:avg_end]]) / avg_len
+        avg_y = sum([p[1] for p in data[avg_start:avg_end]]) / avg_len
+
+        # pick the point of the current bucket making the largest triangle
+        ax, ay = data[a]
+        max_area = -1
+        next_a = a
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (data[j][1] - ay) - (ax - data[j][0]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        sampled.append(data[next_a])
+        a = next_a
+
+    sampled.append(data[-1])
+    return sampled
 
 
 def get_topics_tags_report():
@@ -351,40 +1014,36 @@ def get_topics_tags_report():
 
 
 def get_topics_tags_report_header():
-    points = PointView.objects.all().order_by('topic')
-    report_header = []
+    report_header = set()
     topics_tags = {}
 
-    for point in points:
-        tags_exists = False
+    for (topic, kv_tags, m_tags) in PointView.objects.order_by('topic').values_list('topic', 'kv_tags', 'm_tags'):
         topic_tags = {}
-        if point.kv_tags:
-            topic_tags["kv_tags"] = point.kv_tags
-            tags_exists = True
-            for key in point.kv_tags.keys():
-                if key not in report_header:
-                    report_header.append(key)
-
-        if point.m_tags:
-            topic_tags["m_tags"] = point.m_tags
-            tags_exists = True
-            for tag in point.m_tags:
-                if tag not in report_header:
-                    report_header.append(tag)
+        if kv_tags:
+            topic_tags["kv_tags"] = kv_tags
+            report_header.update(kv_tags.keys())
+
+        if m_tags:
+            topic_tags["m_tags"] = m_tags
+            report_header.update(m_tags)
 
-        if tags_exists:
-            topics_tags[point.topic] = topic_tags
+        if topic_tags:
+            topics_tags[topic] = topic_tags
     report_header = sorted(report_header)
 
     return report_header, topics_tags
 
 
-def tag_rulesets_run_report(entities):
+def tag_rulesets_run_report(entities, report_tags=None):
+    # the columns are all the tags of the data points, given as report_tags when
+    # they are already known, like the tags collected by a preview
     report_rows = []
     report_header = []
-    topics_tags = {}
 
-    report_header, topics_tags = get_topics_tags_report_header()
+    if report_tags is None:
+        report_header, topics_tags = get_topics_tags_report_header()
+    else:
+        report_header = sorted(report_tags)
 
     for key in sorted(entities.keys()):
         entity = entities[key]
@@ -412,14 +1071,17 @@ def tag_rulesets_run_report(entities):
     return report_rows, report_header
 
 
-def tag_rulesets_run_report_diff(entities, updated_tags, removed_tags):
+def tag_rulesets_run_report_diff(entities, updated_tags, removed_tags, report_tags=None):
+    # see tag_rulesets_run_report for report_tags
     report_rows = []
     report_header = []
     report_header_diff = []
-    topics_tags = {}
 
     if updated_tags or removed_tags:
-        report_header_all, topics_tags = get_topics_tags_report_header()
+        if report_tags is None:
+            report_header_all, topics_tags = get_topics_tags_report_header()
+        else:
+            report_header_all = sorted(report_tags)
         for key in updated_tags.keys():
             tags = updated_tags.get(key)
             for tag in report_header_all:
@@ -477,8 +1139,20 @@ def tag_rulesets_run_report_diff(entities, updated_tags, removed_tags):
 def charts_for_points(points):
     charts = []
     i = 0
+    points = list(points)
+    current_values = get_current_values(points)
+    # the series of the Number and Bool charts are fetched at once from data_url when there
+    # are several of them, a single chart or the string points use their own url which
+    # downsamples or returns the raw string values
+    batched = [point.entity_id for point in points
+               if current_values.get(point.topic) and point.kind in ('Number', 'Bool')]
+    if len(batched) < 2:
+        batched = []
+    data_url = None
+    if batched:
+        data_url = reverse("core:points_data_json") + '?' + urlencode([('point', entity_id) for entity_id in batched])
     for point in points:
-        data = get_current_value_dict(point)
+        data = current_values.get(point.topic)
         # skip empty charts
         if data:
             i += 1
@@ -499,6 +1173,8 @@ def charts_for_points(points):
                 'point': point,
                 'current_value': data,
                 'url': reverse("core:point_data_json", kwargs={"point": point.entity_id}),
+                'data_url': data_url,
+                'batched': point.entity_id in batched,
                 'isBool': point.kind == 'Bool'
             })
     return charts
@@ -863,92 +1539,283 @@ def filter_Q(name, operator, value, valid_tags):
         return condition
 
 
-def apply_filter_to_queryset(qs, filter_field, filter_type, filter_value, valid_tags):
-    logger.info('apply_filter_to_queryset: %s %s %s', filter_field, filter_type, filter_value)
+def filter_to_Q(filter_field, filter_type, filter_value, valid_tags):
+    # returns the Q for one filter, or None when it does not restrict anything
+    logger.info('filter_to_Q: %s %s %s', filter_field, filter_type, filter_value)
     if not filter_field or filter_field == 'undefined' or filter_field == 'Topic':
         name = 'topic'
     else:
         name = filter_field
+    q = None
     if filter_type:
         if filter_type == 'present':
-            qs = qs.filter(filter_Q(name, 'isnull', False, valid_tags))
+            q = filter_Q(name, 'isnull', False, valid_tags)
         elif filter_type == 'absent':
-            qs = qs.exclude(filter_Q(name, 'isnull', False, valid_tags))
+            q = ~filter_Q(name, 'isnull', False, valid_tags)
         elif filter_value:
             # all of those test either topic OR a kv_tags
             # so fail if trying to match a kv_tag
             prefix = 'i'
             if not name == 'topic' and name not in valid_tags and (filter_type == 'c' or filter_type == 'eq'):
                 logger.warning('topic filter found an unused tag: %s', name)
-                return qs.none()
+                return Q(pk__in=[])
             if filter_type == 'c':
-                qs = qs.filter(filter_Q(name, prefix + 'contains', filter_value, valid_tags))
+                q = filter_Q(name, prefix + 'contains', filter_value, valid_tags)
             elif filter_type == 'nc':
-                qs = qs.exclude(filter_Q(name, prefix + 'contains', filter_value, valid_tags))
+                q = ~filter_Q(name, prefix + 'contains', filter_value, valid_tags)
             elif filter_type == 'eq':
-                qs = qs.filter(filter_Q(name, prefix + 'exact', filter_value, valid_tags))
+                q = filter_Q(name, prefix + 'exact', filter_value, valid_tags)
             elif filter_type == 'neq':
-                qs = qs.exclude(filter_Q(name, prefix + 'exact', filter_value, valid_tags))
+                q = ~filter_Q(name, prefix + 'exact', filter_value, valid_tags)
             elif filter_type == 'matches':
-                qs = qs.filter(filter_Q(name, prefix + 'regex', filter_value, valid_tags))
+                q = filter_Q(name, prefix + 'regex', filter_value, valid_tags)
             elif filter_type == 'gt':
-                qs = qs.filter(filter_Q(name, 'gt', filter_value, valid_tags))
+                q = filter_Q(name, 'gt', filter_value, valid_tags)
             elif filter_type == 'gte':
-                qs = qs.filter(filter_Q(name, 'gte', filter_value, valid_tags))
+                q = filter_Q(name, 'gte', filter_value, valid_tags)
             elif filter_type == 'lt':
-                qs = qs.filter(filter_Q(name, 'lt', filter_value, valid_tags))
+                q = filter_Q(name, 'lt', filter_value, valid_tags)
             elif filter_type == 'lte':
-                qs = qs.filter(filter_Q(name, 'lte', filter_value, valid_tags))
-    return qs
+                q = filter_Q(name, 'lte', filter_value, valid_tags)
+    # an empty Q, eg: for a tag that is not a Crate column, matches everything
+    if not q:
+        return None
+    return q
 
 
-def apply_filters_to_queryset(qs, filters):
-    # first we do a schema check since trying to fetch unused tags will cause a DB error
-    valid_tags = []
+def apply_filter_to_queryset(qs, filter_field, filter_type, filter_value, valid_tags):
+    q = filter_to_Q(filter_field, filter_type, filter_value, valid_tags)
+    if q is not None:
+        qs = qs.filter(q)
+    return qs
 
-    with connections['crate'].cursor() as c:
-        sql = """SELECT column_name from information_schema.columns
-                 WHERE table_name = 'topic' and column_name like 'kv_tags[%';"""
-        c.execute(sql)
-        for (cn, ) in c:
-            # extract the tag name from "kv_tags['tag_name']"
-            valid_tags.append(cn[9:-2])
 
+def filters_to_Q(filters, valid_tags):
     # ordering or AND and OR filters
-    # A or B and C -> (A(qs) | B(qs)) & C(qs)
-    # A or B and C or D -> (A(qs) | B(qs)) & (C(qs) | D(qs))
-    # so we first resolve the ORs from the list:
+    # A or B and C -> (A | B) & C
+    # A or B and C or D -> (A | B) & (C | D)
+    # so we first group the ORs from the list:
     #  (A, *), (B, or), (C, and), (D, or)
-    # The ORs apply to oqs (original qs)
-    # then we AND each resulting qs
-    oqs = qs
-    first = True
-    rqs = []
+    # then AND the groups into a single Q, or None when nothing is restricted
+    groups = []
     for (filter_field, filter_type, filter_value, filter_op) in filters:
-        logging.info('apply_filters_to_queryset: add filter %s', (filter_field, filter_type, filter_value, filter_op))
-        if first:
-            qs = apply_filter_to_queryset(oqs, filter_field, filter_type, filter_value, valid_tags)
-        elif filter_op and filter_op.lower() == 'or':
-            qs = qs | apply_filter_to_queryset(oqs, filter_field, filter_type, filter_value, valid_tags)
+        logging.info('filters_to_Q: add filter %s', (filter_field, filter_type, filter_value, filter_op))
+        q = filter_to_Q(filter_field, filter_type, filter_value, valid_tags)
+        if groups and filter_op and filter_op.lower() == 'or':
+            groups[-1].append(q)
         else:
-            # skip for now store the current qs
-            rqs.append(qs)
-            # reset working qs
-            qs = oqs
-            qs = apply_filter_to_queryset(oqs, filter_field, filter_type, filter_value, valid_tags)
-        first = False
+            groups.append([q])
+
+    result = None
+    for group in groups:
+        # OR with an unrestricted filter matches everything
+        if None in group:
+            continue
+        q = group[0]
+        for x in group[1:]:
+            q = q | x
+        result = q if result is None else result & q
+    return result
 
-    # add the last qs
-    rqs.append(qs)
 
-    # now AND resulting qs
-    qs = oqs
-    for q in rqs:
-        qs = qs & q
+def explain_queryset(qs):
+    # debug hook: log the SQL of the queryset and its query plan
+    # compiled for the queryset database, sql_with_params would use the default one
+    sql, params = qs.query.get_compiler(qs.db).as_sql()
+    with connections[qs.db].cursor() as c:
+        c.execute('EXPLAIN ' + sql, params)
+        plan = c.fetchall()
+    logger.info('explain_queryset: %s %s\n%s', sql, params, '\n'.join(str(row) for row in plan))
+    return sql, plan
 
+
+def apply_filters_to_queryset(qs, filters):
+    # first we do a schema check since trying to fetch unused tags will cause a DB error
+    valid_tags = get_crate_topic_tags()
+
+    # the filters are compiled to a single WHERE clause
+    q = filters_to_Q(filters, valid_tags)
+    if q is not None:
+        qs = qs.filter(q)
+    if settings.EXPLAIN_TOPIC_FILTERS:
+        explain_queryset(qs)
     return qs
 
 
+def topic_list_key(*args):
+    # hash of the topic list filters and options, changes with the crate topics version
+    s = json.dumps([get_crate_topics_version()] + list(args), sort_keys=True, default=str)
+    return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+
+def count_topics(qs, key):
+    # the COUNT(*) of a filtered topic queryset, cached by its topic_list_key
+    cache_key = TOPIC_COUNT_KEY_PREFIX + key
+    count = cache.get(cache_key)
+    if count is None:
+        count = qs.count()
+        cache.set(cache_key, count, settings.TOPIC_LIST_CACHE_TTL)
+    return count
+
+
+class CountedPaginator(Paginator):
+    # a Paginator using an already known count
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        if count is not None:
+            self.count = count
+
+
+def get_topics_page(qs, key, page, per_page, count, cursor=None, keyset=True, desc=False):
+    # returns (the values of the topics in the page, the cursor of the next page)
+    # when the queryset is sorted by topic, the pages are read with a keyset: the
+    # rows after the last topic of the previous page, which is either given as the
+    # cursor or was cached when that page was read, else this falls back to OFFSET
+    paginator = CountedPaginator(qs, per_page, count=count)
+    # same as Paginator.get_page for invalid page numbers
+    try:
+        page = paginator.validate_number(page)
+    except PageNotAnInteger:
+        page = 1
+    except EmptyPage:
+        page = paginator.num_pages
+    per_page = paginator.per_page
+
+    pages_key = TOPIC_PAGES_KEY_PREFIX + key
+    pages = cache.get(pages_key) or {}
+    if keyset and cursor is None and page > 1:
+        cursor = pages.get(page - 1)
+    if page == 1:
+        rows = qs[:per_page]
+    elif keyset and cursor is not None:
+        if desc:
+            rows = qs.filter(topic__lt=cursor)[:per_page]
+        else:
+            rows = qs.filter(topic__gt=cursor)[:per_page]
+    else:
+        offset = (page - 1) * per_page
+        rows = qs[offset:offset + per_page]
+    rows = list(rows.values())
+
+    next_cursor = None
+    if rows:
+        next_cursor = rows[-1]['topic']
+        if keyset and pages.get(page) != next_cursor:
+            pages[page] = next_cursor
+            cache.set(pages_key, pages, settings.TOPIC_LIST_CACHE_TTL)
+    return rows, next_cursor
+
+
+def iter_topic_chunks(qs, size=TAG_TOPICS_CHUNK_SIZE):
+    # yields the topic names of the Crate topic queryset in lists of at most size, read
+    # by keyset pages since iterator() needs server side cursors which Crate does not support
+    qs = qs.order_by('topic')
+    last = None
+    while True:
+        page_qs = qs if last is None else qs.filter(topic__gt=last)
+        chunk = [str(topic) for topic in page_qs.values_list('topic', flat=True)[:size]]
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            break
+        last = chunk[-1]
+
+
+def tag_topics_chunk(topics, tags, pretend, updated, updated_entities, updated_tags, removed_tags):
+    entities = {}
+    for e in Entity.objects.filter(topic__in=topics):
+        entities.setdefault(e.topic, e)
+
+    created = []
+    changed = []
+    for topic in topics:
+        logging.info('tag_topics: apply to topic %s', topic)
+        # update or create the Data Point
+        e = entities.get(topic)
+        if not e:
+            entity_id = make_random_id(topic)
+            e = Entity(entity_id=entity_id, topic=topic, m_tags=[])
+            e.add_tag('id', entity_id, commit=False)
+            entities[topic] = e
+            created.append(e)
+        else:
+            changed.append(e)
+        if not e.kv_tags or not e.kv_tags.get('dis'):
+            e.add_tag('dis', topic, commit=False)
+        for tag in tags:
+            # never tag with 'site' or 'equip'!
+            if tag != 'site' and tag != 'equip':
+                if tag.get('remove') is True or tag.get('remove') == 'True':
+                    logging.info('*** remove tag %s', tag)
+                    if pretend:
+                        current_tag = None
+                        current_value = None
+                        tag_tag = tag.get('tag')
+                        if tag_tag in e.m_tags:
+                            current_tag = tag_tag
+                            current_value = 'type:MARKER'
+                        else:
+                            value = e.kv_tags.get(tag_tag)
+                            if value:
+                                current_tag = tag_tag
+                                current_value = value
+
+                        if current_tag:
+                            tt = removed_tags.get(topic)
+                            if not tt:
+                                tt = {}
+                            tt[current_tag] = current_value
+
+                            removed_tags[topic] = tt
+
+                    e.remove_tag(tag.get('tag'), commit=False)
+                else:
+                    logging.info('*** add tag %s', tag)
+                    if pretend:
+                        current_value = None
+                        tag_tag = tag.get('tag')
+                        if tag_tag in e.m_tags:
+                            current_value = 'type:MARKER'
+                        else:
+                            value = e.kv_tags.get(tag_tag)
+                            if value:
+                                current_value = value
+
+                        tt = updated_tags.get(topic)
+                        if not tt:
+                            tt = {}
+                        if tag.get('value'):
+                            tt[tag.get('tag')] = {'new': tag.get('value'), 'previous': current_value}
+                        else:
+                            tt[tag.get('tag')] = {'new': 'type:MARKER', 'previous': current_value}
+
+                        updated_tags[topic] = tt
+                    e.add_tag(tag.get('tag'), value=tag.get('value'), commit=False)
+
+    # if tagged with an equipRef make sure the siteRef also matches
+    equip_refs = set(e.kv_tags.get('equipRef') for e in entities.values() if e.kv_tags and e.kv_tags.get('equipRef'))
+    equips_sites = {}
+    if equip_refs:
+        equips_sites = dict(EquipmentView.objects.filter(object_id__in=equip_refs).values_list('object_id', 'site_id'))
+    for topic in topics:
+        e = entities[topic]
+        equip_ref = e.kv_tags.get('equipRef')
+        if equip_ref:
+            # let it fail if the equipment does not exist
+            if equip_ref not in equips_sites:
+                raise EquipmentView.DoesNotExist('Equipment {} does not exist'.format(equip_ref))
+            if equips_sites[equip_ref]:
+                e.add_tag('siteRef', equips_sites[equip_ref], commit=False)
+        if pretend:
+            updated_entities[topic] = e
+            logging.info('tag_topics: pretend changed %s %s %s', e, e.m_tags, e.kv_tags)
+        updated.append({'topic': topic, 'point': e.entity_id, 'name': e.kv_tags.get('dis')})
+
+    if not pretend:
+        bulk_save_entities(created=created, updated=changed)
+
+
 def tag_topics(filters, tags, select_all=False, topics=[], select_not_mapped_topics=None, pretend=False):
     qs = Topic.objects.all()
 
@@ -971,86 +1838,20 @@ def tag_topics(filters, tags, select_all=False, topics=[], select_not_mapped_top
                 q_filters.append((filter_field, filter_type, filter_value, filter_op))
         qs = apply_filters_to_queryset(qs, q_filters)
 
+    if not select_all:
+        qs = qs.filter(topic__in=topics)
+
     # store a dict of topic -> data_point.entity_id
     updated = []
     updated_entities = {}
     updated_tags = {}
     removed_tags = {}
-    for etopic in qs:
-        topic = str(etopic.topic)
-        if select_all or topic in topics:
-            logging.info('tag_topics: apply to topic %s', topic)
-            # update or create the Data Point
-            try:
-                e = Entity.objects.get(topic=topic)
-            except Entity.DoesNotExist:
-                entity_id = make_random_id(topic)
-                e = Entity(entity_id=entity_id, topic=topic, m_tags=[])
-                e.add_tag('id', entity_id, commit=False)
-            if not e.kv_tags or not e.kv_tags.get('dis'):
-                e.add_tag('dis', topic, commit=False)
-            for tag in tags:
-                # never tag with 'site' or 'equip'!
-                if tag != 'site' and tag != 'equip':
-                    if tag.get('remove') is True or tag.get('remove') == 'True':
-                        logging.info('*** remove tag %s', tag)
-                        if pretend:
-                            current_tag = None
-                            current_value = None
-                            tag_tag = tag.get('tag')
-                            if tag_tag in e.m_tags:
-                                current_tag = tag_tag
-                                current_value = 'type:MARKER'
-                            else:
-                                value = e.kv_tags.get(tag_tag)
-                                if value:
-                                    current_tag = tag_tag
-                                    current_value = value
-
-                            if current_tag:
-                                tt = removed_tags.get(topic)
-                                if not tt:
-                                    tt = {}
-                                tt[current_tag] = current_value
-
-                                removed_tags[topic] = tt
-
-                        e.remove_tag(tag.get('tag'), commit=False)
-                    else:
-                        logging.info('*** add tag %s', tag)
-                        if pretend:
-                            current_value = None
-                            tag_tag = tag.get('tag')
-                            if tag_tag in e.m_tags:
-                                current_value = 'type:MARKER'
-                            else:
-                                value = e.kv_tags.get(tag_tag)
-                                if value:
-                                    current_value = value
-
-                            tt = updated_tags.get(topic)
-                            if not tt:
-                                tt = {}
-                            if tag.get('value'):
-                                tt[tag.get('tag')] = {'new': tag.get('value'), 'previous': current_value}
-                            else:
-                                tt[tag.get('tag')] = {'new': 'type:MARKER', 'previous': current_value}
-
-                            updated_tags[topic] = tt
-                        e.add_tag(tag.get('tag'), value=tag.get('value'), commit=False)
-            # if tagged with an equipRef make sure the siteRef also matches
-            equip_ref = e.kv_tags.get('equipRef')
-            if equip_ref:
-                # let it fail if the equipment does not exist
-                equip = EquipmentView.objects.get(object_id=equip_ref)
-                if equip and equip.site_id:
-                    e.add_tag('siteRef', equip.site_id, commit=False)
-            if pretend:
-                updated_entities[topic] = e
-                logging.info('tag_topics: pretend changed %s %s %s', e, e.m_tags, e.kv_tags)
-            else:
-                e.save()
-            updated.append({'topic': topic, 'point': e.entity_id, 'name': e.kv_tags.get('dis')})
+    # the topics are tagged in chunks: one query for their entities and one for the
+    # referenced equipments, then the changes are saved in bulk and synced to Crate
+    # all at once at the end
+    with defer_crate_tag_sync():
+        for chunk in iter_topic_chunks(qs):
+            tag_topics_chunk(chunk, tags, pretend, updated, updated_entities, updated_tags, removed_tags)
 
     return updated, updated_entities, updated_tags, removed_tags
 
@@ -1167,11 +1968,85 @@ def create_equipment(equipment_name, action_fields):
 def link_points_to_equipments(new_equipments, new_equipments_topics):
     for equipment_name, equipment in new_equipments.items():
         topics = new_equipments_topics.get(equipment_name)
-        for topic in topics:
-            points = Entity.objects.filter(topic=topic)
-            if points:
-                for point in points:
-                    point.add_tag('equipRef',  equipment.kv_tags['id'], commit=True)
+        # update the points of each equipment in chunks
+        for i in range(0, len(topics), TAG_TOPICS_CHUNK_SIZE):
+            points = list(Entity.objects.filter(topic__in=topics[i:i + TAG_TOPICS_CHUNK_SIZE]))
+            for point in points:
+                point.add_tag('equipRef',  equipment.kv_tags['id'], commit=False)
+            bulk_save_entities(updated=points)
+
+
+def run_topic_tag_ruleset(rule_set, topic_filter=None, pretend=False, progress_observer=None):
+    # run all the rules of the rule set, see run_topic_tag_rules
+    return run_topic_tag_rules(rule_set.topictagrule_set.order_by('id'), topic_filter=topic_filter, pretend=pretend,
+                               progress_observer=progress_observer)
+
+
+def run_topic_tag_rules(rules, topic_filter=None, pretend=False, progress_observer=None):
+    # run the rules in order, returns
+    # (updated topics, updated entities, updated tags, removed tags, new equipments)
+    updated_set = set()
+    updated_entities = {}
+    updated_tags = {}
+    removed_tags = {}
+    new_equipments = []
+    rules = list(rules)
+    for i, rule in enumerate(rules):
+        if progress_observer:
+            progress_observer.set_progress(i, len(rules), description='Running rule {} ...'.format(rule.name))
+        rule_filters = rule.filters
+        # Add the topic_filter to the rule filters if given
+        if topic_filter:
+            tf = {'type': 'c', 'value': topic_filter}
+            if rule_filters:
+                rule_filters.append(tf)
+            else:
+                rule_filters = [tf]
+        if rule.tags:
+            updated, updated_curr_entities, updated_curr_tags, removed_curr_tags = tag_topics(
+                rule_filters, rule.tags, select_all=True, pretend=pretend)
+            for x in updated:
+                updated_set.add(x.get('topic'))
+
+            for key in updated_curr_entities.keys():
+                updated_curr_entity = updated_curr_entities.get(key, {})
+                topic = updated_curr_entity.topic
+                kv_tags = updated_curr_entity.kv_tags
+                m_tags = updated_curr_entity.m_tags
+                updated_entity = updated_entities.get(key, {})
+                updated_entity['topic'] = topic
+                updated_kv_tags = updated_entity.get('kv_tags', {})
+                updated_m_tags = updated_entity.get('m_tags', [])
+                for tag, value in kv_tags.items():
+                    updated_kv_tags[tag] = value
+                for tag in m_tags:
+                    if tag not in updated_m_tags:
+                        updated_m_tags.append(tag)
+
+                updated_entity['kv_tags'] = updated_kv_tags
+                updated_entity['m_tags'] = updated_m_tags
+
+                updated_entities[key] = updated_entity
+
+            for key, updated_curr_tag in updated_curr_tags.items():
+                updated_tag = updated_tags.get(key, {})
+                for tag, value in updated_curr_tag.items():
+                    updated_tag[tag] = value
+                updated_tags[key] = updated_tag
+
+            for key, removed_curr_tag in removed_curr_tags.items():
+                removed_tag = removed_tags.get(key, {})
+                for tag, value in removed_curr_tag.items():
+                    removed_tag[tag] = value
+                removed_tags[key] = removed_tag
+
+        if rule.action and rule.action_fields and not pretend:
+            if rule.action == 'create equipment':
+                new_equipments = create_equipment_action(rule_filters, rule.action_fields)
+
+    if progress_observer:
+        progress_observer.set_progress(len(rules), len(rules), description='Done.')
+    return updated_set, updated_entities, updated_tags, removed_tags, new_equipments
 
 
 def get_weather_station_for_location(latitude, longitude, as_object=True):
@@ -35,6 +35,7 @@ from ..models import SolarEdgeSetting
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import OperationalError
 from django.db.models import Q
 from django.db.models.functions import Lower
 from django.http import HttpResponse
@@ -57,6 +58,9 @@ from django.shortcuts import get_object_or_404
 
 logger = logging.getLogger(__name__)
 
+# maximum number of data point charts shown on the equipment page
+EQUIPMENT_MAX_CHARTS = 12
+
 
 def filter_equipments_by_permission(queryset, user):
     # for normal users only show equipments for sites they have permissions to
@@ -230,6 +234,15 @@ class EquipmentDetailView(LoginRequiredMixin, WithFilesAndNotesAndTagsMixin, Wit
             pass
 
         context['data_points'] = PointView.objects.filter(equipment_id=context['object'].object_id).count()
+        # chart the historized data points, their series are fetched all at once
+        charts = []
+        try:
+            his_points = PointView.objects.filter(equipment_id=context['object'].object_id)
+            his_points = his_points.filter(m_tags__contains=['his']).order_by('description')
+            charts = utils.charts_for_points(his_points[:EQUIPMENT_MAX_CHARTS])
+        except OperationalError:
+            logging.warning('Crate database unavailable')
+        context['charts'] = charts
         is_ahu = 0
         if 'ahu' in context['object'].m_tags:
             is_ahu = 1
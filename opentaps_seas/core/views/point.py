@@ -16,6 +16,7 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import csv
+import itertools
 import logging
 from datetime import datetime
 
@@ -44,6 +45,9 @@ from django_tables2.utils import A  # alias for Accessor
 
 logger = logging.getLogger(__name__)
 
+# maximum number of rows in the exported CSV files
+CSV_MAX_ROWS = 65535
+
 
 class PointTable(Table):
     description = LinkColumn('core:point_detail',
@@ -96,19 +100,45 @@ class PointDetailView(LoginRequiredMixin, WithFilesAndNotesAndTagsMixin, WithPoi
 point_detail_view = PointDetailView.as_view()
 
 
+def get_max_points_param(request):
+    max_points = request.GET.get('max_points')
+    if max_points:
+        try:
+            return int(max_points)
+        except ValueError:
+            logger.warning('Invalid max_points parameter: %s', max_points)
+    return utils.DEFAULT_MAX_POINTS
+
+
 def point_data_json(request, point, site=None, equip=None):
     if not request.user.is_authenticated:
         return JsonResponse({'error': 'Authentication required'}, status=401)
     resolution = request.GET.get('res')
     trange = request.GET.get('range')
+    max_points = get_max_points_param(request)
+    downsample = request.GET.get('downsample') or utils.DEFAULT_DOWNSAMPLE
     p = PointView.objects.get(entity_id=point)
     if p:
-        return JsonResponse({'values': utils.get_point_values(p, date_trunc=resolution, trange=trange)})
+        return JsonResponse({'values': utils.get_point_values(p, date_trunc=resolution, trange=trange,
+                                                              max_points=max_points, downsample=downsample)})
     else:
         logger.warning('No point found with entity_id = %s', point)
         return JsonResponse({'error': 'Point data not found {} : {}'.format(equip, point)}, status=404)
 
 
+def points_data_json(request):
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    resolution = request.GET.get('res')
+    trange = request.GET.get('range')
+    max_points = get_max_points_param(request)
+    point_ids = request.GET.getlist('point')
+    if not point_ids:
+        return JsonResponse({'error': 'Missing point parameter'}, status=400)
+    points = PointView.objects.filter(entity_id__in=point_ids)
+    return JsonResponse(utils.get_points_values(points, date_trunc=resolution, trange=trange, max_points=max_points))
+
+
 class Echo:
     """An object that implements just the write method of the file-like
     interface.
@@ -126,14 +156,16 @@ def point_data_csv(request, point, site=None, equip=None):
     p = get_object_or_404(PointView, entity_id=point)
     site = p.kv_tags['siteRef']
     equip = p.kv_tags['equipRef']
-    rows = utils.get_point_values(p, date_trunc=resolution, trange=trange)
-    # limit output
-    if len(rows) > 65535:
-        del rows[:65535]
+    start, end = utils.get_start_date_from_range(trange)
+    # stream the rows from Crate, limiting the output
+    rows = itertools.islice(utils.iter_point_values(p, start, end, date_trunc=resolution), CSV_MAX_ROWS)
 
+    # peek the first row for the file name
     last_timestamp = "0"
-    if len(rows) > 0:
-        last_timestamp = rows[:-1][0][0]
+    first_row = next(rows, None)
+    if first_row:
+        last_timestamp = first_row[0]
+        rows = itertools.chain([first_row], rows)
 
     value_title = 'value'
     if p.unit:
@@ -304,41 +304,42 @@ def site_pie_chart_data_json(request, site):
         hot_threshold = float(request.GET.get('hot_threshold'))
     else:
         hot_threshold = 75
-    for e in equipments:
-        data_points = PointView.objects.filter(equipment_id=e.object_id)
-        data_points = data_points.filter(m_tags__contains=['air', 'his', 'point', 'sensor', 'temp'])
-        data_points = data_points.exclude(m_tags__contains=['equip'])
-        try:
-            for d in utils.add_current_values(data_points, raw=True):
-                cv = d.current_value.get('value', 'N/A')
-                logger.info('site_pie_chart_data_json got value %s -> %s', d.entity_id, cv)
-                if isinstance(cv, str):
-                    try:
-                        cv = float(cv)
-                    except ValueError:
-                        cv = 'N/A'
-                if 'N/A' == cv or cv > 200 or cv < -50:
-                    if 'No Data' not in pie:
-                        pie['No Data'] = 1
-                    else:
-                        pie['No Data'] += 1
-                elif cv < cold_threshold:
-                    if 'Cold' not in pie:
-                        pie['Cold'] = 1
-                    else:
-                        pie['Cold'] += 1
-                elif cv > hot_threshold:
-                    if 'Hot' not in pie:
-                        pie['Hot'] = 1
-                    else:
-                        pie['Hot'] += 1
+    # fetch the data points of all the equipments at once so their current values
+    # can be read in a single batch
+    data_points = PointView.objects.filter(equipment_id__in=equipments.values('object_id'))
+    data_points = data_points.filter(m_tags__contains=['air', 'his', 'point', 'sensor', 'temp'])
+    data_points = data_points.exclude(m_tags__contains=['equip'])
+    try:
+        for d in utils.add_current_values(data_points, raw=True):
+            cv = d.current_value.get('value', 'N/A')
+            logger.info('site_pie_chart_data_json got value %s -> %s', d.entity_id, cv)
+            if isinstance(cv, str):
+                try:
+                    cv = float(cv)
+                except ValueError:
+                    cv = 'N/A'
+            if 'N/A' == cv or cv > 200 or cv < -50:
+                if 'No Data' not in pie:
+                    pie['No Data'] = 1
+                else:
+                    pie['No Data'] += 1
+            elif cv < cold_threshold:
+                if 'Cold' not in pie:
+                    pie['Cold'] = 1
+                else:
+                    pie['Cold'] += 1
+            elif cv > hot_threshold:
+                if 'Hot' not in pie:
+                    pie['Hot'] = 1
                 else:
-                    if 'Comfortable' not in pie:
-                        pie['Comfortable'] = 1
-                    else:
-                        pie['Comfortable'] += 1
-        except OperationalError:
-            logging.warning('Crate database unavailable')
+                    pie['Hot'] += 1
+            else:
+                if 'Comfortable' not in pie:
+                    pie['Comfortable'] = 1
+                else:
+                    pie['Comfortable'] += 1
+    except OperationalError:
+        logging.warning('Crate database unavailable')
 
     labels = []
     values = []
@@ -27,6 +27,7 @@ from urllib.parse import urlparse
 from zipfile import ZipFile
 
 from .common import WithBreadcrumbsMixin
+from .. import tasks
 from .. import utils
 from ..models import Entity, EntityPermission
 from ..models import EquipmentView
@@ -44,7 +45,6 @@ from ..forms.topic import TopicTagRuleCreateForm
 from ..forms.topic import TopicTagRuleSetRunForm
 from ..forms.topic import TopicTagRuleRunForm
 
-from django.core.paginator import Paginator
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
@@ -72,7 +72,6 @@ from django_tables2 import CheckBoxColumn
 from django_tables2 import Column
 from django_tables2 import LinkColumn
 from django_tables2 import Table
-from django_tables2.config import RequestConfig
 from django_tables2.utils import A  # alias for Accessor
 from django_tables2.views import SingleTableMixin
 from rest_framework.decorators import api_view
@@ -326,12 +325,39 @@ def topic_list_table(request):
                          filter_op, filter_field, filter_type, filter_value)
             q_filters.append((filter_field, filter_type, filter_value, filter_op))
     qs = utils.apply_filters_to_queryset(qs, q_filters)
-
-    rc = RequestConfig(request, paginate={'per_page': 15})
-    table = TopicTable(qs, orderable=True, order_by='topic')
-    table = rc.configure(table)
+    count = utils.count_topics(qs, utils.topic_list_key(q_filters, select_not_mapped_topics))
+
+    # all the columns show the topic, so any sort is by topic and the pages are read
+    # by keyset like in TopicListJsonView: the next link has the last topic of the page
+    # as its cursor, and the previous pages cursors are cached by get_topics_page
+    per_page = 15
+    sort = request.GET.get('sort') or 'topic'
+    desc = sort.startswith('-')
+    qs = qs.order_by('-topic' if desc else 'topic')
+    cursor_param = 'before' if desc else 'after'
+    page = utils.CountedPaginator(qs, per_page, count=count).get_page(request.GET.get('page'))
+    topics_list, next_cursor = utils.get_topics_page(
+        qs, utils.topic_list_key(q_filters, select_not_mapped_topics, sort, per_page),
+        page.number, per_page, count, cursor=request.GET.get(cursor_param), desc=desc)
+
+    table = TopicTable([Topic(**item) for item in topics_list], orderable=True, order_by=sort,
+                       template_name='core/_topic_table.html')
+    table.page_number = page.number
+    table.num_pages = page.paginator.num_pages
+    table.previous_querystring = None
+    table.next_querystring = None
+    if page.has_previous():
+        params = request.GET.copy()
+        params['page'] = page.previous_page_number()
+        params.pop(cursor_param, None)
+        table.previous_querystring = '?' + params.urlencode()
+    if page.has_next() and next_cursor is not None:
+        params = request.GET.copy()
+        params['page'] = page.next_page_number()
+        params[cursor_param] = next_cursor
+        table.next_querystring = '?' + params.urlencode()
     resp = HttpResponse(table.as_html(request))
-    resp['topics_counter'] = str(len(qs))
+    resp['topics_counter'] = str(count)
     return resp
 
 
@@ -387,12 +413,17 @@ class TopicListJsonView(LoginRequiredMixin, ListView):
 
         per_page = self.request.GET.get('per_page') or 10
         page = self.request.GET.get('page') or 1
-        paginator = Paginator(qs, per_page)
+        cursor = self.request.GET.get('cursor')
 
-        logging.info('TopicListJsonView render_to_response DONE')
-        topics_list = paginator.get_page(page).object_list.values()
         data = []
         try:
+            count = utils.count_topics(qs, utils.topic_list_key(q_filters, select_not_mapped_topics))
+            # only the topic sort is unique, other sorts use OFFSET
+            topics_list, next_cursor = utils.get_topics_page(
+                qs, utils.topic_list_key(q_filters, select_not_mapped_topics, sort_by, per_page),
+                page, per_page, count, cursor=cursor,
+                keyset=sort_by in ('topic', '-topic'), desc=sort_by.startswith('-'))
+            logging.info('TopicListJsonView render_to_response DONE')
             for item in topics_list:
                 p = utils.get_topic_point(item['topic'])
                 if p:
@@ -402,7 +433,7 @@ class TopicListJsonView(LoginRequiredMixin, ListView):
         except Exception:
             return JsonResponse({'error': 'Cannot get topics sorted by {}'.format(sort_by)})
 
-        response = {'data': data, 'count': paginator.count}
+        response = {'data': data, 'count': count, 'next_cursor': next_cursor}
         if 'topic_fields' in self.request.session:
             response['topic_fields'] = self.request.session['topic_fields']
 
@@ -833,14 +864,36 @@ class TopicTagRuleSetRunView(LoginRequiredMixin, TopicTagRuleSetBCMixin, FormVie
             context['errors'] = errors
         return self.render_to_response(context)
 
+    def run_async(self, form):
+        # previews stay synchronous since their report is rendered by this server
+        kwargs = {
+            'ruleset_id': form.cleaned_data['ruleset_id'],
+            'topic_filter': form.cleaned_data['topic_filter'],
+        }
+        try:
+            async_res = tasks.run_topic_tag_ruleset_task.delay(kwargs)
+            logger.info('Started async run of the topic tag rule set %s', kwargs)
+        except Exception as e:
+            # this could fail if Celery has issues in which case the run is done synchronously
+            logger.error('Could not start an async job to run the topic tag rule set: %s', e)
+            return None
+        return JsonResponse({'success': 'async', 'task_id': async_res.task_id,
+                             'progress_url': reverse("core:get_task_progress",
+                                                     kwargs={'task_id': async_res.task_id})})
+
     def post(self, request, *args, **kwargs):
         form = self.get_form()
         if form.is_valid():
+            if form.cleaned_data['use_async'] and not form.cleaned_data['preview_type']:
+                response = self.run_async(form)
+                if response:
+                    return response
             updated_set, updated_entities, preview_type, updated_tags, removed_tags, diff_format, new_eqm = form.save()
             if preview_type:
                 if diff_format:
                     report_rows, report_header = utils.tag_rulesets_run_report_diff(
-                                                       updated_entities, updated_tags, removed_tags)
+                                                       updated_entities, updated_tags, removed_tags,
+                                                       report_tags=form.report_tags)
                     if not report_rows:
                         messages.error(self.request, "Preview diff is empty")
                         context = self.get_context_data(**kwargs)
@@ -878,7 +931,8 @@ class TopicTagRuleSetRunView(LoginRequiredMixin, TopicTagRuleSetBCMixin, FormVie
 
                         return response
                 else:
-                    report_rows, report_header = utils.tag_rulesets_run_report(updated_entities)
+                    report_rows, report_header = utils.tag_rulesets_run_report(
+                        updated_entities, report_tags=form.report_tags)
                     if preview_type == 'preview_csv':
                         response = HttpResponse(content_type='text/csv')
                         response['Content-Disposition'] = 'attachment; filename="TagRulesetsPreviewReport.csv"'
@@ -995,7 +1049,8 @@ class TopicTagRuleRunView(LoginRequiredMixin, TopicTagRuleBCMixin, FormView):
             if preview_type:
                 if diff_format:
                     report_rows, report_header = utils.tag_rulesets_run_report_diff(
-                                                       updated_entities, updated_tags, removed_tags)
+                                                       updated_entities, updated_tags, removed_tags,
+                                                       report_tags=form.report_tags)
                     if not report_rows:
                         messages.error(self.request, "Preview diff is empty")
                         context = self.get_context_data(**kwargs)
@@ -1033,7 +1088,8 @@ class TopicTagRuleRunView(LoginRequiredMixin, TopicTagRuleBCMixin, FormView):
 
                         return response
                 else:
-                    report_rows, report_header = utils.tag_rulesets_run_report(updated_entities)
+                    report_rows, report_header = utils.tag_rulesets_run_report(
+                        updated_entities, report_tags=form.report_tags)
                     if preview_type == 'preview_csv':
                         response = HttpResponse(content_type='text/csv')
                         response['Content-Disposition'] = 'attachment; filename="TagRulePreviewReport.csv"'
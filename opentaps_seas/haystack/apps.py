@@ -22,3 +22,8 @@ class HaystackAppConfig(AppConfig):
 
     name = "opentaps_seas.haystack"
     verbose_name = "Haystack"
+
+    def ready(self):
+        # connects the signals invalidating the nav tree and the watched entities
+        from . import nav  # noqa F401
+        from . import watch  # noqa F401
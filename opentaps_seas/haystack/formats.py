@@ -0,0 +1,192 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import datetime
+import hszinc
+import io
+import json
+import math
+
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from hszinc.zincdumper import dump_row as dump_zinc_row
+from hszinc.zincdumper import dump_scalar as dump_zinc_scalar
+
+# The grid formats supported by the Haystack views, the first one is the default.
+MODE_ZINC = 'text/zinc'
+MODE_JSON = 'application/json'
+MODE_CSV = 'text/csv'
+FORMATS = [MODE_ZINC, MODE_JSON, MODE_CSV]
+
+CSV_MARKER = u'✓'
+
+
+def negotiate(request):
+    # returns the grid format to respond with given the Accept header, media ranges
+    # are tried by quality then order and anything unsupported falls back to Zinc
+    accepted = []
+    for i, media_range in enumerate(request.META.get('HTTP_ACCEPT', '').split(',')):
+        parts = media_range.strip().split(';')
+        mime = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            k, _, v = param.partition('=')
+            if k.strip() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0
+        if mime and q > 0:
+            accepted.append((-q, i, mime))
+    for (_, _, mime) in sorted(accepted):
+        if mime in FORMATS:
+            return mime
+        if mime in ('*/*', 'text/*'):
+            return MODE_ZINC
+    return MODE_ZINC
+
+
+def json_scalar(value):
+    # Haystack JSON encoding, strings are only prefixed when they could be read as another type
+    if value is None:
+        return None
+    if value is hszinc.MARKER:
+        return 'm:'
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, hszinc.Ref):
+        if value.has_value:
+            return u'r:{} {}'.format(value.name, value.value)
+        return u'r:{}'.format(value.name)
+    if isinstance(value, hszinc.Uri):
+        return u'u:{}'.format(value)
+    if isinstance(value, hszinc.Bin):
+        return u'b:{}'.format(value)
+    if isinstance(value, str):
+        if len(value) > 1 and value[1] == ':':
+            return u's:{}'.format(value)
+        return value
+    if isinstance(value, hszinc.Quantity):
+        if value.unit:
+            return u'n:{} {}'.format(_json_number(value.value), value.unit)
+        return u'n:{}'.format(_json_number(value.value))
+    if isinstance(value, (int, float)):
+        return u'n:{}'.format(_json_number(value))
+    if isinstance(value, datetime.datetime):
+        return u't:{}'.format(dump_zinc_scalar(value))
+    if isinstance(value, datetime.date):
+        return u'd:{}'.format(value.isoformat())
+    if isinstance(value, datetime.time):
+        return u'h:{}'.format(value.isoformat())
+    if isinstance(value, hszinc.Coordinate):
+        return u'c:{},{}'.format(value.latitude, value.longitude)
+    if isinstance(value, list):
+        return [json_scalar(v) for v in value]
+    if isinstance(value, dict):
+        return {k: json_scalar(v) for k, v in value.items()}
+    return dump_zinc_scalar(value)
+
+
+def _json_number(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return 'INF' if value > 0 else '-INF'
+        if value.is_integer():
+            return str(int(value))
+    return str(value)
+
+
+def csv_scalar(value):
+    # Haystack CSV encoding: plain strings, a check mark for markers and Zinc for the rest
+    if value is None:
+        return ''
+    if value is hszinc.MARKER:
+        return CSV_MARKER
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, hszinc.Ref):
+        if value.has_value:
+            return u'@{} {}'.format(value.name, value.value)
+        return u'@{}'.format(value.name)
+    if isinstance(value, str):
+        return value
+    return dump_zinc_scalar(value)
+
+
+def _csv_line(values):
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerow(values)
+    return out.getvalue()
+
+
+def dump_chunks(grid, rows, mime):
+    # yields the encoded grid, the header first then one chunk per row so that
+    # large grids can be streamed without being held in memory
+    columns = list(grid.column.keys())
+    if mime == MODE_JSON:
+        meta = {'ver': '2.0'}
+        meta.update({k: json_scalar(v) for k, v in grid.metadata.items()})
+        cols = []
+        for c, c_meta in grid.column.items():
+            col = {k: json_scalar(v) for k, v in c_meta.items()}
+            col['name'] = c
+            cols.append(col)
+        yield '{{"meta":{},"cols":{},"rows":['.format(json.dumps(meta), json.dumps(cols))
+        sep = ''
+        for row in rows:
+            yield sep + json.dumps({c: json_scalar(row[c]) for c in columns if row.get(c) is not None})
+            sep = ','
+        yield ']}'
+    elif mime == MODE_CSV:
+        # the header uses the column dis when given
+        yield _csv_line([grid.column[c].get('dis', c) for c in columns])
+        for row in rows:
+            yield _csv_line([csv_scalar(row.get(c)) for c in columns])
+    else:
+        # dumping the grid without rows gives the header and columns lines
+        header = hszinc.Grid()
+        header.metadata.update(grid.metadata)
+        for c, c_meta in grid.column.items():
+            header.column[c] = c_meta
+        yield hszinc.dump(header)
+        for row in rows:
+            yield dump_zinc_row(grid, row) + '\n'
+
+
+def dump_grid(grid, mime=MODE_ZINC):
+    if mime == MODE_ZINC:
+        return hszinc.dump(grid)
+    return ''.join(dump_chunks(grid, grid, mime))
+
+
+def content_type(mime):
+    return '{};charset=utf-8'.format(mime)
+
+
+def grid_response(request, grid, rows=None, **kwargs):
+    # the grid in the format negotiated with the client, when rows are given they
+    # are streamed after the grid metadata and columns
+    mime = negotiate(request)
+    if len(grid.column) == 0:
+        # trick to get an empty grid without crashing the dumper
+        grid.column['empty'] = {}
+    if rows is None:
+        return HttpResponse(dump_grid(grid, mime), content_type=content_type(mime), **kwargs)
+    return StreamingHttpResponse(dump_chunks(grid, rows, mime), content_type=content_type(mime), **kwargs)
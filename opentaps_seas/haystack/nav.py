@@ -0,0 +1,155 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import hszinc
+import logging
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from ..core.models import Entity
+from ..core.models import entities_bulk_saved
+from .formats import MODE_ZINC
+from .formats import dump_grid
+
+logger = logging.getLogger(__name__)
+
+# The nav tree is cached as the encoded grid of the children of each node, per format
+# and under keys including a version which changes every time an Entity is saved or deleted.
+NAV_VERSION_KEY = 'haystack_nav_version'
+NAV_KEY_PREFIX = 'haystack_nav:'
+# the navId of the tree root, which lists the sites
+NAV_ROOT = None
+
+
+def _nav_key(version, mime, nav_id):
+    if nav_id is NAV_ROOT:
+        return '{}{}:{}:root'.format(NAV_KEY_PREFIX, version, mime)
+    return '{}{}:{}:{}'.format(NAV_KEY_PREFIX, version, mime, hashlib.md5(nav_id.encode('utf-8')).hexdigest())
+
+
+def _nav_grid(rows, mime):
+    g = hszinc.Grid()
+    g.column['navId'] = {}
+    columns = set()
+    for row in rows:
+        columns.update(row.keys())
+    for c in sorted(columns):
+        if c not in g.column:
+            g.column[c] = {}
+    g.extend(rows)
+    return dump_grid(g, mime)
+
+
+def build_nav_tree():
+    # returns {navId: [child rows]} for the root, the sites and the equipments, in one
+    # pass over the entities:
+    # - root -> the sites
+    # - site -> the entities with its siteRef and no equipRef
+    # - equip -> the entities with its equipRef
+    nodes = {}
+    by_site = {}
+    by_equip = {}
+    sites = []
+    equips = {}
+    qs = Entity.objects.filter(
+        Q(m_tags__contains=['site']) | Q(kv_tags__has_key='siteRef') | Q(kv_tags__has_key='equipRef'))
+    for (entity_id, kv_tags, m_tags) in qs.values_list('entity_id', 'kv_tags', 'm_tags').order_by('entity_id'):
+        kv_tags = kv_tags or {}
+        m_tags = m_tags or []
+        e_data = dict(kv_tags)
+        for f in m_tags:
+            e_data[f] = hszinc.MARKER
+        e_data['navId'] = entity_id
+        nodes[entity_id] = e_data
+
+        # children are linked by the id tag of their parent
+        eid = kv_tags.get('id', entity_id)
+        if 'site' in m_tags:
+            sites.append(entity_id)
+        elif 'equip' in m_tags:
+            equips[entity_id] = eid
+        if 'equipRef' in kv_tags:
+            by_equip.setdefault(kv_tags['equipRef'], []).append(e_data)
+        elif 'siteRef' in kv_tags:
+            by_site.setdefault(kv_tags['siteRef'], []).append(e_data)
+
+    tree = {NAV_ROOT: [nodes[s] for s in sites]}
+    for entity_id in sites:
+        eid = nodes[entity_id].get('id', entity_id)
+        tree[entity_id] = by_site.get(eid, [])
+    for entity_id, eid in equips.items():
+        tree[entity_id] = by_equip.get(eid, [])
+    return tree
+
+
+def get_nav_grid(nav_id=NAV_ROOT, mime=MODE_ZINC):
+    # returns the encoded grid of the children of the given node, or None when
+    # the node is not a site or equipment or has no children
+    version = cache.get(NAV_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(NAV_VERSION_KEY, version, None)
+
+    # the built key lists the keys of the nodes having children, a node listed there but
+    # missing from the cache was evicted on its own and the tree is built again
+    built_key = '{}{}:{}:built'.format(NAV_KEY_PREFIX, version, mime)
+    key = _nav_key(version, mime, nav_id)
+    built = cache.get(built_key)
+    if built is not None:
+        if key not in built:
+            return None
+        grid = cache.get(key)
+        if grid is not None:
+            return grid
+
+    logger.info('get_nav_grid: building the %s nav tree for version %s', mime, version)
+    tree = build_nav_tree()
+    grids = {}
+    for node_id, rows in tree.items():
+        if rows:
+            grids[_nav_key(version, mime, node_id)] = _nav_grid(rows, mime)
+    cache.set_many(grids, settings.HAYSTACK_NAV_CACHE_TTL)
+    # set last so the nodes are cached whenever it is
+    cache.set(built_key, frozenset(grids.keys()), settings.HAYSTACK_NAV_CACHE_TTL)
+    return grids.get(key)
+
+
+def invalidate_nav_tree():
+    # the cached grids of the previous version just expire
+    cache.set(NAV_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+@receiver(post_save, sender=Entity, dispatch_uid='haystack_nav_entity_post_save_signal')
+def entity_saved(sender, instance, using, **kwargs):
+    invalidate_nav_tree()
+
+
+@receiver(post_delete, sender=Entity, dispatch_uid='haystack_nav_entity_post_delete_signal')
+def entity_deleted(sender, instance, using, **kwargs):
+    invalidate_nav_tree()
+
+
+@receiver(entities_bulk_saved, sender=Entity, dispatch_uid='haystack_nav_entities_bulk_saved_signal')
+def entities_saved(sender, entities, **kwargs):
+    invalidate_nav_tree()
@@ -23,7 +23,10 @@ from .views import (
     ops_view,
     nav_view,
     hisread_view,
-    read_view
+    read_view,
+    watchsub_view,
+    watchunsub_view,
+    watchpoll_view
 )
 
 app_name = "haystack"
@@ -34,4 +37,7 @@ urlpatterns = [
     path("nav", view=nav_view, name="nav"),
     path("hisRead", view=hisread_view, name="hisRead"),
     path("read", view=read_view, name="read"),
+    path("watchSub", view=watchsub_view, name="watchSub"),
+    path("watchUnsub", view=watchunsub_view, name="watchUnsub"),
+    path("watchPoll", view=watchpoll_view, name="watchPoll"),
 ]
@@ -15,6 +15,8 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+from functools import lru_cache
+
 from .common import ParseException
 from .hbool import HBool
 from .href import HRef
@@ -37,7 +39,7 @@ class HFilter(object):
     @classmethod
     def make(cls, s, checked=True):
         try:
-            return FilterParser(s).parse()
+            return parse_filter(s)
         except Exception as e:
             if not checked:
                 return None
@@ -155,37 +157,18 @@ class Pather(object):
 # Path is a simple name or a complex path using the "->" separator
 class Path(object):
     # Construct a new Path from string or throw ParseException
+    @staticmethod
     def make(path):
-        try:
-            # optimize for common single name case
-            try:
-                dash = path.index('-')
-            except ValueError:
-                return Path1(path)
-
-            # parse
-            s = 0
-            acc = []
-            while True:
-                n = path.substring(s, dash)
-                if len(n) == 0:
-                    raise Exception()
-                acc.append(n)
-                if path.charAt(dash+1) != '>':
-                    raise Exception()
-                s = dash + 2
-                try:
-                    dash = path.index('-', s)
-                except ValueError:
-                    n = path.substring(s, len(path))
-                    if len(n) == 0:
-                        raise Exception()
-                    acc.append(n)
-                    break
-            return PathN(path, acc)
-        except Exception as e:
-            raise
-        raise ParseException("Path: " + path)
+        # optimize for common single name case
+        if '-' not in path:
+            return Path1(path)
+
+        # parse
+        acc = path.split('->')
+        for n in acc:
+            if len(n) == 0 or '-' in n:
+                raise ParseException("Path: " + path)
+        return PathN(path, acc)
 
     def __len__(self):
         return self.size()
@@ -260,22 +243,21 @@ class PathFilter(HFilter):
         # default implementation
         if not pather:
             pather = Pather()
-        print('PathFilter::include', _dict)
-        print('PathFilter::include get from path', self.path, self.path.size())
-        print('PathFilter::include get', self.path.get(0))
         val = _dict.get(self.path.get(0), None)
-        print('PathFilter::include got val', val)
         if self.path.size() != 1:
             nt = _dict
-            for i in range(self.path.size()):
-                if not isinstance(val, HRef):
+            for i in range(1, self.path.size()):
+                # entity tags store the refs as the plain id string
+                if isinstance(val, HRef):
+                    val = val.val
+                if not isinstance(val, str):
                     val = None
                     break
-                nt = pather.find(val.val)
+                nt = pather.find(val)
                 if (nt is None):
                     val = None
                     break
-                val = nt.get(self.path.get(i), False)
+                val = nt.get(self.path.get(i), None)
         return self.doInclude(val)
 
     def doInclude(self, val):
@@ -291,7 +273,6 @@ class Has(PathFilter):
         super(Has, self).__init__(p)
 
     def doInclude(self, v):
-        print('Has::doInclude', v)
         return v is not None
 
     def toStr(self):
@@ -307,7 +288,6 @@ class Missing(PathFilter):
         super(Missing, self).__init__(p)
 
     def doInclude(self, v):
-        print('Missing::doInclude', v)
         return v is None
 
     def toStr(self):
@@ -324,7 +304,6 @@ class CmpFilter(PathFilter):
         self.val = val
 
     def toStr(self):
-        print('CmpFilter::toStr', type(self.val), self.val, self.path, self.cmpStr())
         return str(self.path) + self.cmpStr() + self.val.toZinc()
 
     def sameType(self, v):
@@ -346,7 +325,6 @@ class Eq(CmpFilter):
         return "=="
 
     def doInclude(self, v):
-        print('Eq::doInclude', type(v), v, type(self.val), self.val, v == self.val)
         return v is not None and v == self.val
 
 # //////////////////////////////////////////////////////////////////////////
@@ -362,7 +340,6 @@ class Ne(CmpFilter):
         return "!="
 
     def doInclude(self, v):
-        print('Ne::doInclude', v, self.val)
         return v is not None and not v == self.val
 
 # //////////////////////////////////////////////////////////////////////////
@@ -378,7 +355,6 @@ class Lt(CmpFilter):
         return "<"
 
     def doInclude(self, v):
-        print('Lt::doInclude', v, self.val)
         return v < self.val
 
 # //////////////////////////////////////////////////////////////////////////
@@ -394,7 +370,6 @@ class Le(CmpFilter):
         return "<="
 
     def doInclude(self, v):
-        print('Le::doInclude', v, self.val)
         return v <= self.val
 
 # //////////////////////////////////////////////////////////////////////////
@@ -410,7 +385,6 @@ class Gt(CmpFilter):
         return ">"
 
     def doInclude(self, v):
-        print('Gt::doInclude', type(v), v, type(self.val), self.val, v > self.val)
         return v > self.val
 
 # //////////////////////////////////////////////////////////////////////////
@@ -426,7 +400,6 @@ class Ge(CmpFilter):
         return ">="
 
     def doInclude(self, v):
-        print('Ge::doInclude', v, self.val)
         return v >= self.val
 
 # //////////////////////////////////////////////////////////////////////////
@@ -471,7 +444,6 @@ class And(CompoundFilter):
         return "and"
 
     def include(self, _dict, pather):
-        print('And::include', self.a, self.b)
         return self.a.include(_dict, pather) and self.b.include(_dict, pather)
 
 # //////////////////////////////////////////////////////////////////////////
@@ -487,13 +459,22 @@ class Or(CompoundFilter):
         return "or"
 
     def include(self, _dict, pather):
-        print('Or::include', self.a, self.b)
         return self.a.include(_dict, pather) or self.b.include(_dict, pather)
 
+
 # //////////////////////////////////////////////////////////////////////////
 # // FilterParser
 # //////////////////////////////////////////////////////////////////////////
 
+# Parsed filters are immutable so they are kept by filter string, the same queries
+# being repeated by the dashboards. Invalid filters raise and are not cached.
+FILTER_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def parse_filter(s):
+    return FilterParser(s).parse()
+
 
 class FilterParser:
     def __init__(self, _in):
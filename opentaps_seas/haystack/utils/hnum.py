@@ -36,7 +36,8 @@ class HNum(HVal):
             return math.nan
         if isinstance(val, str):
             try:
-                val = float(re.sub("[^0-9-]", "", val))
+                # ignore the unit and thousands separators, eg: 1000 for "1,000ft²" and 72.5 for "72.5°F"
+                val = float(re.sub("[^0-9.-]", "", val))
             except Exception:
                 if error:
                     raise
@@ -0,0 +1,189 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import hszinc
+
+from django.contrib.postgres.fields.hstore import KeyTransform
+from django.db.models import F
+from django.db.models import FloatField
+from django.db.models import Func
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from ...core.models import Entity
+from .hfilter import And
+from .hfilter import CmpFilter
+from .hfilter import Eq
+from .hfilter import Ge
+from .hfilter import Gt
+from .hfilter import Has
+from .hfilter import Le
+from .hfilter import Lt
+from .hfilter import Missing
+from .hfilter import Ne
+from .hfilter import Or
+from .hfilter import Pather
+from .hnum import HNum
+
+
+# The numeric value of a tag as compared by HNum, eg: 1000 for "1,000ft²" and 72.5 for "72.5°F",
+# or NULL when HNum.to_num cannot convert it, then HNum compares the strings instead: those are
+# never equal, and ordering comparisons on them are not supported (they never match in SQL).
+class HNumValue(Func):
+    output_field = FloatField()
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        # same as HNum.to_num: strip all but digits, dots and minus then parse as a float
+        digits = "regexp_replace({}, '[^0-9.-]', '', 'g')".format(sql)
+        sql = "CASE WHEN {0} ~ '^-?([0-9]+(\\.[0-9]*)?|\\.[0-9]+)$' THEN CAST({0} AS double precision) END".format(
+            digits)
+        return sql, list(params) * 2
+
+
+# Compiles a HFilter into a Q filtering Entity rows, matching what HFilter.include
+# does on the Entity dict: kv_tags values, m_tags as markers and the id falling back
+# to the entity_id.
+# Paths using "->" cannot be resolved in SQL, the compiled filter is then only a
+# pre filter and exact is False so HFilter.include must still check the results.
+class HFilterCompiler(object):
+
+    def __init__(self):
+        self.annotations = {}
+        self.exact = True
+
+    def compile(self, h_filter):
+        # returns a Q or None which means no restriction
+        if isinstance(h_filter, And):
+            a = self.compile(h_filter.a)
+            b = self.compile(h_filter.b)
+            if a is None:
+                return b
+            if b is None:
+                return a
+            return a & b
+        if isinstance(h_filter, Or):
+            a = self.compile(h_filter.a)
+            b = self.compile(h_filter.b)
+            if a is None or b is None:
+                return None
+            return a | b
+        if h_filter.path.size() != 1:
+            self.exact = False
+            # the path can only resolve when its first ref is set
+            if isinstance(h_filter, Missing):
+                return None
+            return Q(kv_tags__has_key=h_filter.path.get(0))
+
+        name = h_filter.path.get(0)
+        if isinstance(h_filter, Has):
+            return self.has(name)
+        if isinstance(h_filter, Missing):
+            return ~self.has(name)
+        if isinstance(h_filter, CmpFilter):
+            return self.cmp(name, h_filter)
+
+        self.exact = False
+        return None
+
+    def has(self, name):
+        if name == 'id':
+            # always set since it falls back to the entity_id
+            return Q(entity_id__isnull=False)
+        return Q(kv_tags__has_key=name) | Q(m_tags__contains=[name])
+
+    def value(self, name, numeric):
+        # annotate the tag value and return the annotation name to filter on
+        alias = '_hf_{}{}'.format(len(self.annotations), '_num' if numeric else '')
+        if name == 'id':
+            expression = Coalesce(KeyTransform('id', 'kv_tags'), F('entity_id'))
+        else:
+            expression = KeyTransform(name, 'kv_tags')
+        if numeric:
+            expression = HNumValue(expression)
+        self.annotations[alias] = expression
+        return alias
+
+    def cmp(self, name, h_filter):
+        numeric = isinstance(h_filter.val, HNum)
+        if numeric:
+            val = h_filter.val.val
+        else:
+            val = str(h_filter.val)
+        alias = self.value(name, numeric)
+        if isinstance(h_filter, Eq):
+            return Q(**{alias: val})
+        if isinstance(h_filter, Ne):
+            # markers are never equal to a value, nor are the values that are not numbers to a number
+            if numeric:
+                return self.has(name) & (~Q(**{alias: val}) | Q(**{alias + '__isnull': True}))
+            return (Q(**{alias + '__isnull': False}) & ~Q(**{alias: val})) | Q(m_tags__contains=[name])
+        if isinstance(h_filter, Lt):
+            return Q(**{alias + '__lt': val})
+        if isinstance(h_filter, Le):
+            return Q(**{alias + '__lte': val})
+        if isinstance(h_filter, Gt):
+            return Q(**{alias + '__gt': val})
+        if isinstance(h_filter, Ge):
+            return Q(**{alias + '__gte': val})
+
+        self.exact = False
+        return None
+
+
+# Resolves the refs of "->" paths from an index of all the entities by id,
+# built with one query the first time it is needed and kept for the request.
+class EntityPather(Pather):
+
+    def __init__(self, qs=None):
+        self.qs = qs
+        self.index = None
+
+    def find(self, ref):
+        if self.index is None:
+            self.index = {}
+            qs = self.qs
+            if qs is None:
+                qs = Entity.objects.all()
+            for (entity_id, kv_tags, m_tags) in qs.values_list('entity_id', 'kv_tags', 'm_tags').iterator():
+                e_data = entity_data(entity_id, kv_tags, m_tags)
+                self.index[e_data['id']] = e_data
+        return self.index.get(ref)
+
+
+def entity_data(entity_id, kv_tags, m_tags):
+    # the dict of the entity tags as checked by HFilter.include
+    e_data = {}
+    if kv_tags:
+        e_data.update(kv_tags)
+    for f in m_tags or []:
+        e_data[f] = hszinc.MARKER
+    # by default uses the id tag, but fallback to entity_id
+    if 'id' not in e_data:
+        e_data['id'] = entity_id
+    return e_data
+
+
+def filter_entities(qs, h_filter):
+    # apply the HFilter to the Entity queryset, returns the filtered queryset
+    # and whether its results still need to be checked with HFilter.include
+    compiler = HFilterCompiler()
+    q = compiler.compile(h_filter)
+    if compiler.annotations:
+        qs = qs.annotate(**compiler.annotations)
+    if q is not None:
+        qs = qs.filter(q)
+    return qs, not compiler.exact
@@ -65,7 +65,6 @@ class HRef(HVal):
     #  Is the given character valid in the identifier part
     @classmethod
     def isIdChar(cls, ch):
-        print('?? Href::isIdChar ? ', ch)
         if ch is None:
             return False
         if (isinstance(ch, str)):
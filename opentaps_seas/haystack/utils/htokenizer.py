@@ -15,6 +15,8 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import re
+
 from .hnum import HNum
 from .hstr import HStr
 from .href import HRef
@@ -25,6 +27,19 @@ from .huri import HUri
 from .htoken import HaystackToken
 
 
+# The common tokens are matched with regular expressions from the current position,
+# anything else (dates, times, uris, escaped strings, hex numbers ...) falls back
+# to the char by char productions.
+WS_RE = re.compile(r'[ \t\xa0]+')
+ID_RE = re.compile(r'[a-zA-Z][a-zA-Z0-9_]*')
+REF_RE = re.compile(r'@([a-zA-Z0-9_:\-.~@]+)')
+STR_RE = re.compile(r'"([^"\\]*)"')
+# a decimal number with an optional unit, not followed by anything that could make it a date or time
+NUM_RE = re.compile(r'(?!0x)(-?[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)'
+                    r'([a-zA-Z%$/\u0080-\uffff][a-zA-Z0-9_%$/\u0080-\uffff]*)?'
+                    r'(?![a-zA-Z0-9_%$/\u0080-\uffff:.+\-])')
+
+
 #  * Stream based tokenizer for Haystack formats such as Zinc and Filters
 class HaystackTokenizer(object):
     # ////////////////////////////////////////////////////////////////////////
@@ -33,6 +48,8 @@ class HaystackTokenizer(object):
     def __init__(self, in_):
         self.cur = None
         self.peek = None
+        # index of cur in the input
+        self.pos = -2
         self.char_index = 0
         self.line = 1
         self.eof = None
@@ -56,8 +73,9 @@ class HaystackTokenizer(object):
         #  skip non-meaningful whitespace and comments
         while True:
             #  treat space, tab, non-breaking space as whitespace
-            if self.cur == ' ' or self.cur == '\t' or self.cur == 0xa0:
-                self.consume()
+            m = WS_RE.match(self.in_, self.pos)
+            if m:
+                self.seek(m.end())
                 continue
             #  comments
             if self.cur == '/':
@@ -83,12 +101,15 @@ class HaystackTokenizer(object):
             self.tok = self.str_()
         elif self.cur == '@':
             self.tok = self.ref()
-        elif self.isDigit(self.cur):
-            self.tok = self.num()
+        elif self.isDigit(self.cur) or (self.cur == '-' and self.isDigit(self.peek)):
+            m = NUM_RE.match(self.in_, self.pos)
+            if m:
+                self.seek(m.end())
+                self.tok = self.number(m.group(0), len(m.group(1)) if m.group(2) else 0)
+            else:
+                self.tok = self.num()
         elif self.cur == '`':
             self.tok = self.uri()
-        elif self.cur == '-' and self.isDigit(self.peek):
-            self.tok = self.num()
         else:
             self.tok = self.symbol()
         return self.tok
@@ -97,11 +118,9 @@ class HaystackTokenizer(object):
     #  Token Productions
     # ////////////////////////////////////////////////////////////////////////
     def id(self):
-        s = ''
-        while self.isIdPart(self.cur):
-            s += self.cur
-            self.consume()
-        self.val = s
+        m = ID_RE.match(self.in_, self.pos)
+        self.seek(m.end())
+        self.val = m.group(0)
         return HaystackToken.id
 
     @classmethod
@@ -134,7 +153,7 @@ class HaystackTokenizer(object):
             self.consume('0')
             self.consume('x')
             while True:
-                if isHex(self.cur):
+                if self.isHex(self.cur):
                     s += self.cur
                     self.consume()
                     continue
@@ -168,7 +187,7 @@ class HaystackTokenizer(object):
                         break
                 elif (self.cur == 'e' or self.cur == 'E') and (self.peek == '-' or self.peek == '+' or self.peek.isdigit()):
                     exp = True
-                elif self.cur.isalpha() or self.cur == '%' or self.cur == '$' or self.cur == '/' or self.cur > 128:
+                elif self.cur.isalpha() or self.cur == '%' or self.cur == '$' or self.cur == '/' or ord(self.cur) > 128:
                     if unitIndex == 0:
                         unitIndex = len(s)
                 elif self.cur == '_':
@@ -259,6 +278,12 @@ class HaystackTokenizer(object):
         return HaystackToken.num
 
     def str_(self):
+        m = STR_RE.match(self.in_, self.pos)
+        if m:
+            # no escape sequence
+            self.seek(m.end())
+            self.val = HStr.make(m.group(1))
+            return HaystackToken.str_
         self.consume('"')
         s = ''
         while True:
@@ -276,15 +301,11 @@ class HaystackTokenizer(object):
         return HaystackToken.str_
 
     def ref(self):
-        self.consume('@')
-        s = ''
-        while True:
-            if HRef.isIdChar(self.cur):
-                s += self.cur
-                self.consume()
-            else:
-                break
-        self.val = HRef.make(s, None)
+        m = REF_RE.match(self.in_, self.pos)
+        if not m:
+            raise self.err("Invalid id val: \"\"")
+        self.seek(m.end())
+        self.val = HRef.make(m.group(1), None)
         return HaystackToken.ref
 
     def uri(self):
@@ -480,12 +501,21 @@ class HaystackTokenizer(object):
     # ////////////////////////////////////////////////////////////////////////
     #  Char
     # ////////////////////////////////////////////////////////////////////////
+    def seek(self, pos):
+        # move cur to the given index of the input
+        n = len(self.in_)
+        self.pos = pos
+        self.cur = self.in_[pos] if pos < n else self.eof
+        self.peek = self.in_[pos + 1] if pos + 1 < n else None
+        self.char_index = pos + 2
+
     def consume(self, expected=None):
         if expected:
             if self.cur != expected:
                 raise self.err("Expected " + expected)
             self.consume()
         else:
+            self.pos += 1
             try:
                 self.cur = self.peek
                 if self.char_index >= len(self.in_):
@@ -17,26 +17,53 @@
 
 import hszinc
 import logging
+import pytz
+from datetime import datetime
 
 from django.contrib.sites.models import Site
+from django.db.models import CharField
+from django.db.models import F
+from django.db.models import Func
 from django.http import HttpResponse
 from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
 
 from ..core.models import Entity
 from ..core.models import PointView
 from ..core import utils
 from .utils.hfilter import HFilter
-from .utils.hfilter import Pather
+from . import watch
+from .formats import FORMATS
+from .formats import content_type
+from .formats import grid_response
+from .formats import negotiate
+from .nav import NAV_ROOT
+from .nav import get_nav_grid
+from .utils.hquery import EntityPather
+from .utils.hquery import entity_data
+from .utils.hquery import filter_entities
 
 
 logger = logging.getLogger(__name__)
 
 
-def _hzinc_response(data, **kwargs):
-    if len(data.column) == 0:
-        # trick to get an empty grid without crashing the dumper
-        data.column['empty'] = {}
-    return HttpResponse(hszinc.dump(data), content_type="text/zinc;charset=utf-8", **kwargs)
+def _add_columns(g, columns, first=None):
+    # set the grid columns, sorted with the given ones first
+    for c in first or []:
+        g.column[c] = {}
+    for c in sorted(columns):
+        if c not in g.column:
+            g.column[c] = {}
+
+
+def _entity_columns(qs):
+    # the distinct tag names of the given entities, computed by the DB
+    entities = Entity.objects.filter(entity_id__in=qs.values('entity_id'))
+    columns = set()
+    for field, function in (('kv_tags', 'skeys'), ('m_tags', 'unnest')):
+        tags = entities.annotate(tag=Func(F(field), function=function, output_field=CharField()))
+        columns.update(tags.values_list('tag', flat=True).distinct())
+    return columns
 
 
 def about_view(request):
@@ -62,7 +89,7 @@ def about_view(request):
         'serverTime': timezone.now(),
         'vendorName': 'Opentaps-SEAS Haystack'
     }])
-    return _hzinc_response(g)
+    return grid_response(request, g)
 
 
 def ops_view(request):
@@ -87,8 +114,17 @@ def ops_view(request):
     }, {
         'name': 'nav',
         'summary': 'Navigate record tree'
+    }, {
+        'name': 'watchSub',
+        'summary': 'Watch a set of records for changes'
+    }, {
+        'name': 'watchUnsub',
+        'summary': 'Stop watching records for changes'
+    }, {
+        'name': 'watchPoll',
+        'summary': 'Poll a watch for changes'
     }])
-    return _hzinc_response(g)
+    return grid_response(request, g)
 
 
 def formats_view(request):
@@ -97,91 +133,124 @@ def formats_view(request):
     g.column['read'] = {}
     g.column['write'] = {}
     g.extend([{
-        'mime': 'text/zinc',
+        'mime': mime,
         'read': hszinc.MARKER,
         'write': hszinc.MARKER
-    }])
-    return HttpResponse(hszinc.dump(g), content_type="text/zinc;charset=utf-8")
+    } for mime in FORMATS])
+    return grid_response(request, g)
 
 
 def nav_view(request):
-    g = hszinc.Grid()
-    navId = request.GET.get('navId')
-    root = None
-    if navId:
-        try:
-            root = Entity.objects.get(entity_id=navId)
-        except Entity.DoesNotExist:
-            return _hzinc_response(g, status=404)
-
-    entities = None
-    if root:
-        eid = root.entity_id
-        if 'id' in root.kv_tags:
-            eid = root.kv_tags['id']
-        # list the entities linked to root
-        if 'site' in root.m_tags:
-            entities = Entity.objects.filter(kv_tags__contains={'siteRef': eid}).exclude(kv_tags__has_key='equipRef')
-        elif 'equip' in root.m_tags:
-            entities = Entity.objects.filter(kv_tags__contains={'equipRef': eid})
-    else:
-        # list the sites
-        entities = Entity.objects.filter(m_tags__contains=['site'])
-
-    if not entities or len(entities) == 0:
-        return _hzinc_response(g, status=404)
-
-    # stores the entity_id
-    added_fields = []
-    data = []
-    g.column['navId'] = {}
-    # read which fields to include
-    for e in entities:
-        e_data = {'navId': e.entity_id}
-        if e.kv_tags:
-            for f in e.kv_tags.keys():
-                e_data[f] = e.kv_tags[f]
-                if f not in added_fields:
-                    added_fields.append(f)
-                    g.column[f] = {}
-
-        for f in e.m_tags:
-            e_data[f] = hszinc.MARKER
-            if f not in added_fields:
-                added_fields.append(f)
-                g.column[f] = {}
-
-        logger.info("nav_view: add data %s", e_data)
-        data.append(e_data)
-
-    # set the data
-    g.extend(data)
-    return _hzinc_response(g)
-
-
+    # the grids are precomputed for the whole tree, see nav.get_nav_grid
+    mime = negotiate(request)
+    grid = get_nav_grid(request.GET.get('navId') or NAV_ROOT, mime=mime)
+    if not grid:
+        return grid_response(request, hszinc.Grid(), status=404)
+    return HttpResponse(grid, content_type=content_type(mime))
+
+
+# hisRead interval parameter -> DATE_TRUNC resolution
+HISREAD_INTERVALS = {
+    'second': 'second',
+    '1s': 'second',
+    '1sec': 'second',
+    'minute': 'minute',
+    '1min': 'minute',
+    'hour': 'hour',
+    '1h': 'hour',
+    '1hr': 'hour',
+    'day': 'day',
+    '1d': 'day',
+    '1day': 'day'
+}
+# hisRead rollup parameter -> Crate aggregation function
+HISREAD_ROLLUPS = ['avg', 'min', 'max', 'sum', 'count']
+
+
+def _parse_zinc_grid(body):
+    # parse a request grid, depending on the version hszinc returns a list of grids
+    grid = hszinc.parse(body.decode('utf-8'))
+    if isinstance(grid, list):
+        grid = grid[0] if grid else None
+    return grid
+
+
+def _ref_name(ref):
+    # a Ref from a parsed grid or a string id from the query parameters
+    if isinstance(ref, hszinc.Ref):
+        return ref.name
+    return str(ref)
+
+
+@csrf_exempt
 def hisread_view(request):
     g = hszinc.Grid()
-    e_id = request.GET.get('id')
-    e_range = request.GET.get('range')
-    if not e_id or not e_range:
-        return _hzinc_response(g, status=404)
-
-    try:
-        e = PointView.objects.get(entity_id=e_id)
-    except PointView.DoesNotExist:
-        return _hzinc_response(g, status=404)
-
-    values = utils.get_point_values(e, trange=e_range, ts_as_datetime=True)
-
-    g.metadata['id'] = e.entity_id
+    # ids are given as parameters or as the rows of a posted grid, in which case
+    # the other parameters are in the grid metadata
+    params = request.GET
+    e_ids = request.GET.getlist('id')
+    if request.method == 'POST' and request.body:
+        try:
+            req = _parse_zinc_grid(request.body)
+        except Exception:
+            logger.exception('hisread_view: Error parsing the request grid')
+            return grid_response(request, g, status=400)
+        if req is not None:
+            params = {k: str(v) for k, v in req.metadata.items()}
+            e_ids = [_ref_name(row['id']) for row in req if row.get('id')]
+    e_range = params.get('range')
+    if not e_ids or not e_range:
+        return grid_response(request, g, status=404)
+
+    points = {p.entity_id: p for p in PointView.objects.filter(entity_id__in=e_ids)}
+    if len(points) < len(set(e_ids)):
+        return grid_response(request, g, status=404)
+
+    max_points = utils.DEFAULT_MAX_POINTS
+    if params.get('maxPoints'):
+        try:
+            max_points = int(params.get('maxPoints'))
+        except ValueError:
+            logger.exception('hisread_view: Error parsing maxPoints parameter')
+
+    # optional server side rollup, eg: interval=1h&rollup=max
+    date_trunc = HISREAD_INTERVALS.get(params.get('interval'), utils.DEFAULT_RES)
+    value_func = params.get('rollup')
+    if value_func not in HISREAD_ROLLUPS:
+        value_func = 'avg'
+
+    if len(e_ids) == 1:
+        e = points[e_ids[0]]
+        series = utils.get_point_series(e, date_trunc=date_trunc, value_func=value_func, trange=e_range,
+                                        max_points=max_points)
+
+        g.metadata['id'] = e.entity_id
+        g.column['ts'] = {}
+        g.column['val'] = {}
+        data = [{'ts': ts, 'val': val} for ts, val in zip(series.index.to_pydatetime(), series.tolist())]
+
+        g.extend(data)
+        return grid_response(request, g)
+
+    # multiple ids: one query for all the points and a ts, v0, v1 ... grid
+    e_ids = list(dict.fromkeys(e_ids))
+    values = utils.get_points_values([points[e_id] for e_id in e_ids], date_trunc=date_trunc,
+                                     value_func=value_func, trange=e_range, max_points=max_points)
     g.column['ts'] = {}
-    g.column['val'] = {}
-    data = []
-    for v in values:
-        data.append({'ts': v[0], 'val': v[1]})
+    columns = []
+    for i, e_id in enumerate(e_ids):
+        column = 'v{}'.format(i)
+        g.column[column] = {'id': hszinc.Ref(e_id)}
+        columns.append((column, values['values'][e_id]))
 
-    g.extend(data)
-    return _hzinc_response(g)
+    def rows():
+        for i, ts in enumerate(values['ts']):
+            row = {'ts': datetime.fromtimestamp(ts / 1000, tz=pytz.utc)}
+            for column, col_values in columns:
+                row[column] = col_values[i]
+            yield row
+
+    return grid_response(request, g, rows())
 
 
 def read_view(request):
@@ -190,7 +259,7 @@ def read_view(request):
     if not e_id:
         r_filter = request.GET.get('filter')
         if not r_filter:
-            return _hzinc_response(g, status=404)
+            return grid_response(request, g, status=404)
 
         r_limit = request.GET.get('limit')
         if r_limit:
@@ -212,49 +281,48 @@ def read_view(request):
         #  eg: siteRef=="@A"
         try:
             h_filter = HFilter.make(r_filter)
-            h_pather = Pather()
-
-            added_fields = []
+            h_pather = EntityPather()
+
+            # the filter is run by the DB, except for the "->" paths which
+            # still require checking each record
+            qs, check_include = filter_entities(Entity.objects.all(), h_filter)
+            qs = qs.order_by('entity_id')
+            if not check_include:
+                # the limited ids are fetched once so the columns are those of the streamed rows
+                ids = list(qs.values_list('entity_id', flat=True)[:r_limit])
+                qs = Entity.objects.filter(entity_id__in=ids).order_by('entity_id')
+                columns = _entity_columns(qs)
+                if ids:
+                    _add_columns(g, columns | {'id'}, first=['id'])
+
+                def rows():
+                    for e in qs.iterator():
+                        yield entity_data(e.entity_id, e.kv_tags, e.m_tags)
+
+                return grid_response(request, g, rows())
+
+            columns = set()
             data = []
-            n = 0
-            for e in Entity.objects.all():
-                # transform into a dict first
-                e_data = {}
-                if e.kv_tags:
-                    for f in e.kv_tags.keys():
-                        e_data[f] = e.kv_tags[f]
-
-                for f in e.m_tags:
-                    e_data[f] = hszinc.MARKER
-
-                # by default uses the id tag, but fallback to entity_id
-                if 'id' not in e_data:
-                    e_data['id'] = e.entity_id
-
-                if h_filter.include(e_data, h_pather):
-                    print('++++', e_data)
-                    for f in e_data.keys():
-                        if f not in added_fields:
-                            added_fields.append(f)
-                            g.column[f] = {}
-                    data.append(e_data)
-                    n += 1
-                    if (n >= r_limit):
-                        break
-
-                else:
-                    print('0000', e_data)
-
-            g.extend(data)
-            return _hzinc_response(g)
+            for e in qs.iterator():
+                e_data = entity_data(e.entity_id, e.kv_tags, e.m_tags)
+                if not h_filter.include(e_data, h_pather):
+                    continue
+
+                columns.update(e_data.keys())
+                data.append(e_data)
+                if (len(data) >= r_limit):
+                    break
+
+            _add_columns(g, columns, first=['id'] if data else None)
+            return grid_response(request, g, data)
         except Exception:
             logger.exception('read_view: Error filtering')
-            return _hzinc_response(g, status=500)
+            return grid_response(request, g, status=500)
 
     try:
         e = Entity.objects.get(entity_id=e_id)
     except Entity.DoesNotExist:
-        return _hzinc_response(g, status=404)
+        return grid_response(request, g, status=404)
 
     e_data = {}
     added_fields = []
@@ -274,4 +342,116 @@ def read_view(request):
         logger.info("read_view: read data %s", e_data)
 
     g.extend([e_data])
-    return _hzinc_response(g)
+    return grid_response(request, g)
+
+
+def _watch_request(request):
+    # the watch ops take a grid with the watch in the metadata and the ids as rows
+    if request.method != 'POST' or not request.body:
+        return None
+    return _parse_zinc_grid(request.body)
+
+
+def _lease_seconds(lease):
+    # the lease is a duration number, eg: 5min
+    if lease is None:
+        return None
+    value = getattr(lease, 'value', lease)
+    unit = getattr(lease, 'unit', None)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if unit in ('ms', 'millisecond'):
+        value = value / 1000
+    elif unit in ('min', 'minute'):
+        value = value * 60
+    elif unit in ('h', 'hr', 'hour'):
+        value = value * 3600
+    elif unit in ('day', 'd'):
+        value = value * 86400
+    return int(value)
+
+
+def _watch_response(request, watch_id, watch, records):
+    g = hszinc.Grid()
+    g.metadata['watchId'] = watch_id
+    g.metadata['lease'] = hszinc.Quantity(watch['lease'], 's')
+    columns = set()
+    for r in records:
+        columns.update(r.keys())
+    _add_columns(g, columns, first=['id'] if records else None)
+    g.extend(records)
+    return grid_response(request, g)
+
+
+def _watch_busy_response(request, e):
+    # a Haystack error grid when the watch stayed locked by other requests
+    logger.warning('%s', e)
+    g = hszinc.Grid()
+    g.metadata['err'] = hszinc.MARKER
+    g.metadata['dis'] = str(e)
+    return grid_response(request, g, status=503)
+
+
+@csrf_exempt
+def watchsub_view(request):
+    try:
+        req = _watch_request(request)
+    except Exception:
+        logger.exception('watchsub_view: Error parsing the request grid')
+        return grid_response(request, hszinc.Grid(), status=400)
+    if req is None:
+        return grid_response(request, hszinc.Grid(), status=400)
+
+    watch_id = req.metadata.get('watchId')
+    ids = [_ref_name(row['id']) for row in req if row.get('id')]
+    try:
+        res = watch.watch_sub(str(watch_id) if watch_id else None, ids, dis=req.metadata.get('watchDis'),
+                              lease=_lease_seconds(req.metadata.get('lease')))
+    except watch.WatchLockTimeout as e:
+        return _watch_busy_response(request, e)
+    if res is None:
+        return grid_response(request, hszinc.Grid(), status=404)
+    return _watch_response(request, *res)
+
+
+@csrf_exempt
+def watchunsub_view(request):
+    try:
+        req = _watch_request(request)
+    except Exception:
+        logger.exception('watchunsub_view: Error parsing the request grid')
+        return grid_response(request, hszinc.Grid(), status=400)
+    if req is None or not req.metadata.get('watchId'):
+        return grid_response(request, hszinc.Grid(), status=400)
+
+    watch_id = str(req.metadata.get('watchId'))
+    if 'close' in req.metadata:
+        watch.close_watch(watch_id)
+    else:
+        try:
+            watch.watch_unsub(watch_id, [_ref_name(row['id']) for row in req if row.get('id')])
+        except watch.WatchLockTimeout as e:
+            return _watch_busy_response(request, e)
+    return grid_response(request, hszinc.Grid())
+
+
+@csrf_exempt
+def watchpoll_view(request):
+    try:
+        req = _watch_request(request)
+    except Exception:
+        logger.exception('watchpoll_view: Error parsing the request grid')
+        return grid_response(request, hszinc.Grid(), status=400)
+    if req is None or not req.metadata.get('watchId'):
+        return grid_response(request, hszinc.Grid(), status=400)
+
+    watch_id = str(req.metadata.get('watchId'))
+    try:
+        res = watch.watch_poll(watch_id, refresh='refresh' in req.metadata)
+    except watch.WatchLockTimeout as e:
+        return _watch_busy_response(request, e)
+    if res is None:
+        return grid_response(request, hszinc.Grid(), status=404)
+    return _watch_response(request, watch_id, *res)
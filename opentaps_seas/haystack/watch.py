@@ -0,0 +1,247 @@
+# This file is part of opentaps Smart Energy Applications Suite (SEAS).
+
+# opentaps Smart Energy Applications Suite (SEAS) is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# opentaps Smart Energy Applications Suite (SEAS) is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with opentaps Smart Energy Applications Suite (SEAS).
+# If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from ..core.models import Entity
+from ..core.models import entities_bulk_saved
+from ..core import utils
+from .utils.hquery import entity_data
+
+logger = logging.getLogger(__name__)
+
+# Watches are kept in the cache for the duration of their lease as:
+# {'dis': watchDis, 'lease': seconds, 'ids': [entity_id], 'topics': {entity_id: topic},
+#  'versions': {entity_id: version of the entity}, 'values': {topic: ts of the last value}}
+# The version of each entity is changed by the Entity signals, so a poll only loads the
+# entities whose version changed or whose topic received a new value since its own last value.
+WATCH_KEY_PREFIX = 'haystack_watch:'
+ENTITY_VERSION_KEY_PREFIX = 'haystack_entity_version:'
+# an expired version only makes the entity be returned once more by the polls
+ENTITY_VERSION_TTL = 86400
+# the watch updates are serialized by a lock held at most that many seconds
+WATCH_LOCK_TIMEOUT = 30
+# how many seconds a request waits for the lock of its watch before giving up
+WATCH_LOCK_WAIT = 10
+
+
+class WatchLockTimeout(Exception):
+    pass
+
+
+def _watch_key(watch_id):
+    return WATCH_KEY_PREFIX + hashlib.md5(watch_id.encode('utf-8')).hexdigest()
+
+
+def _version_key(entity_id):
+    return ENTITY_VERSION_KEY_PREFIX + hashlib.md5(entity_id.encode('utf-8')).hexdigest()
+
+
+def get_entity_versions(entity_ids):
+    # returns {entity_id: version}, giving a new version to the entities without one
+    keys = {_version_key(entity_id): entity_id for entity_id in entity_ids}
+    versions = {keys[key]: version for key, version in cache.get_many(keys.keys()).items()}
+    missing = {key: uuid.uuid4().hex for key, entity_id in keys.items() if entity_id not in versions}
+    if missing:
+        cache.set_many(missing, ENTITY_VERSION_TTL)
+        versions.update({keys[key]: version for key, version in missing.items()})
+    return versions
+
+
+def touch_entities(entity_ids):
+    # the watches return those entities on their next poll
+    cache.set_many({_version_key(entity_id): uuid.uuid4().hex for entity_id in entity_ids}, ENTITY_VERSION_TTL)
+
+
+@receiver(post_save, sender=Entity, dispatch_uid='haystack_watch_entity_post_save_signal')
+def entity_saved(sender, instance, using, **kwargs):
+    touch_entities([instance.entity_id])
+
+
+@receiver(post_delete, sender=Entity, dispatch_uid='haystack_watch_entity_post_delete_signal')
+def entity_deleted(sender, instance, using, **kwargs):
+    touch_entities([instance.entity_id])
+
+
+@receiver(entities_bulk_saved, sender=Entity, dispatch_uid='haystack_watch_entities_bulk_saved_signal')
+def entities_saved(sender, entities, **kwargs):
+    touch_entities([e.entity_id for e in entities])
+
+
+def _cur_val(e, string_value):
+    kind = (e.kv_tags or {}).get('kind')
+    if kind == 'Bool':
+        return str(string_value).lower() in ('t', 'true', '1')
+    if kind == 'Number':
+        try:
+            return float(string_value)
+        except (TypeError, ValueError):
+            pass
+    return string_value
+
+
+@contextmanager
+def watch_lock(watch_id):
+    # a lock in the cache so concurrent requests on the same watch do not overwrite each other,
+    # it expires after WATCH_LOCK_TIMEOUT in case its holder died, and raises WatchLockTimeout
+    # if it could not be acquired within WATCH_LOCK_WAIT
+    key = _watch_key(watch_id) + ':lock'
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + WATCH_LOCK_WAIT
+    while not cache.add(key, token, WATCH_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise WatchLockTimeout('Timed out waiting for the lock of watch {}'.format(watch_id))
+        time.sleep(0.05)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def get_watch(watch_id):
+    return cache.get(_watch_key(watch_id))
+
+
+def save_watch(watch_id, watch):
+    cache.set(_watch_key(watch_id), watch, watch['lease'])
+
+
+def close_watch(watch_id):
+    cache.delete(_watch_key(watch_id))
+
+
+def watch_records(entities, last_values):
+    # the entity records as returned by read, with the current value of the points
+    records = []
+    for e in entities:
+        e_data = entity_data(e.entity_id, e.kv_tags, e.m_tags)
+        if e.topic and e.topic in last_values:
+            ts, string_value = last_values[e.topic]
+            e_data['curVal'] = _cur_val(e, string_value)
+            e_data['curTs'] = ts
+        records.append(e_data)
+    return records
+
+
+def _prune_values(watch):
+    # forget the last values of the topics no longer watched
+    topics = set(watch['topics'].values())
+    for topic in [t for t in watch['values'].keys() if t not in topics]:
+        del watch['values'][topic]
+
+
+def watch_sub(watch_id, ids, dis=None, lease=None):
+    # create the watch if watch_id is None or add the ids to it, returns
+    # (watch_id, watch, records of the subscribed entities) or None if the watch expired
+    if not watch_id:
+        watch_id = uuid.uuid4().hex
+        watch = {'dis': dis, 'lease': settings.HAYSTACK_WATCH_LEASE, 'ids': [], 'topics': {}, 'versions': {},
+                 'values': {}}
+        return _watch_sub(watch_id, watch, ids, lease)
+    with watch_lock(watch_id):
+        watch = get_watch(watch_id)
+        if watch is None:
+            return None
+        return _watch_sub(watch_id, watch, ids, lease)
+
+
+def _watch_sub(watch_id, watch, ids, lease):
+    if lease:
+        watch['lease'] = lease
+
+    entities = list(Entity.objects.filter(entity_id__in=ids))
+    versions = get_entity_versions([e.entity_id for e in entities])
+    last_values = utils.get_last_value_rows(list(set(e.topic for e in entities if e.topic)))
+    for e in entities:
+        if e.entity_id not in watch['ids']:
+            watch['ids'].append(e.entity_id)
+        watch['topics'][e.entity_id] = e.topic
+        watch['versions'][e.entity_id] = versions.get(e.entity_id)
+        if e.topic in last_values:
+            watch['values'][e.topic] = last_values[e.topic][0]
+    _prune_values(watch)
+    save_watch(watch_id, watch)
+    return watch_id, watch, watch_records(entities, last_values)
+
+
+def watch_unsub(watch_id, ids):
+    with watch_lock(watch_id):
+        watch = get_watch(watch_id)
+        if watch is None:
+            return
+        watch['ids'] = [i for i in watch['ids'] if i not in ids]
+        for i in ids:
+            watch['versions'].pop(i, None)
+            watch['topics'].pop(i, None)
+        _prune_values(watch)
+        save_watch(watch_id, watch)
+
+
+def watch_poll(watch_id, refresh=False):
+    # returns (watch, records of the entities that changed since the last poll),
+    # or None if the watch expired
+    with watch_lock(watch_id):
+        watch = get_watch(watch_id)
+        if watch is None:
+            return None
+
+        # the entities whose tags changed
+        versions = get_entity_versions(watch['ids'])
+        if refresh:
+            changed_ids = set(watch['ids'])
+        else:
+            changed_ids = set(i for i in watch['ids'] if watch['versions'].get(i) != versions.get(i))
+
+        # the topics which received data since their own last value, only those are returned by Crate
+        topics = list(set(t for t in watch['topics'].values() if t))
+        cursors = [watch['values'].get(t) for t in topics]
+        since = None
+        if cursors and not refresh and None not in cursors:
+            since = min(cursors)
+        last_values = utils.query_last_value_rows(topics=topics, since=since) if topics else {}
+        changed_topics = set()
+        for topic, (ts, string_value) in last_values.items():
+            if refresh or watch['values'].get(topic) != ts:
+                changed_topics.add(topic)
+            watch['values'][topic] = ts
+        changed_ids.update(i for i, t in watch['topics'].items() if t in changed_topics)
+
+        changed = list(Entity.objects.filter(entity_id__in=changed_ids)) if changed_ids else []
+        for e in changed:
+            watch['topics'][e.entity_id] = e.topic
+            watch['versions'][e.entity_id] = versions.get(e.entity_id)
+        # the entities whose tags changed still get their current value
+        missing = [e.topic for e in changed if e.topic and e.topic not in last_values]
+        if missing:
+            for topic, row in utils.get_last_value_rows(missing).items():
+                last_values[topic] = row
+                watch['values'][topic] = row[0]
+        _prune_values(watch)
+        save_watch(watch_id, watch)
+    logger.info('watch_poll: %s changed of %s watched', len(changed), len(watch['ids']))
+    return watch, watch_records(changed, last_values)
@@ -15,9 +15,24 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import csv
+import json
+import re
+
 from .base import OpentapsSeasTestCase
+from django.core.cache import cache
 from django.urls import reverse
 from opentaps_seas.core.models import Entity
+from opentaps_seas.haystack import nav
+from opentaps_seas.haystack import watch
+from opentaps_seas.haystack.formats import MODE_ZINC
+from opentaps_seas.haystack.utils.common import ParseException
+from opentaps_seas.haystack.utils.hfilter import FilterParser
+from opentaps_seas.haystack.utils.hfilter import HFilter
+from opentaps_seas.haystack.utils.hfilter import Path
+from opentaps_seas.haystack.utils.hfilter import parse_filter
+from opentaps_seas.haystack.utils.hquery import entity_data
+from opentaps_seas.haystack.utils.hquery import filter_entities
 
 
 class HaystackTests(OpentapsSeasTestCase):
@@ -155,6 +170,9 @@ class HaystackTests(OpentapsSeasTestCase):
         self.assertContains(response, '"Read time series from historian"')
         self.assertContains(response, '"nav"')
         self.assertContains(response, '"Navigate record tree"')
+        self.assertContains(response, '"watchSub"')
+        self.assertContains(response, '"watchUnsub"')
+        self.assertContains(response, '"watchPoll"')
 
     def test_formats(self):
         url = reverse('haystack:formats')
@@ -162,6 +180,41 @@ class HaystackTests(OpentapsSeasTestCase):
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response['Content-Type'], 'text/zinc;charset=utf-8')
         self.assertContains(response, '"text/zinc",M,M')
+        self.assertContains(response, '"application/json",M,M')
+        self.assertContains(response, '"text/csv",M,M')
+
+    def test_formats_negotiation(self):
+        url = reverse('haystack:read')
+        response = self.client.get(url, {'filter': 'equip and siteMeter'}, HTTP_ACCEPT='application/json')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'application/json;charset=utf-8')
+        data = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(data['meta']['ver'], '2.0')
+        self.assertEqual(data['cols'][0]['name'], 'id')
+        self.assertEqual(len(data['rows']), 5)
+        for row in data['rows']:
+            self.assertEqual(row['equip'], 'm:')
+
+        # the preferred supported format is used, Zinc being the default
+        response = self.client.get(url, {'filter': 'equip and siteMeter'},
+                                   HTTP_ACCEPT='text/html, text/csv;q=0.9, application/json;q=0.5')
+        self.assertEquals(response['Content-Type'], 'text/csv;charset=utf-8')
+        lines = list(csv.reader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(lines[0][0], 'id')
+        self.assertEqual(len(lines), 6)
+        equip = lines[0].index('equip')
+        for line in lines[1:]:
+            self.assertEqual(line[equip], '\u2713')
+        response = self.client.get(url, {'filter': 'equip and siteMeter'}, HTTP_ACCEPT='text/html')
+        self.assertEquals(response['Content-Type'], 'text/zinc;charset=utf-8')
+
+        response = self.client.get(reverse('haystack:nav'), HTTP_ACCEPT='application/json')
+        self.assertEquals(response['Content-Type'], 'application/json;charset=utf-8')
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertIn('Richmond,VA', [row.get('geoAddr') for row in data['rows']])
+
+        response = self.client.get(reverse('haystack:about'), HTTP_ACCEPT='text/csv')
+        self.assertEquals(response['Content-Type'], 'text/csv;charset=utf-8')
 
     def test_nav(self):
         url = reverse('haystack:nav')
@@ -441,3 +494,221 @@ class HaystackTests(OpentapsSeasTestCase):
         self.assertNotContains(response, '"@B"')
         self.assertNotContains(response, '"site/B"')
         self.assertNotContains(response, '"@C"')
+
+    def test_filter_parse_cache(self):
+        # a long compound filter as sent by the dashboards
+        r_filter = ' or '.join(['(point and equipRef==@E{0} and siteRef=="site/{0}" and area>={0}00ft and not disabled)'
+                                .format(i) for i in range(20)])
+        parse_filter.cache_clear()
+
+        h_filter = FilterParser(r_filter).parse()
+        self.assertEqual(str(h_filter), str(FilterParser(str(h_filter)).parse()))
+
+        # repeated queries are only parsed once
+        cached = HFilter.make(r_filter)
+        for i in range(20):
+            self.assertIs(HFilter.make(r_filter), cached)
+        self.assertEqual(str(cached), str(h_filter))
+        self.assertEqual(parse_filter.cache_info().misses, 1)
+        self.assertEqual(parse_filter.cache_info().hits, 20)
+
+        # invalid filters are not cached
+        with self.assertRaises(ParseException):
+            HFilter.make(r_filter + ' and')
+        self.assertEqual(parse_filter.cache_info().currsize, 1)
+
+    def test_filter_entities(self):
+        def entity_ids(r_filter):
+            qs, check_include = filter_entities(Entity.objects.all(), HFilter.make(r_filter))
+            self.assertFalse(check_include)
+            return set(qs.values_list('entity_id', flat=True))
+
+        self.assertEqual(entity_ids('point and his and kind=="Number"'), {'@A-E1-KWH', '@A-E1-KW'})
+        self.assertEqual(entity_ids('point and not elecKwh and siteRef=="site/A"'), {'@A-E1-KW'})
+        self.assertEqual(entity_ids('equip and siteRef!="site/A" and not elecMeter'), {'@B-E1', '@C-E1'})
+        self.assertEqual(entity_ids('id=="site/B" or id=="site/C"'), {'@B', '@C'})
+        self.assertEqual(entity_ids('site and area>1000 and area<3000'), {'@B'})
+        self.assertEqual(entity_ids('fan or (elecKw and unit=="kW")'), {'@B-E2-Fan', '@A-E1-KW'})
+
+        # the numeric comparisons match HNum, including unit suffixed decimals and values that are not numbers
+        for (e_id, temp) in [('_test_hnum_a', '72.5°F'), ('_test_hnum_b', '725°F'), ('_test_hnum_c', 'n/a')]:
+            Entity.objects.create(entity_id=e_id, m_tags=['point'], kv_tags={'id': e_id, 'temp': temp})
+        Entity.objects.create(entity_id='_test_hnum_d', m_tags=['point', 'temp'], kv_tags={'id': '_test_hnum_d'})
+        self.assertEqual(entity_ids('temp==72.5'), {'_test_hnum_a'})
+        self.assertEqual(entity_ids('temp<100'), {'_test_hnum_a'})
+        self.assertEqual(entity_ids('temp>=72.5'), {'_test_hnum_a', '_test_hnum_b'})
+        self.assertEqual(entity_ids('temp!=72.5'), {'_test_hnum_b', '_test_hnum_c', '_test_hnum_d'})
+        self.assertEqual(entity_ids('temp!=72.5'), {e.entity_id for e in Entity.objects.all()
+                                                    if HFilter.make('temp!=72.5').include(entity_data(
+                                                        e.entity_id, e.kv_tags, e.m_tags))})
+
+        # ref paths cannot be compiled and have to be checked on each record
+        qs, check_include = filter_entities(Entity.objects.all(), HFilter.make('point and equipRef->siteMeter'))
+        self.assertTrue(check_include)
+        self.assertEqual(set(qs.values_list('entity_id', flat=True)), {'@A-E1-KWH', '@A-E1-KW', '@B-E2-Fan'})
+
+    def test_read_by_filter_streaming(self):
+        url = reverse('haystack:read')
+        response = self.client.get(url, {'filter': 'equip and siteMeter'})
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        # the version header, the columns then one line per equipment
+        self.assertTrue(lines[0].startswith('ver:'))
+        columns = lines[1].split(',')
+        self.assertEqual(columns[0], 'id')
+        self.assertEqual(set(columns), {'id', 'dis', 'siteRef', 'equip', 'siteMeter', 'elecMeter'})
+        self.assertEqual(len(lines), 7)
+        equip = columns.index('equip')
+        for line in lines[2:]:
+            self.assertEqual(line.split(',')[equip], 'M')
+
+        # the limit keeps the first entities by id
+        response = self.client.get(url, {'filter': 'equip and siteMeter', 'limit': 1})
+        limited = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(limited), 3)
+        self.assertEqual(limited[2].split(',')[0], lines[2].split(',')[0])
+
+    def test_hisread_multiple_ids(self):
+        for e_id in ['_test_his_a', '_test_his_b']:
+            Entity.objects.create(entity_id=e_id, m_tags=['point', 'his'], kv_tags={'id': e_id, 'kind': 'Number'})
+        url = reverse('haystack:hisRead')
+        response = self.client.get(url, {'id': ['_test_his_a', '_test_missing'], 'range': 'today'})
+        self.assertEquals(response.status_code, 404)
+
+        response = self.client.get(url, {'id': ['_test_his_a', '_test_his_b'], 'range': 'today', 'interval': '1h',
+                                         'rollup': 'max'})
+        self.assertEquals(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        # one value column per id, with the id in the column metadata
+        self.assertEqual(lines[1], 'ts,v0 id:@_test_his_a,v1 id:@_test_his_b')
+
+        # the ids can also be given as a posted grid
+        body = 'ver:"2.0" range:"today"\nid\n@_test_his_a\n@_test_his_b\n'
+        response = self.client.post(url, body, content_type='text/zinc')
+        self.assertEquals(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(lines[1], 'ts,v0 id:@_test_his_a,v1 id:@_test_his_b')
+
+    def test_read_by_filter_ref_path(self):
+        path = Path.make('equipRef->siteRef')
+        self.assertEqual(path.size(), 2)
+        self.assertEqual(path.get(0), 'equipRef')
+        self.assertEqual(path.get(1), 'siteRef')
+        self.assertEqual(Path.make('siteRef').size(), 1)
+        with self.assertRaises(ParseException):
+            Path.make('equipRef->')
+
+        url = reverse('haystack:read')
+        response = self.client.get(url, {'filter': 'point and equipRef->elecMeter'})
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, '"point/B/E2/Fan"')
+        self.assertNotContains(response, '"point/A/E1/KWH"')
+        self.assertNotContains(response, '"point/A/E1/KW"')
+
+        response = self.client.get(url, {'filter': 'his and equipRef->siteRef->geoState=="VA"'})
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, '"point/A/E1/KWH"')
+        self.assertContains(response, '"point/A/E1/KW"')
+        self.assertContains(response, '"point/B/E2/Fan"')
+
+        response = self.client.get(url, {'filter': 'point and not equipRef->elecMeter'})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotContains(response, '"point/B/E2/Fan"')
+        self.assertContains(response, '"point/A/E1/KWH"')
+
+    def test_nav_cached(self):
+        url = reverse('haystack:nav')
+        with self.settings(HAYSTACK_NAV_CACHE_TTL=60):
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            self.assertNotContains(response, '_test_nav_site')
+
+            # saving an entity rebuilds the cached tree
+            Entity.objects.create(entity_id='_test_nav_site', m_tags=['site'], kv_tags={'id': '_test_nav_site'})
+            response = self.client.get(url)
+            self.assertContains(response, '"_test_nav_site"')
+            response = self.client.get(url, {'navId': '_test_nav_site'})
+            self.assertEquals(response.status_code, 404)
+
+            Entity.objects.create(entity_id='_test_nav_equip', m_tags=['equip'],
+                                  kv_tags={'id': '_test_nav_equip', 'siteRef': '_test_nav_site'})
+            response = self.client.get(url, {'navId': '_test_nav_site'})
+            self.assertEquals(response.status_code, 200)
+            self.assertContains(response, '"_test_nav_equip"')
+
+            # a node evicted from the cache is built again
+            cache.delete(nav._nav_key(cache.get(nav.NAV_VERSION_KEY), MODE_ZINC, '_test_nav_site'))
+            response = self.client.get(url, {'navId': '_test_nav_site'})
+            self.assertEquals(response.status_code, 200)
+            self.assertContains(response, '"_test_nav_equip"')
+
+            Entity.objects.filter(entity_id__startswith='_test_nav').delete()
+            response = self.client.get(url)
+            self.assertNotContains(response, '_test_nav_site')
+
+    def test_watch(self):
+        Entity.objects.create(entity_id='_test_watch_a', m_tags=['point'], kv_tags={'id': '_test_watch_a'})
+        Entity.objects.create(entity_id='_test_watch_b', m_tags=['point'], kv_tags={'id': '_test_watch_b'})
+
+        with self.settings(HAYSTACK_WATCH_LEASE=60):
+            url = reverse('haystack:watchSub')
+            body = 'ver:"2.0" watchDis:"test" lease:30s\nid\n@_test_watch_a\n@_test_watch_b\n'
+            response = self.client.post(url, body, content_type='text/zinc')
+            self.assertEquals(response.status_code, 200)
+            self.assertContains(response, 'lease:30s')
+            self.assertContains(response, '@_test_watch_a')
+            self.assertContains(response, '@_test_watch_b')
+            watch_id = re.search(r'watchId:"(\w+)"', response.content.decode('utf-8')).group(1)
+
+            # nothing changed since the subscription
+            url = reverse('haystack:watchPoll')
+            body = 'ver:"2.0" watchId:"{}"\nempty\n'.format(watch_id)
+            response = self.client.post(url, body, content_type='text/zinc')
+            self.assertEquals(response.status_code, 200)
+            self.assertNotContains(response, '_test_watch_')
+
+            # only the entity whose tags changed is returned
+            e = Entity.objects.get(entity_id='_test_watch_a')
+            e.add_tag('dis', 'Watched A', commit=True)
+            response = self.client.post(url, body, content_type='text/zinc')
+            self.assertEquals(response.status_code, 200)
+            self.assertContains(response, '@_test_watch_a')
+            self.assertContains(response, '"Watched A"')
+            self.assertNotContains(response, '_test_watch_b')
+
+            # refresh returns all the watched entities
+            refresh_body = 'ver:"2.0" watchId:"{}" refresh\nempty\n'.format(watch_id)
+            response = self.client.post(url, refresh_body, content_type='text/zinc')
+            self.assertContains(response, '@_test_watch_a')
+            self.assertContains(response, '@_test_watch_b')
+
+            url = reverse('haystack:watchUnsub')
+            unsub_body = 'ver:"2.0" watchId:"{}"\nid\n@_test_watch_a\n'.format(watch_id)
+            response = self.client.post(url, unsub_body, content_type='text/zinc')
+            self.assertEquals(response.status_code, 200)
+            response = self.client.post(reverse('haystack:watchPoll'), refresh_body, content_type='text/zinc')
+            self.assertNotContains(response, '_test_watch_a')
+            self.assertContains(response, '@_test_watch_b')
+            self.assertEqual(watch.get_watch(watch_id)['ids'], ['_test_watch_b'])
+            self.assertNotIn('_test_watch_a', watch.get_watch(watch_id)['versions'])
+            self.assertNotIn('_test_watch_a', watch.get_watch(watch_id)['topics'])
+
+            # a request waiting too long for the lock of the watch gets an error grid
+            lock_key = watch._watch_key(watch_id) + ':lock'
+            cache.add(lock_key, 'other', watch.WATCH_LOCK_TIMEOUT)
+            lock_wait = watch.WATCH_LOCK_WAIT
+            watch.WATCH_LOCK_WAIT = 0.1
+            try:
+                response = self.client.post(reverse('haystack:watchPoll'), body, content_type='text/zinc')
+                self.assertContains(response, 'err', status_code=503)
+            finally:
+                watch.WATCH_LOCK_WAIT = lock_wait
+                cache.delete(lock_key)
+
+            # once closed the watch is gone
+            close_body = 'ver:"2.0" watchId:"{}" close\nempty\n'.format(watch_id)
+            response = self.client.post(url, close_body, content_type='text/zinc')
+            self.assertEquals(response.status_code, 200)
+            response = self.client.post(reverse('haystack:watchPoll'), body, content_type='text/zinc')
+            self.assertEquals(response.status_code, 404)
@@ -23,6 +23,9 @@ from .base import OpentapsSeasTestCase
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.db import connections
+from opentaps_seas.core import tasks
+from opentaps_seas.core import topic_rules_utils
+from opentaps_seas.core import utils
 from opentaps_seas.core.models import (
     Entity, Tag, Topic, TopicTagRuleSet, TopicTagRule
 )
@@ -295,6 +298,46 @@ class TopicAPITests(OpentapsSeasTestCase):
         response = self._get_response(data)
         self._check_topic_list(response, c_list, nc_list)
 
+    def test_topics_keyset_pages(self):
+        self._login()
+        expected = [
+            '_test_filters/bar/ahu',
+            '_test_filters/bar/another_topic',
+            '_test_filters/bar/zone_temp',
+            '_test_filters/foo/an_ac',
+            '_test_filters/foo/some_topic'
+        ]
+        data = {
+            'n0': 'Topic',
+            't0': 'c',
+            'f0': '_test_filters',
+            'filters_count': 1
+        }
+
+        # the pages after the first start after the last topic of the previous page
+        topics = []
+        next_cursor = None
+        for page in range(1, 4):
+            response = self.client.post(self.topic_list_url + '?page={}&per_page=2'.format(page), data)
+            json_resp = json.loads(response.content)
+            self.assertEqual(5, json_resp['count'])
+            topics.extend([item['topic'] for item in json_resp['data']])
+            next_cursor = json_resp['next_cursor']
+        self.assertEqual(expected, topics)
+        self.assertEqual('_test_filters/foo/some_topic', next_cursor)
+
+        # or after the given cursor
+        response = self.client.post(self.topic_list_url + '?page=2&per_page=2&cursor={}'.format(expected[1]), data)
+        json_resp = json.loads(response.content)
+        self.assertEqual(expected[2:4], [item['topic'] for item in json_resp['data']])
+
+        # the count is dropped when the topics change
+        Topic.ensure_topic_exists('_test_filters/foo/new_topic')
+        with connections['crate'].cursor() as c:
+            c.execute("""REFRESH TABLE {0}""".format("topic"))
+        response = self.client.post(self.topic_list_url + '?page=1&per_page=2', data)
+        self.assertEqual(6, json.loads(response.content)['count'])
+
     def test_topics_filter(self):
         self._login()
 
@@ -1025,3 +1068,103 @@ class TopicAPITests(OpentapsSeasTestCase):
         for equipment in equipments:
             self.assertEqual(equipment.kv_tags['siteRef'], 'test_filters_site')
             self.assertEqual(equipment.kv_tags['modelRef'], '_test_model')
+
+    def test_topic_ruleset_task(self):
+        rule_set = TopicTagRuleSet.objects.create(name='test task rule set')
+        TopicTagRule.objects.create(
+            name='test task rule 1',
+            rule_set=rule_set,
+            filters=[{'field': 'Topic', 'type': 'c', 'value': 'foo'}],
+            tags=[{'tag': 'appName', 'value': 'task_foo'}])
+        TopicTagRule.objects.create(
+            name='test task rule 2',
+            rule_set=rule_set,
+            filters=[{'field': 'Topic', 'type': 'matches', 'value': '.*vav-(.*)'}],
+            action='create equipment',
+            action_fields={'equipment_name': '{group[1]} task equip', 'site_object_id': 'test_filters_site'})
+
+        # run the rule set as the background task does
+        result = tasks.run_topic_tag_ruleset({'ruleset_id': rule_set.id})
+        self.assertEqual(2, result['updated'])
+        self.assertEqual(2, result['new_equipments'])
+
+        for topic in Entity.objects.filter(topic__contains='foo'):
+            self.assertEqual(topic.kv_tags['appName'], 'task_foo')
+
+        # check the points are linked to their equipment
+        equipment = Entity.objects.get(entity_id__contains='100-task-equip')
+        points = Entity.objects.filter(topic__contains='vav-100')
+        self.assertEqual(2, points.count())
+        for point in points:
+            self.assertEqual(point.kv_tags['equipRef'], equipment.kv_tags['id'])
+
+    def test_topic_ruleset_preview(self):
+        rule_set = TopicTagRuleSet.objects.create(name='test preview rule set')
+        TopicTagRule.objects.create(
+            name='test preview rule 1',
+            rule_set=rule_set,
+            filters=[{'field': 'Topic', 'type': 'c', 'value': 'foo'}],
+            tags=[{'tag': 'appName', 'value': 'preview_foo'}])
+        # this rule only matches after the first rule applied
+        TopicTagRule.objects.create(
+            name='test preview rule 2',
+            rule_set=rule_set,
+            filters=[{'field': 'appName', 'type': 'eq', 'value': 'preview_foo'},
+                     {'field': 'ac', 'type': 'present', 'op': 'AND'}],
+            tags=[{'tag': 'ac', 'remove': 'True'}])
+
+        updated_set, updated_entities, updated_tags, removed_tags, _ = \
+            topic_rules_utils.preview_topic_tag_ruleset(rule_set)
+        self.assertIn('_test_filters/foo/some_topic', updated_set)
+        self.assertIn('_test_filters/foo/an_ac', updated_set)
+        self.assertNotIn('_test_filters/bar/another_topic', updated_set)
+        self.assertEqual({'new': 'preview_foo', 'previous': 'test_foo_1'},
+                         updated_tags['_test_filters/foo/some_topic']['appName'])
+        self.assertEqual({'ac': 'type:MARKER'}, removed_tags['_test_filters/foo/an_ac'])
+        self.assertNotIn('ac', updated_entities['_test_filters/foo/an_ac']['m_tags'])
+        self.assertEqual('preview_foo', updated_entities['_test_filters/foo/an_ac']['kv_tags']['appName'])
+
+        # nothing was saved
+        e = Entity.objects.get(entity_id='_test_filters/foo/an_ac')
+        self.assertIn('ac', e.m_tags)
+        self.assertEqual('test_foo', e.kv_tags['appName'])
+
+    def test_topic_ruleset_preview_missing_tag(self):
+        rule_set = TopicTagRuleSet.objects.create(name='test preview missing tag rule set')
+        # unit is only set on some of the topics
+        TopicTagRule.objects.create(
+            name='test preview missing tag rule 1',
+            rule_set=rule_set,
+            filters=[{'field': 'unit', 'type': 'gt', 'value': 'a'}],
+            tags=[{'tag': 'appName', 'value': 'preview_unit'}])
+        # no topic has this tag
+        TopicTagRule.objects.create(
+            name='test preview missing tag rule 2',
+            rule_set=rule_set,
+            filters=[{'field': '_test_no_such_tag', 'type': 'lt', 'value': 'z'},
+                     {'field': 'Topic', 'type': 'c', 'value': 'foo', 'op': 'AND'}],
+            tags=[{'tag': 'appName', 'value': 'preview_missing'}])
+
+        preview_set = topic_rules_utils.preview_topic_tag_ruleset(rule_set, topic_filter='_test_filters')[0]
+        run_set = utils.run_topic_tag_ruleset(rule_set, topic_filter='_test_filters', pretend=True)[0]
+        self.assertEqual(run_set, preview_set)
+        self.assertEqual({'_test_filters/bar/zone_temp', '_test_filters/foo/some_topic', '_test_filters/foo/an_ac'},
+                         preview_set)
+
+    def test_topic_ruleset_preview_report(self):
+        rule_set = TopicTagRuleSet.objects.create(name='test preview report rule set')
+        TopicTagRule.objects.create(
+            name='test preview report rule',
+            rule_set=rule_set,
+            filters=[{'field': 'Topic', 'type': 'c', 'value': 'foo'}],
+            tags=[{'tag': 'appName', 'value': 'preview_foo'}])
+
+        state = topic_rules_utils.TopicTagsState()
+        updated_set, updated_entities, updated_tags, removed_tags, _ = \
+            topic_rules_utils.preview_topic_tag_ruleset(rule_set, state=state)
+        # the report from the tags collected by the preview is the same as from all the data points
+        self.assertEqual(utils.tag_rulesets_run_report(updated_entities),
+                         utils.tag_rulesets_run_report(updated_entities, report_tags=state.tags))
+        self.assertEqual(utils.tag_rulesets_run_report_diff(updated_entities, updated_tags, removed_tags),
+                         utils.tag_rulesets_run_report_diff(updated_entities, updated_tags, removed_tags,
+                                                            report_tags=state.tags))
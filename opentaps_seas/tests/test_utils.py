@@ -16,11 +16,22 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import time
+import numpy
+import pandas
 
 from .base import OpentapsSeasTestCase
 from datetime import datetime
+from datetime import timedelta
+from django.core.cache import cache
 from django.db import connections
+from django.db.models import Q
 from opentaps_seas.core.models import Entity
+from opentaps_seas.core.models import Topic
+from opentaps_seas.core.models import defer_crate_tag_sync
+from opentaps_seas.core.models import sync_tags_to_crate_entities
+from opentaps_seas.core.models import CRATE_TOPIC_TAGS_CACHE_KEY
+from opentaps_seas.core.models import get_crate_topic_tags
+from opentaps_seas.core.models import invalidate_crate_topic_tags
 from opentaps_seas.core import utils
 
 
@@ -137,6 +148,129 @@ class UtilsTests(OpentapsSeasTestCase):
         self.assertIsNotNone(point_value)
         self.assertIn('34.74', point_value)
 
+    def test_get_point_values_rollup(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+        point.unit = '°C'
+
+        raw_values = utils.get_point_values(point, 'hour')
+        cache.clear()
+        try:
+            utils.refresh_rollup('hour')
+            self.assertIsNotNone(utils.get_rollup('hour'))
+            point_values = utils.get_point_values(point, 'hour')
+            self.assertEqual(len(point_values), 1)
+            self.assertEqual(point_values, raw_values)
+
+            # the watermark is kept in Crate
+            cache.clear()
+            self.assertIsNotNone(utils.get_rollup('hour'))
+
+            # the dirty topics are re-aggregated then cleared
+            utils.mark_rollups_dirty({self.topic: datetime.utcnow() - timedelta(days=30)})
+            utils.refresh_rollup('hour')
+            with connections['crate'].cursor() as c:
+                c.execute("""REFRESH TABLE {0}""".format(utils.ROLLUP_DIRTY_TABLE))
+                c.execute("""SELECT COUNT(*) FROM {0} WHERE rollup = %s AND topic = %s""".format(
+                    utils.ROLLUP_DIRTY_TABLE), ['data_hourly', self.topic])
+                self.assertEqual(c.fetchone()[0], 0)
+            self.assertEqual(utils.get_point_values(point, 'hour'), raw_values)
+        finally:
+            cache.clear()
+            with connections['crate'].cursor() as c:
+                sql = """DELETE FROM {0} WHERE topic like %s""".format("data_hourly")
+                c.execute(sql, ['_test%'])
+                sql = """DELETE FROM {0} WHERE topic like %s""".format(utils.ROLLUP_DIRTY_TABLE)
+                c.execute(sql, ['_test%'])
+
+    def test_iter_point_values(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+        point.unit = '°C'
+
+        start, end = utils.get_start_date_from_range(utils.DEFAULT_RANGE)
+        point_values = utils.iter_point_values(point, start, end)
+        self.assertFalse(isinstance(point_values, list))
+        point_values = list(point_values)
+        self.assertEqual(len(point_values), 1)
+        self.assertIn(34.74, point_values[0])
+
+    def test_get_points_values(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+        point.unit = '°C'
+
+        point1 = Entity()
+        point1.entity_id = self.entity_id + '1'
+        point1.topic = self.topic1
+        point1.kind = 'Bool'
+
+        points_values = utils.get_points_values([point, point1])
+        self.assertIsNotNone(points_values)
+        ts = points_values['ts']
+        self.assertTrue(len(ts) >= 1)
+        values = points_values['values']
+        self.assertEqual(len(values), 2)
+        # all the columns are aligned on the timestamps
+        self.assertEqual(len(values[point.entity_id]), len(ts))
+        self.assertEqual(len(values[point1.entity_id]), len(ts))
+        self.assertIn(34.74, values[point.entity_id])
+        self.assertIn(1, values[point1.entity_id])
+
+    def test_get_point_series(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+        point.unit = '°C'
+
+        series = utils.get_point_series(point)
+        self.assertEqual(len(series), 1)
+        self.assertEqual(series.iloc[0], 34.74)
+        self.assertEqual(str(series.index.tz), 'UTC')
+
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic1
+        point.kind = 'Bool'
+
+        series = utils.get_point_series(point)
+        self.assertEqual(len(series), 1)
+        self.assertEqual(series.iloc[0], 1)
+        self.assertEqual(series.tolist(), [v[1] for v in utils.get_point_values(point)])
+
+    def test_ts_to_datetime_index(self):
+        expected = pandas.to_datetime(['2019-01-01T00:00:00Z', '2019-01-01T00:01:00Z'], utc=True)
+        # aggregated timestamps
+        index = utils.ts_to_datetime_index(numpy.array([1546300800000, 1546300860000], dtype='int64'))
+        self.assertEqual(index.tolist(), expected.tolist())
+        # raw timestamps as ints in an object array are also epoch milliseconds
+        index = utils.ts_to_datetime_index(numpy.array([1546300800000, 1546300860000], dtype=object))
+        self.assertEqual(index.tolist(), expected.tolist())
+        # or as datetimes
+        index = utils.ts_to_datetime_index(numpy.array([datetime(2019, 1, 1, 0, 0), datetime(2019, 1, 1, 0, 1)],
+                                                       dtype=object))
+        self.assertEqual(index.tolist(), expected.tolist())
+        self.assertEqual(len(utils.ts_to_datetime_index(numpy.array([], dtype='int64'))), 0)
+
+    def test_lttb(self):
+        data = [[i, i % 7] for i in range(1000)]
+        sampled = utils.lttb(data, 100)
+        self.assertEqual(len(sampled), 100)
+        self.assertEqual(sampled[0], data[0])
+        self.assertEqual(sampled[-1], data[-1])
+        for i in range(1, len(sampled)):
+            self.assertTrue(sampled[i - 1][0] < sampled[i][0])
+
+        # nothing to do if there are fewer values than the threshold
+        self.assertEqual(utils.lttb(data[:10], 100), data[:10])
+
     def test_charts_for_points(self):
         point = Entity()
         point.entity_id = self.entity_id
@@ -161,6 +295,23 @@ class UtilsTests(OpentapsSeasTestCase):
         charts = utils.charts_for_points(points)
         self.assertIsNotNone(charts)
         self.assertEqual(len(charts), 2)
+        # the Number and Bool charts are fetched together
+        self.assertTrue(charts[0]['batched'])
+        self.assertTrue(charts[1]['batched'])
+        self.assertIsNotNone(charts[0]['data_url'])
+
+        # a single chart uses its own url which downsamples
+        charts = utils.charts_for_points([point])
+        self.assertEqual(len(charts), 1)
+        self.assertFalse(charts[0]['batched'])
+        self.assertIsNone(charts[0]['data_url'])
+
+        # a string point is never batched since its values are not aggregated
+        point1.kind = 'Str'
+        charts = utils.charts_for_points(points)
+        self.assertEqual(len(charts), 2)
+        self.assertFalse(charts[0]['batched'])
+        self.assertFalse(charts[1]['batched'])
 
     def test_add_current_values(self):
         point = Entity()
@@ -187,3 +338,182 @@ class UtilsTests(OpentapsSeasTestCase):
         self.assertIsNotNone(data)
         self.assertTrue('<b>34.7</b> °C' in data[0].current_value)
         self.assertTrue('<b>True</b>' in data[1].current_value)
+
+    def test_get_current_values(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = self.topic
+        point.kind = 'Number'
+        point.unit = '°C'
+
+        point1 = Entity()
+        point1.entity_id = self.entity_id
+        point1.topic = self.topic1
+        point1.kind = 'Bool'
+        point1.unit = ''
+
+        point2 = Entity()
+        point2.entity_id = self.entity_id
+        point2.topic = 'empty'
+        point2.kind = 'Number'
+        point2.unit = ''
+
+        values = utils.get_current_values([point, point1, point2])
+        self.assertIsNotNone(values)
+        self.assertEqual(len(values), 2)
+        self.assertEqual(values[self.topic]['value'], '34.7')
+        self.assertEqual(values[self.topic]['unit'], '°C')
+        self.assertTrue(values[self.topic1]['value'])
+        self.assertNotIn('empty', values)
+
+    def test_get_current_values_cached(self):
+        point = Entity()
+        point.entity_id = self.entity_id
+        point.topic = '_test/topiccached'
+        point.kind = 'Number'
+        point.unit = ''
+
+        sql = """INSERT INTO {0} (double_value, source, string_value, topic, ts)
+        VALUES (%s, %s, %s, %s, %s)""".format("data")
+        with self.settings(CRATE_LAST_VALUE_TTL=60):
+            cache.clear()
+            with connections['crate'].cursor() as c:
+                c.execute(sql, [12.5, 'scrape', '12.5', point.topic, datetime.utcnow()])
+                c.execute("""REFRESH TABLE {0}""".format("data"))
+            values = utils.get_current_values([point])
+            self.assertEqual(values[point.topic]['value'], '12.5')
+            # once cached, the value is served without reading the new data
+            with connections['crate'].cursor() as c:
+                c.execute(sql, [13.5, 'scrape', '13.5', point.topic, datetime.utcnow()])
+                c.execute("""REFRESH TABLE {0}""".format("data"))
+            values = utils.get_current_values([point])
+            self.assertEqual(values[point.topic]['value'], '12.5')
+            # until the cache gets refreshed
+            self.assertTrue(utils.refresh_last_values() >= 1)
+            values = utils.get_current_values([point])
+            self.assertEqual(values[point.topic]['value'], '13.5')
+            # topics without data are cached as missing
+            rows = utils.get_last_value_rows(['_test/topicnodata'])
+            self.assertEqual(rows, {})
+            self.assertEqual(cache.get(utils._last_value_cache_key('_test/topicnodata')), utils.LAST_VALUE_MISSING)
+            cache.clear()
+
+    def test_get_crate_topic_tags_cached(self):
+        with self.settings(CRATE_TOPIC_TAGS_TTL=60):
+            cache.clear()
+            tags = get_crate_topic_tags()
+            self.assertTrue('id' in tags)
+            # once cached, the schema is not queried again
+            cache.set(CRATE_TOPIC_TAGS_CACHE_KEY, {'id', 'dis'}, 60)
+            self.assertEqual(get_crate_topic_tags(), {'id', 'dis'})
+            # known tags do not invalidate the cache, new ones do
+            invalidate_crate_topic_tags({'id': '_test'})
+            self.assertEqual(get_crate_topic_tags(), {'id', 'dis'})
+            invalidate_crate_topic_tags({'_testNewTag': '_test'})
+            self.assertNotEqual(get_crate_topic_tags(), {'id', 'dis'})
+            cache.clear()
+
+    def test_sync_tags_to_crate_entities(self):
+        rows = []
+        for i in range(3):
+            topic = '_test/bulksync{}'.format(i)
+            rows.append(Entity(entity_id=topic, topic=topic, m_tags=['point', 'his'],
+                               kv_tags={'id': topic, 'dis': 'Bulk {}'.format(i)}))
+        # the existing topic only gets its tags updated
+        rows.append(Entity(entity_id=self.topic, topic=self.topic, m_tags=['point'], kv_tags={'id': self.topic}))
+        self.assertEqual(sync_tags_to_crate_entities(rows), 4)
+
+        with connections['crate'].cursor() as c:
+            c.execute("""REFRESH TABLE {0}""".format("topic"))
+        topic = Topic.objects.get(topic='_test/bulksync1')
+        self.assertEqual(topic.m_tags, ['point', 'his'])
+        self.assertEqual(topic.kv_tags['dis'], 'Bulk 1')
+        topic = Topic.objects.get(topic=self.topic)
+        self.assertEqual(topic.m_tags, ['point'])
+        self.assertEqual(topic.kv_tags['id'], self.topic)
+
+    def test_defer_crate_tag_sync(self):
+        with self.settings(CRATE_TAG_AUTOSYNC=True):
+            with defer_crate_tag_sync():
+                for i in range(3):
+                    topic = '_test/defersync{}'.format(i)
+                    e = Entity(entity_id=topic, topic=topic, m_tags=['point'], kv_tags={'id': topic})
+                    e.save()
+                    e.kv_tags['dis'] = 'Deferred {}'.format(i)
+                    e.save()
+
+        with connections['crate'].cursor() as c:
+            c.execute("""REFRESH TABLE {0}""".format("topic"))
+        self.assertEqual(Topic.objects.filter(topic__startswith='_test/defersync').count(), 3)
+        topic = Topic.objects.get(topic='_test/defersync2')
+        self.assertEqual(topic.kv_tags['dis'], 'Deferred 2')
+
+        # the entities saved before an error are still synced
+        with self.settings(CRATE_TAG_AUTOSYNC=True):
+            with self.assertRaises(ValueError):
+                with defer_crate_tag_sync():
+                    topic = '_test/defersync3'
+                    Entity(entity_id=topic, topic=topic, m_tags=['point'], kv_tags={'id': topic}).save()
+                    raise ValueError()
+
+        with connections['crate'].cursor() as c:
+            c.execute("""REFRESH TABLE {0}""".format("topic"))
+        self.assertTrue(Topic.objects.filter(topic='_test/defersync3').exists())
+
+    def test_tag_topics_bulk(self):
+        with connections['crate'].cursor() as c:
+            for i in range(3):
+                c.execute("""INSERT INTO {0} (topic) VALUES (%s)""".format("topic"), ['_test/bulktag{}'.format(i)])
+            c.execute("""REFRESH TABLE {0}""".format("topic"))
+        Entity.objects.create(entity_id='_test_bulktag_equip', m_tags=['equip'],
+                              kv_tags={'id': '_test_bulktag_equip', 'siteRef': '_test_bulktag_site'})
+        # an existing point keeps its id and dis
+        Entity.objects.create(entity_id='_test_bulktag0', topic='_test/bulktag0', m_tags=['point'],
+                              kv_tags={'id': '_test_bulktag0', 'dis': 'Existing'})
+
+        filters = [{'type': 'c', 'value': '_test/bulktag'}]
+        tags = [{'tag': 'his'}, {'tag': 'equipRef', 'value': '_test_bulktag_equip'}]
+        with self.settings(CRATE_TAG_AUTOSYNC=False):
+            updated, _, _, _ = utils.tag_topics(filters, tags, select_all=True)
+        self.assertEqual(len(updated), 3)
+
+        entities = {e.topic: e for e in Entity.objects.filter(topic__startswith='_test/bulktag')}
+        self.assertEqual(len(entities), 3)
+        self.assertEqual(entities['_test/bulktag0'].entity_id, '_test_bulktag0')
+        self.assertEqual(entities['_test/bulktag0'].kv_tags['dis'], 'Existing')
+        self.assertEqual(entities['_test/bulktag1'].kv_tags['dis'], '_test/bulktag1')
+        for e in entities.values():
+            self.assertIn('his', e.m_tags)
+            self.assertEqual(e.kv_tags['equipRef'], '_test_bulktag_equip')
+            # the siteRef is set from the equipment
+            self.assertEqual(e.kv_tags['siteRef'], '_test_bulktag_site')
+
+        # pretend does not save anything
+        tags = [{'tag': 'his', 'remove': True}]
+        updated, updated_entities, _, removed_tags = utils.tag_topics(filters, tags, select_all=True, pretend=True)
+        self.assertEqual(len(updated_entities), 3)
+        self.assertEqual(removed_tags['_test/bulktag2'], {'his': 'type:MARKER'})
+        self.assertIn('his', Entity.objects.get(topic='_test/bulktag2').m_tags)
+
+    def test_filters_to_Q(self):
+        valid_tags = ['appName']
+        filters = [('Topic', 'c', 'foo', 'AND'), ('appName', 'eq', 'bar', 'OR'), ('Topic', 'nc', 'ac', 'AND')]
+        q = utils.filters_to_Q(filters, valid_tags)
+        self.assertEqual(
+            q,
+            (Q(topic__icontains='foo') | Q(kv_tags__appName__iexact='bar')) & ~Q(topic__icontains='ac'))
+
+        # a not contains on a tag that is not a column matches everything
+        self.assertIsNone(utils.filters_to_Q([('unit', 'nc', 'x', 'AND')], valid_tags))
+        q = utils.filters_to_Q([('Topic', 'c', 'foo', 'AND'), ('unit', 'nc', 'x', 'OR')], valid_tags)
+        self.assertIsNone(q)
+
+        # the filtered query has a single WHERE clause
+        with connections['crate'].cursor() as c:
+            c.execute("""INSERT INTO {0} (topic) VALUES (%s)""".format("topic"), ['_test/filters_q/foo'])
+            c.execute("""REFRESH TABLE {0}""".format("topic"))
+        qs = utils.apply_filters_to_queryset(Topic.objects.all(), filters)
+        sql, plan = utils.explain_queryset(qs)
+        self.assertEqual(1, sql.count('WHERE'))
+        self.assertTrue(plan)
+        self.assertIn('_test/filters_q/foo', [t.topic for t in qs])
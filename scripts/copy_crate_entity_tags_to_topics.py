@@ -21,7 +21,7 @@ from django.db.models import CharField
 from cratedb.fields import HStoreField as CrateHStoreField
 from cratedb.fields import ArrayField as CrateArrayField
 from opentaps_seas.core.models import ensure_crate_entity_table
-from opentaps_seas.core.models import sync_tags_to_crate_entity
+from opentaps_seas.core.models import sync_tags_to_crate_entities
 
 
 # Redefine the old CrateEntity class for usage in this script
@@ -67,11 +67,13 @@ def copy_crate_entity_tags_to_topics():
     # first make sure the CrateDB table already exists
     ensure_crate_entity_table()
 
-    # iterate the topic data points and copy the tags
+    # iterate the topic data points and copy the tags in bulk
+    rows = []
     for row in CrateEntity.objects.all():
         print(" --> {} with {} and {}".format(row.topic, row.m_tags, row.kv_tags))
-        sync_tags_to_crate_entity(row)
+        rows.append(row)
         count = count + 1
+    sync_tags_to_crate_entities(rows)
 
     print(count, "topics have been processed")
 
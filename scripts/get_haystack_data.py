@@ -15,219 +15,253 @@
 # along with opentaps Smart Energy Applications Suite (SEAS).
 # If not, see <https://www.gnu.org/licenses/>.
 
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 from datetime import datetime
 from datetime import timezone
+from dateutil.parser import parse as parse_datetime
 from opentaps_seas.core.models import Entity
+from opentaps_seas.core.models import defer_crate_tag_sync
 from opentaps_seas.core.utils import cleanup_id
+from opentaps_seas.core.utils import mark_rollups_dirty
 from hsclient.client import HSClient
-from crate.client.exceptions import ProgrammingError
+from hsclient.client import HSClientError
 from django.db import connections
 
+# number of concurrent requests to the Haystack server
+DEFAULT_WORKERS = 8
+# timeout of each request, hisRead of a long range can be slow
+REQUEST_TIMEOUT = 30
+# number of data rows inserted by each INSERT statement
+INSERT_BATCH_SIZE = 1000
+
+
+def import_data(base_url, range_from, workers=DEFAULT_WORKERS):
+    # the client session is shared by the worker threads
+    client = HSClient(base_url, timeout=REQUEST_TIMEOUT, pool_maxsize=workers)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # the nav tree is fetched one level at a time, the nav requests of each level run concurrently
+        sites_nav_ids, _ = import_level(client, executor, [None], 'site')
+        print("Processed {0} sites.".format(len(sites_nav_ids)))
+        if not sites_nav_ids:
+            print("Empty sites list")
+            return
+
+        equips_nav_ids, _ = import_level(client, executor, sites_nav_ids, 'equip')
+        print("Processed {0} equipments.".format(len(equips_nav_ids)))
+        if not equips_nav_ids:
+            print("Empty equipments list")
+            return
+
+        _, all_points_ids = import_level(client, executor, equips_nav_ids, 'point')
+        print("Processed {0} points.".format(len(all_points_ids)))
+
+        import_history(client, executor, all_points_ids, range_from, workers=workers)
+
+
+def import_level(client, executor, nav_ids, tag):
+    # fetch the children of the given nav nodes and create the missing entities having the given marker tag,
+    # returns the navIds and ids of those entities
+    level_nav_ids = []
+    level_ids = []
+    rows = []
+    futures = {executor.submit(fetch_grid, client.nav_grid, nav_id=nav_id): nav_id for nav_id in nav_ids}
+    for future in as_completed(futures):
+        header, data = future.result()
+        nav_id = futures[future]
+        if nav_id:
+            print("{1}: Got {0} {2}".format(len(data), nav_id, tag))
+        try:
+            id_index = header.index('id')
+            nav_id_index = header.index('navId')
+        except ValueError:
+            print("Cannot get id index")
+            continue
+        try:
+            tag_index = header.index(tag)
+        except ValueError:
+            print("Cannot find '{0}' in the response header".format(tag))
+            continue
+
+        for row in data:
+            if 'M' == row[tag_index]:
+                level_nav_ids.append(row[nav_id_index])
+                level_ids.append(row[id_index])
+                rows.append((header, row, id_index))
+            else:
+                print("There is no '{0}' tag in ".format(tag), row)
+
+    # only one query to find which entities already exist
+    new_ids = [cleanup_id(row[id_index]) for (header, row, id_index) in rows]
+    existing = set(Entity.objects.filter(entity_id__in=new_ids, m_tags__contains=[tag])
+                   .values_list('entity_id', flat=True))
+    created_ids = []
+    with defer_crate_tag_sync():
+        for (header, row, id_index), new_id in zip(rows, new_ids):
+            if new_id in existing or new_id in created_ids:
+                continue
+            kv_tags, m_tags = prepare_tags(header, row)
+            new_entity = Entity(entity_id=new_id, kv_tags=kv_tags, m_tags=m_tags)
+            if tag == 'point':
+                new_entity.topic = row[id_index]
+            new_entity.save()
+            created_ids.append(new_id)
 
-def import_data(base_url, range_from):
-    client = HSClient(base_url)
+    if created_ids:
+        print("New {0} ids:".format(tag), created_ids)
+    print("Added {0} new {1}.".format(len(created_ids), tag))
+    return level_nav_ids, level_ids
 
-    # sites
-    content = client.nav(nav_id=None)
-    header, data = client.parse_grid(content)
-    id_index = header.index('id')
-    nav_id_index = header.index('navId')
+
+def fetch_grid(method, **kwargs):
+    # run in the worker threads, the nav grids are small enough to be read entirely
     try:
-        site_tag_id = header.index('site')
-    except ValueError:
-        site_tag_id = None
+        header, rows = method(**kwargs)
+        return header, list(rows)
+    except HSClientError as e:
+        print(e)
+        return [], []
 
-    sites_nav_ids = []
-    new_sites_ids = []
-    new_sites = 0
 
-    if site_tag_id is not None:
-        for row in data:
-            new_id = cleanup_id(row[id_index])
-            site_tag = row[site_tag_id]
-            if 'M' == site_tag:
-                sites_nav_ids.append(row[nav_id_index])
-                entity = Entity.objects.filter(entity_id=new_id, m_tags__contains=['site']).first()
-                if not entity:
-                    # create new one
-                    kv_tags, m_tags = prepare_tags(header, row)
-                    new_entity = Entity(entity_id=new_id, kv_tags=kv_tags, m_tags=m_tags)
-                    new_entity.save()
-                    new_sites = new_sites + 1
-                    new_sites_ids.append(new_id)
-            else:
-                print("There is no 'site' tag in ", row)
+def get_watermarks(crate_cursor, points_ids):
+    # the timestamp of the latest data row of each point, only newer rows are imported
+    crate_cursor.execute("""SELECT topic, MAX(ts) FROM "data"
+        WHERE topic = ANY(%s) GROUP BY topic;""", [points_ids])
+    return {topic: to_datetime(ts) for topic, ts in crate_cursor.fetchall()}
 
-    else:
-        print("Cannot find 'site' in the response header")
-
-    if new_sites > 0:
-        print("New sites ids:", new_sites_ids)
-
-    print("Processed {0} sites, added {1} new.".format(len(data), new_sites))
-    # print("sites_nav_ids:", sites_nav_ids)
-
-    # equipments
-    total_equips = 0
-    new_equips = 0
-    new_equips_ids = []
-    equips_nav_ids = []
-    if len(sites_nav_ids) > 0:
-        for nav_id in sites_nav_ids:
-            content = client.nav(nav_id=nav_id)
-            header, data = client.parse_grid(content)
-            total_equips = total_equips + len(data)
-            print("{1}: Got {0} equipments".format(len(data), nav_id))
-            id_index = header.index('id')
-            nav_id_index = header.index('navId')
-            try:
-                equip_tag_id = header.index('equip')
-            except ValueError:
-                equip_tag_id = None
-
-            if equip_tag_id is not None:
-                for row in data:
-                    new_id = cleanup_id(row[id_index])
-                    equip_tag = row[equip_tag_id]
-                    if 'M' == equip_tag:
-                        equips_nav_ids.append(row[nav_id_index])
-                        entity = Entity.objects.filter(entity_id=new_id, m_tags__contains=['equip']).first()
-                        if not entity:
-                            # create new one
-                            kv_tags, m_tags = prepare_tags(header, row)
-                            new_entity = Entity(entity_id=new_id, kv_tags=kv_tags, m_tags=m_tags)
-                            new_entity.save()
-                            new_equips = new_equips + 1
-                            new_equips_ids.append(new_id)
-                    else:
-                        print("There is no 'equip' tag in ", row)
 
-            else:
-                print("Cannot find 'equip' in the response header")
+def to_datetime(ts):
+    # Crate timestamps can be returned as epoch milliseconds
+    if isinstance(ts, datetime):
+        if not ts.tzinfo:
+            ts = ts.replace(tzinfo=timezone.utc)
+        return ts
+    return datetime.fromtimestamp(ts / 1000, tz=timezone.utc)
 
-    else:
-        print("Empty sites list")
-
-    if new_equips > 0:
-        print("New equipments ids:", new_equips_ids)
-
-    print("Processed {0} equipments, added {1} new.".format(total_equips, new_equips))
-    # print("equip_nav_ids:", equips_nav_ids)
-
-    # points
-    total_points = 0
-    new_points = 0
-    new_points_ids = []
-    all_points_ids = []
-    points_nav_ids = []
-    if len(equips_nav_ids) > 0:
-        for nav_id in equips_nav_ids:
-            content = client.nav(nav_id=nav_id)
-            header, data = client.parse_grid(content)
-            total_points = total_points + len(data)
-            print("{1}: Got {0} points".format(len(data), nav_id))
-            try:
-                id_index = header.index('id')
-            except ValueError:
-                print("Cannot get id index")
-                continue
 
-            nav_id_index = header.index('navId')
-            try:
-                point_tag_id = header.index('point')
-            except ValueError:
-                point_tag_id = None
-
-            if point_tag_id is not None:
-                for row in data:
-                    new_id = cleanup_id(row[id_index])
-                    point_tag = row[point_tag_id]
-                    if 'M' == point_tag:
-                        points_nav_ids.append(row[nav_id_index])
-                        all_points_ids.append(row[id_index])
-                        entity = Entity.objects.filter(entity_id=new_id, m_tags__contains=['point']).first()
-                        if not entity:
-                            # create new one
-                            kv_tags, m_tags = prepare_tags(header, row)
-                            new_entity = Entity(entity_id=new_id, topic=row[id_index],
-                                                kv_tags=kv_tags, m_tags=m_tags)
-                            new_entity.save()
-                            new_points = new_points + 1
-                            new_points_ids.append(new_id)
-                    else:
-                        print("There is no 'point' tag in ", row)
-            else:
-                print("Cannot find 'point' in the response header")
-    else:
-        print("Empty equipments list")
+def his_range(watermark, range_from):
+    if watermark:
+        return watermark.strftime('%Y-%m-%d') + ',' + datetime.utcnow().strftime('%Y-%m-%d')
+    if range_from:
+        if range_from != "none":
+            return range_from
+        return None
+    return 'today'
 
-    if new_points > 0:
-        print("New points ids:", new_points_ids)
 
-    print("Processed {0} points, added {1} new.".format(total_points, new_points))
-    # print("all_points_ids:", all_points_ids)
-    # print("points_nav_ids:", points_nav_ids)
+def import_history(client, executor, points_ids, range_from, workers=DEFAULT_WORKERS):
+    if not points_ids:
+        return
 
-    # points data
     topics_counter = 0
-    topics_list = []
-
     with connections['crate'].cursor() as crate_cursor:
-        if len(all_points_ids) > 0:
-            for point_id in all_points_ids:
-                topic_data_counter = 0
-
-                sql = """INSERT INTO {0} (topic)
-                VALUES (%s)""".format("topic")
+        # make sure the topics exist
+        for i in range(0, len(points_ids), INSERT_BATCH_SIZE):
+            batch = points_ids[i:i + INSERT_BATCH_SIZE]
+            crate_cursor.execute("""INSERT INTO topic (topic) VALUES {0}
+                ON CONFLICT DO NOTHING;""".format(', '.join(['(%s)'] * len(batch))), batch)
+
+        watermarks = get_watermarks(crate_cursor, points_ids)
+        # each worker reads a whole hisRead response, so at most one request per worker is open at a time,
+        # and hands its rows in batches to this thread which inserts them; the queue is bounded so the
+        # workers wait when the inserts lag behind
+        batches = queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+        futures = {}
+        for point_id in points_ids:
+            p_range = his_range(watermarks.get(point_id), range_from)
+            print("Processing :", point_id, ", range: ", p_range)
+            futures[executor.submit(fetch_history, client, point_id, p_range, watermarks.get(point_id), batches,
+                                    stop)] = point_id
+
+        counters = {}
+        first_ts = {}
+        pending = set(futures.keys())
+        try:
+            while pending:
                 try:
-                    crate_cursor.execute("""INSERT INTO topic (topic) VALUES (%s)""", [point_id])
-                except ProgrammingError:
-                    # just make sure the topic exists
+                    point_id, rows = batches.get(timeout=0.1)
+                    counters[point_id] = counters.get(point_id, 0) + insert_data_rows(crate_cursor, rows)
+                    first_ts.setdefault(point_id, rows[0][2])
+                    continue
+                except queue.Empty:
                     pass
-
-                crate_cursor.execute("""SELECT ts, string_value FROM "data"
-                    WHERE topic = %s ORDER BY ts DESC LIMIT 1;""", [point_id])
-                result = crate_cursor.fetchone()
-                his_range = None
-                if result:
-                    ts = result[0]
-                    t = datetime.utcfromtimestamp(ts // 1000).replace(microsecond=ts %
-                                                                      1000 * 1000).replace(tzinfo=timezone.utc)
-                    his_range = t.strftime('%Y-%m-%d') + ',' + datetime.utcnow().strftime('%Y-%m-%d')
-                else:
-                    if range_from:
-                        if range_from != "none":
-                            his_range = range_from
-                    else:
-                        his_range = 'today'
-
-                print("Processing :", point_id, ", range: ", his_range)
-                content = client.his_read(id=point_id, range=his_range)
-                header, data = client.parse_grid(content)
-                if header and 'ts' in header and 'val' in header:
-                    ts_index = header.index('ts')
-                    val_index = header.index('val')
-                    for item in data:
-                        ts_str_arr = item[ts_index].split(" ")
-                        val = item[val_index]
-                        sql = """INSERT INTO data (double_value, source, string_value, topic, ts)
-                        VALUES (%s, %s, %s, %s, %s)"""
-                        try:
-                            crate_cursor.execute(sql, [val, 'scrape', val, point_id, ts_str_arr[0]])
-                            topic_data_counter = topic_data_counter + 1
-                        except ProgrammingError:
-                            # that means it already exists
-                            pass
-
-                topics_list.append({point_id: topic_data_counter})
-                print("Point #{1}: Added {0} data rows.".format(topic_data_counter, topics_counter))
-                topics_counter = topics_counter + 1
-
-        crate_cursor.close()
+                # the batches of a finished worker are all queued before it finishes
+                finished = [future for future in pending if future.done()]
+                if not batches.empty():
+                    continue
+                for future in finished:
+                    pending.remove(future)
+                    point_id = futures[future]
+                    try:
+                        future.result()
+                    except HSClientError as e:
+                        print(e)
+                    # the history may be older than the rollups watermark
+                    if counters.get(point_id):
+                        mark_rollups_dirty({point_id: first_ts[point_id]})
+                    print("Point #{1}: Added {0} data rows.".format(counters.get(point_id, 0), topics_counter))
+                    topics_counter = topics_counter + 1
+        finally:
+            # let the workers give up if this failed
+            stop.set()
 
     print("Processed {0} topics.".format(topics_counter))
 
 
+def fetch_history(client, point_id, p_range, watermark, batches, stop):
+    # run in the worker threads, the rows of the hisRead grid are parsed as the response is read
+    # and queued in batches of INSERT_BATCH_SIZE, the response is always closed
+    header, data = client.his_read_grid(id=point_id, range=p_range)
+    with data:
+        if not header or 'ts' not in header or 'val' not in header:
+            return
+        ts_index = header.index('ts')
+        val_index = header.index('val')
+        rows = []
+        for item in data:
+            if stop.is_set():
+                return
+            ts_str = item[ts_index].split(" ")[0]
+            # skip the rows already imported by a previous run
+            if watermark and to_datetime(parse_datetime(ts_str)) <= watermark:
+                continue
+            rows.append((item[val_index], point_id, ts_str))
+            if len(rows) >= INSERT_BATCH_SIZE:
+                put_batch(batches, stop, (point_id, rows))
+                rows = []
+        if rows:
+            put_batch(batches, stop, (point_id, rows))
+
+
+def put_batch(batches, stop, batch):
+    while not stop.is_set():
+        try:
+            batches.put(batch, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def insert_data_rows(crate_cursor, rows):
+    # multi rows inserts, rows that already exist are ignored
+    n = 0
+    if not rows:
+        return n
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[i:i + INSERT_BATCH_SIZE]
+        params = []
+        for (val, topic, ts) in batch:
+            params.extend([val, 'scrape', val, topic, ts])
+        crate_cursor.execute("""INSERT INTO "data" (double_value, source, string_value, topic, ts) VALUES {0}
+            ON CONFLICT DO NOTHING;""".format(', '.join(['(%s, %s, %s, %s, %s)'] * len(batch))), params)
+        n += crate_cursor.rowcount
+    return n
+
+
 def prepare_tags(header, data_row):
     m_tags = []
     kv_tags = {}
@@ -246,16 +280,20 @@ def prepare_tags(header, data_row):
 
 
 def print_help():
-    print("Usage: python manage.py runscript get_haystack_data --script-args haystack_server_url [none|range_from]")
+    print("Usage: python manage.py runscript get_haystack_data --script-args haystack_server_url "
+          "[none|range_from] [workers]")
 
 
 def run(*args):
     if len(args) > 0:
         base_url = args[0]
         range_from = None
+        workers = DEFAULT_WORKERS
         if len(args) > 1:
             range_from = args[1]
+        if len(args) > 2:
+            workers = int(args[2])
 
-        import_data(base_url, range_from)
+        import_data(base_url, range_from, workers=workers)
     else:
         print_help()
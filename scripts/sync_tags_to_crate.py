@@ -17,7 +17,7 @@
 
 from opentaps_seas.core.models import Entity
 from opentaps_seas.core.models import ensure_crate_entity_table
-from opentaps_seas.core.models import sync_tags_to_crate_entity
+from opentaps_seas.core.models import sync_tags_to_crate_entities
 
 
 def sync_tags_to_crate():
@@ -32,12 +32,14 @@ def sync_tags_to_crate():
         OR 'equip' = ANY (m_tags)
         '''.format(Entity._meta.db_table), [])
 
-    # iterate the topic data points and copy the tags
+    # iterate the topic data points and copy the tags in bulk
+    rows = []
     for row in entities:
         print(" --> {} {} {}".format(row.entity_id, row.topic, row.kv_tags['id']))
-        sync_tags_to_crate_entity(row)
+        rows.append(row)
 
         count = count + 1
+    sync_tags_to_crate_entities(rows)
 
     print(count, "entities have been processed")
 